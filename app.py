@@ -3,26 +3,62 @@ PRV AI Marketing Assistant - Web Version
 Beautiful, modern web interface
 """
 
-from flask import Flask, render_template, request, jsonify, session, Response
+from flask import Flask, render_template, request, jsonify, session, Response, url_for, send_from_directory, g, has_request_context, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 from functools import wraps
+from contextlib import contextmanager
+from collections import deque, OrderedDict
 from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.utils import secure_filename
-import openai
 import requests
 import threading
 import secrets
-import webbrowser
+import sys
 import time
-from datetime import datetime
+import random
+import cProfile
+import pstats
+import io
+import queue
+import heapq
+import atexit
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 import os
+import re
 import json
+import sqlite3
+import csv
+import itertools
 import base64
+import hashlib
+import codecs
+import zlib
+import mimetypes
+import tempfile
+import html as html_lib
+import uuid
+import mmap
+import struct
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from dotenv import load_dotenv
-import pandas as pd
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
+# NOTE: heavy dependencies (openai, pandas, email.mime, googleapiclient) are imported
+# lazily where they are used so gunicorn workers boot fast
+
+# Brotli is optional - responses fall back to gzip when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# fcntl (POSIX only) lets gunicorn workers coalesce identical upstream calls; elsewhere only threads do
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Load environment variables
 load_dotenv()
@@ -37,11 +73,112 @@ IS_PRODUCTION = os.getenv('FLASK_ENV') == 'production'
 app.secret_key = os.getenv('FLASK_SECRET_KEY', secrets.token_hex(16))
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0 if not IS_PRODUCTION else 3600  # Cache in production
 
+# Fingerprinted static assets (generated by build_assets.py, used in production only)
+ASSET_MANIFEST_PATH = os.path.join(app.static_folder, 'dist', 'manifest.json')
+ASSET_MAX_AGE = 365 * 24 * 3600  # Hashed filenames never change content - cache for a year
+
 # File upload configuration
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'xlsx', 'xls', 'csv'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+UPLOAD_SNIFF_ROWS = int(os.getenv('UPLOAD_SNIFF_ROWS', 20))  # Rows read per sheet to find the header and preview
+UPLOAD_TTL_SECONDS = int(os.getenv('UPLOAD_TTL_SECONDS', 3600))  # Sniffed uploads waiting for the column choice
+
+# Logging configuration
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json' if IS_PRODUCTION else 'text')  # json | text
+LOG_SAMPLE_FIRST = int(os.getenv('LOG_SAMPLE_FIRST', 5))  # Per-item loop logs: first N items...
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', 50))  # ...then every Nth item
+
+# Response compression configuration (JSON API payloads)
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))  # bytes
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', 6))  # 1-9
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', 4))  # 0-11
+COMPRESSIBLE_MIMETYPES = {'application/json', 'application/x-ndjson', 'text/csv'}
+
+# Request timing: requests slower than this are flagged in the timing log
+SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', 3000))
+
+# Request deadline: long endpoints stop cleanly before gunicorn's --timeout (120s) kills the worker
+REQUEST_DEADLINE_SECONDS = float(os.getenv('REQUEST_DEADLINE_SECONDS', 100))
+DEADLINE_RESERVE_SECONDS = 2.0  # Kept back for building the (partial) response
+
+# Circuit breakers: stop calling an upstream that keeps failing (or is too slow) for a while
+CIRCUIT_FAILURE_RATE = float(os.getenv('CIRCUIT_FAILURE_RATE', 0.5))  # Failed or slow share that trips the breaker
+CIRCUIT_MIN_CALLS = int(os.getenv('CIRCUIT_MIN_CALLS', 4))  # Calls in the window before the rate is trusted
+CIRCUIT_WINDOW_SECONDS = int(os.getenv('CIRCUIT_WINDOW_SECONDS', 60))
+CIRCUIT_OPEN_SECONDS = int(os.getenv('CIRCUIT_OPEN_SECONDS', 30))  # Fail fast this long before probing again
+CIRCUIT_SLOW_CALL_SECONDS = {'minicrm': 5, 'gmail': 10, 'openai': 30}
+
+# Prometheus metrics are shared between gunicorn workers through files in this directory
+METRICS_DIR = os.getenv('PROMETHEUS_MULTIPROC_DIR') or os.path.join(tempfile.gettempdir(), 'prv_metrics')
+
+# Contact enrichment: parallel MiniCRM lookups per request, rate-limited per worker (MiniCRM throttles bursts)
+ENRICH_CONCURRENCY = int(os.getenv('ENRICH_CONCURRENCY', 8))
+ENRICH_MINICRM_RPS = float(os.getenv('ENRICH_MINICRM_RPS', 10))
+
+# Chat transcripts: conversations are kept locally so they reload (e.g. after a page refresh) without OpenAI
+CONVERSATION_DB_PATH = os.getenv('CONVERSATION_DB_PATH', os.path.join('data', 'conversations.sqlite3'))
+CONVERSATION_RETENTION_DAYS = int(os.getenv('CONVERSATION_RETENTION_DAYS', 30))  # Idle conversations are deleted
+CONVERSATION_MAX_MESSAGES = int(os.getenv('CONVERSATION_MAX_MESSAGES', 500))  # Per conversation, oldest dropped first
+
+# Empty OpenAI threads kept ready per worker, so a new chat's first message skips creating one (0 = off)
+OPENAI_THREAD_POOL_SIZE = int(os.getenv('OPENAI_THREAD_POOL_SIZE', 2))
+OPENAI_THREAD_POOL_TTL = int(os.getenv('OPENAI_THREAD_POOL_TTL', 3600))  # Seconds; older unused threads are replaced
+
+# Bulk email work (AI-personalized drafts, ...) is stored here so it survives restarts and is shared by all workers
+BULK_DB_PATH = os.getenv('BULK_DB_PATH', os.path.join('data', 'bulk.sqlite3'))
+
+# Pre-rendered campaigns: messages are rendered once into an on-disk spool, previewed and sent from there
+SPOOL_DIR = os.getenv('SPOOL_DIR', os.path.join('data', 'spool'))
+SPOOL_MAX_AGE_DAYS = int(os.getenv('SPOOL_MAX_AGE_DAYS', 7))  # Older spools are deleted when a new one is rendered
+SPOOL_READ_BATCH = 50  # Records read back per mmap while sending
+
+# Scheduled delivery: spooled campaigns are sent inside a weekly window, drip-throttled per Gmail account
+SCHEDULE_TIMEZONE = ZoneInfo(os.getenv('SCHEDULE_TIMEZONE', 'Europe/Budapest'))
+SCHEDULE_DEFAULT_PER_HOUR = int(os.getenv('SCHEDULE_DEFAULT_PER_HOUR', 60))
+SCHEDULE_DEFAULT_WINDOW = {'days': [0, 1, 2, 3, 4], 'start': '09:00', 'end': '17:00'}  # Weekdays, business hours
+SCHEDULE_POLL_SECONDS = 30  # Longest the scheduler sleeps (new/resumed campaigns are picked up within this)
+SCHEDULE_MAX_ATTEMPTS = int(os.getenv('SCHEDULE_MAX_ATTEMPTS', 5))  # Tries per message on 429/5xx before it counts as failed
+
+# Sender pool: several authorized Gmail accounts share a bulk send (defaults for newly added accounts)
+SENDER_POOL_DAILY_QUOTA = int(os.getenv('SENDER_POOL_DAILY_QUOTA', 500))  # Gmail: 500/day, Workspace: 2000/day
+SENDER_POOL_PER_MINUTE = int(os.getenv('SENDER_POOL_PER_MINUTE', 120))
+SENDER_POOL_ROUND = 5  # Messages per account per round; the deadline is checked between rounds
+
+# AI-personalized openers: background generation with bounded concurrency and retry/backoff
+PERSONALIZE_MODEL = os.getenv('PERSONALIZE_MODEL', 'gpt-4o-mini')
+PERSONALIZE_CONCURRENCY = int(os.getenv('PERSONALIZE_CONCURRENCY', 4))
+PERSONALIZE_MAX_RETRIES = int(os.getenv('PERSONALIZE_MAX_RETRIES', 4))
+PERSONALIZE_CACHE_DAYS = int(os.getenv('PERSONALIZE_CACHE_DAYS', 30))  # Identical contact+prompt reuses the draft
+# USD per 1M tokens (prompt, completion) - used for the per-job cost estimate only
+PERSONALIZE_PRICE_PER_1M = tuple(float(p) for p in os.getenv('PERSONALIZE_PRICE_PER_1M', '0.15,0.60').split(','))
+PERSONALIZE_STALE_SECONDS = 120  # A running job without a heartbeat this long lost its worker and may be resumed
+
+# Email history summaries: compact per-contact context for chat instead of the full email bodies
+EMAIL_SUMMARY_MODEL = os.getenv('EMAIL_SUMMARY_MODEL', 'gpt-4o-mini')
+EMAIL_SUMMARY_CACHE_DAYS = int(os.getenv('EMAIL_SUMMARY_CACHE_DAYS', 30))
+EMAIL_SUMMARY_MAX_BODY = 4000  # Characters of each email body sent for summarizing
+
+# Shared cache: small per-worker LRU in front of a SQLite (WAL) file shared by all workers
+CACHE_DB_PATH = os.getenv('CACHE_DB_PATH') or os.path.join(tempfile.gettempdir(), 'prv_cache.sqlite3')
+CACHE_MAX_MB = float(os.getenv('CACHE_MAX_MB', 64))  # Shared tier size bound (least recently used evicted first)
+CACHE_MEMORY_ITEMS = int(os.getenv('CACHE_MEMORY_ITEMS', 256))  # Per worker and namespace
+CACHE_MEMORY_MAX_AGE = 10  # Seconds a worker trusts its memory copy (bounds staleness after other workers' writes)
+
+# Identical concurrent upstream calls are coalesced across workers through lock/result files here
+SINGLE_FLIGHT_DIR = os.path.join(tempfile.gettempdir(), 'prv_singleflight')
+
+# Request profiling: on demand (X-Profile header / ?profile=1) for PROFILE_USERS,
+# plus automatic stack sampling of requests slower than PROFILE_SLOW_MS (0 = off)
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_USERS = {u.strip() for u in os.getenv('PROFILE_USERS', '').split(',') if u.strip()}
+PROFILE_SLOW_MS = int(os.getenv('PROFILE_SLOW_MS', 0))
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 1.0))  # Fraction of requests sampled
+PROFILE_SAMPLE_INTERVAL = 0.01  # seconds between stack samples
+PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', 50))
+PROFILE_MAX_MB = int(os.getenv('PROFILE_MAX_MB', 50))
 
 # Create uploads folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
@@ -54,6 +191,94 @@ if IS_PRODUCTION:
 
 CORS(app)
 
+# ============================================
+# LOGGING
+# ============================================
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, message, request ID and any `extra` fields"""
+    
+    RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+    
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'msg': record.getMessage()
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                entry[key] = value
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class RequestIdFilter(logging.Filter):
+    """Attach the current request ID (runs in the logging thread, before queueing)"""
+    
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):  # May already be passed via `extra`
+            record.request_id = g.get('request_id', '-') if has_request_context() else '-'
+        return True
+
+
+def build_log_listener():
+    """Queue + background listener thread that writes log records to stdout"""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s [%(request_id)s] %(message)s'))
+    log_queue = queue.SimpleQueue()
+    return log_queue, QueueListener(log_queue, stream_handler)
+
+
+# Handlers only enqueue records - formatting and the stdout write happen off the request thread
+log_queue, log_listener = build_log_listener()
+log_queue_handler = QueueHandler(log_queue)
+log_queue_handler.addFilter(RequestIdFilter())
+
+logger = logging.getLogger('prv')
+logger.setLevel(LOG_LEVEL)
+logger.addHandler(log_queue_handler)
+logger.propagate = False
+
+log_listener.start()
+atexit.register(lambda: log_listener.stop())  # Flush queued records on shutdown
+
+
+def restart_log_listener_after_fork():
+    """The listener thread does not survive fork - each worker gets its own queue and thread"""
+    global log_queue, log_listener
+    log_queue, log_listener = build_log_listener()
+    log_queue_handler.queue = log_queue
+    log_listener.start()
+
+
+os.register_at_fork(after_in_child=restart_log_listener_after_fork)
+
+
+REQUEST_ID_RE = re.compile(r'^[\w.-]{1,64}$')
+
+
+def log_sampled(index):
+    """Whether to log debug detail for the index-th (1-based) item of a loop: first few, then every Nth"""
+    return logger.isEnabledFor(logging.DEBUG) and (index <= LOG_SAMPLE_FIRST or index % LOG_SAMPLE_EVERY == 0)
+
+
+@app.before_request
+def assign_request_id():
+    """Use the caller's X-Request-ID or generate one, for correlating log lines"""
+    request_id = request.headers.get('X-Request-ID', '')
+    g.request_id = request_id if REQUEST_ID_RE.match(request_id) else secrets.token_hex(8)
+
+
+@app.after_request
+def add_request_id_header(response):
+    """Echo the request ID back to the client"""
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
 # Basic Authentication (for internal company use)
 # Support multiple users - format: username1:password1,username2:password2
 BASIC_AUTH_USERS = {}
@@ -77,6 +302,10 @@ ALLOWED_EMAIL_DOMAINS = os.getenv('ALLOWED_EMAIL_DOMAINS', '').split(',') if os.
 MINICRM_SYSTEM_ID = os.getenv('MINICRM_SYSTEM_ID', '')
 MINICRM_API_KEY = os.getenv('MINICRM_API_KEY', '')
 MINICRM_ENABLED = bool(MINICRM_SYSTEM_ID and MINICRM_API_KEY)
+MINICRM_API_URL = os.getenv('MINICRM_API_URL', 'https://r3.minicrm.hu/Api/R3').rstrip('/')
+
+# Gmail API root override (None = Google's default) - lets benchmarks run against a local fake
+GMAIL_API_URL = os.getenv('GMAIL_API_URL')
 
 # Load API keys from environment variables (production) or config file (local)
 CONFIG_FILE = 'config.json'
@@ -92,7 +321,7 @@ if not CHATGPT_API_KEY and os.path.exists(CONFIG_FILE):
             CHATGPT_API_KEY = config.get('openai_api_key')
             ASSISTANTS_CONFIG = config.get('assistants', {})
     except Exception as e:
-        print(f"⚠️  Warning: Could not load config.json: {e}")
+        logger.warning("Could not load config.json: %s", e)
 
 # Handle Gmail credentials from base64 env var (for Railway)
 if os.getenv('GMAIL_CREDENTIALS_BASE64') and not os.path.exists(GMAIL_CREDENTIALS_PATH):
@@ -100,9 +329,9 @@ if os.getenv('GMAIL_CREDENTIALS_BASE64') and not os.path.exists(GMAIL_CREDENTIAL
         creds_json = base64.b64decode(os.getenv('GMAIL_CREDENTIALS_BASE64')).decode('utf-8')
         with open(GMAIL_CREDENTIALS_PATH, 'w') as f:
             f.write(creds_json)
-        print("✅ Gmail credentials loaded from environment")
+        logger.info("Gmail credentials loaded from environment")
     except Exception as e:
-        print(f"⚠️  Warning: Could not decode Gmail credentials: {e}")
+        logger.warning("Could not decode Gmail credentials: %s", e)
 
 # Handle Gmail token from base64 env var (for Railway)
 if os.getenv('GMAIL_TOKEN_BASE64') and not os.path.exists(GMAIL_TOKEN_PATH):
@@ -110,9 +339,9 @@ if os.getenv('GMAIL_TOKEN_BASE64') and not os.path.exists(GMAIL_TOKEN_PATH):
         token_json = base64.b64decode(os.getenv('GMAIL_TOKEN_BASE64')).decode('utf-8')
         with open(GMAIL_TOKEN_PATH, 'w') as f:
             f.write(token_json)
-        print("✅ Gmail token loaded from environment")
+        logger.info("Gmail token loaded from environment")
     except Exception as e:
-        print(f"⚠️  Warning: Could not decode Gmail token: {e}")
+        logger.warning("Could not decode Gmail token: %s", e)
 
 # Default assistants (can be overridden in config)
 ASSISTANTS = {
@@ -128,22 +357,48 @@ ASSISTANTS = {
     }
 }
 
-# Initialize OpenAI client (only if API key is available)
-client = None
-if CHATGPT_API_KEY:
-    try:
-        client = openai.OpenAI(api_key=CHATGPT_API_KEY)
-        print("✅ OpenAI API initialized")
-    except Exception as e:
-        print(f"⚠️  Warning: Could not initialize OpenAI client: {e}")
-        client = None
-else:
-    print("⚠️  Warning: No OpenAI API key found. Chat functionality will be disabled.")
+# OpenAI client is created lazily on first use (see get_openai_client)
+HAS_OPENAI = bool(CHATGPT_API_KEY)
+if not HAS_OPENAI:
+    logger.warning("No OpenAI API key found. Chat functionality will be disabled.")
+
+_openai_client = None
+_openai_client_lock = threading.Lock()
+
 
-# Store conversations in memory (in production, use a database)
-conversations = {}
+def get_openai_client():
+    """Get this process's OpenAI client, creating it on first use (None if not configured)"""
+    global _openai_client
+    if not HAS_OPENAI:
+        return None
+    if _openai_client is None:
+        with _openai_client_lock:
+            if _openai_client is None:
+                try:
+                    import openai
+                    _openai_client = openai.OpenAI(api_key=CHATGPT_API_KEY)
+                    logger.info("OpenAI API initialized")
+                except Exception as e:
+                    logger.warning("Could not initialize OpenAI client: %s", e)
+                    return None
+    return _openai_client
 
 
+def openai_available():
+    """Whether chat can work: a key is set and this process could build the client"""
+    return get_openai_client() is not None
+
+
+def reset_clients_after_fork():
+    """Drop clients inherited from the parent process (gunicorn --preload forks workers)"""
+    global _openai_client, _openai_client_lock
+    # Connection pools must not be shared between processes - each worker builds its own
+    _openai_client = None
+    _openai_client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_clients_after_fork)
+
 # Authentication decorator for internal use
 def check_auth(username, password):
     """Check if username/password is valid"""
@@ -175,1418 +430,5611 @@ def requires_auth(f):
     return decorated
 
 
-@app.route('/')
-@requires_auth
-def index():
-    """Main page"""
-    has_openai = client is not None
-    has_gmail = os.path.exists(GMAIL_CREDENTIALS_PATH)
+# ============================================
+# REQUEST TIMING
+# ============================================
+
+class RequestTimer:
+    """Wall time per phase (upstream service or local step) for one request"""
     
-    # Get username from auth if available
-    username = None
-    if request.authorization:
-        username = request.authorization.username
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}  # name -> [total_ms, count]
+        self.lock = threading.Lock()
+    
+    def add(self, name, duration_ms):
+        with self.lock:
+            phase = self.phases.setdefault(name, [0.0, 0])
+            phase[0] += duration_ms
+            phase[1] += 1
     
-    return render_template('index.html', 
-                         assistants=ASSISTANTS,
-                         has_openai=has_openai,
-                         has_gmail=has_gmail,
-                         username=username)
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+    
+    def breakdown(self):
+        """Phases plus 'app' (time not spent in any recorded phase) and the total"""
+        total_ms = self.elapsed_ms()
+        with self.lock:
+            phases = {name: {'ms': round(ms, 1), 'calls': count} for name, (ms, count) in self.phases.items()}
+        recorded_ms = sum(phase['ms'] for phase in phases.values())
+        phases['app'] = {'ms': round(max(total_ms - recorded_ms, 0.0), 1), 'calls': 1}
+        return phases, round(total_ms, 1)
 
 
-@app.route('/api/send_message', methods=['POST'])
-def send_message():
-    """Send a message to the AI assistant"""
-    try:
-        # Check if OpenAI is configured
-        if not client:
-            return jsonify({
-                'error': 'OpenAI API is not configured. Please set up your API key in the Settings.'
-            }), 400
-        
-        data = request.json
-        message = data.get('message', '').strip()
-        assistant_name = data.get('assistant', 'Marketing Expert')
-        session_id = data.get('session_id', 'default')
-        
-        if not message:
-            return jsonify({'error': 'Message is required'}), 400
-        
-        # Get or create thread
-        if session_id not in conversations:
-            conversations[session_id] = {
-                'thread_id': None,
-                'messages': []
-            }
-        
-        conv = conversations[session_id]
-        
-        # Create thread if needed
-        if not conv['thread_id']:
-            thread = client.beta.threads.create()
-            conv['thread_id'] = thread.id
-        
-        # Add user message
-        client.beta.threads.messages.create(
-            thread_id=conv['thread_id'],
-            role="user",
-            content=message
-        )
-        
-        # Get assistant
-        assistant_id = ASSISTANTS[assistant_name]['id']
-        
-        # Run assistant
-        run = client.beta.threads.runs.create(
-            thread_id=conv['thread_id'],
-            assistant_id=assistant_id
-        )
-        
-        # Wait for completion
-        while run.status in ['queued', 'in_progress']:
-            time.sleep(0.5)
-            run = client.beta.threads.runs.retrieve(
-                thread_id=conv['thread_id'],
-                run_id=run.id
-            )
-        
-        if run.status == 'completed':
-            # Get messages
-            messages = client.beta.threads.messages.list(
-                thread_id=conv['thread_id']
-            )
-            
-            # Get the latest assistant message
-            for msg in messages.data:
-                if msg.role == "assistant":
-                    response_text = msg.content[0].text.value
-                    
-                    return jsonify({
-                        'response': response_text,
-                        'assistant': assistant_name,
-                        'timestamp': datetime.now().isoformat()
-                    })
-        
-        return jsonify({'error': 'Failed to get response'}), 500
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+def current_timer():
+    """RequestTimer of the active request (None outside a request)"""
+    return g.get('timer') if has_request_context() else None
 
 
-@app.route('/api/clear_conversation', methods=['POST'])
-def clear_conversation():
-    """Clear conversation history"""
+@contextmanager
+def timed(name, timer=None):
+    """Record the wall time of a block under `name` (e.g. 'minicrm', 'parse') for the request"""
+    timer = timer or current_timer()
+    start = time.perf_counter()
     try:
-        data = request.json
-        session_id = data.get('session_id', 'default')
-        
-        if session_id in conversations:
-            del conversations[session_id]
-        
-        return jsonify({'success': True})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        yield
+    finally:
+        if timer is not None:
+            timer.add(name, (time.perf_counter() - start) * 1000)
 
 
-@app.route('/api/check_config', methods=['GET'])
-def check_config():
-    """Check if APIs are configured"""
-    return jsonify({
-        'hasOpenAI': client is not None,
-        'hasGmail': os.path.exists(GMAIL_CREDENTIALS_PATH)
-    })
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider that records jsonify() serialization as the 'render' phase"""
+    
+    def response(self, *args, **kwargs):
+        with timed('render'):
+            return super().response(*args, **kwargs)
 
 
-@app.route('/api/gmail_status', methods=['GET'])
-def gmail_status():
-    """Check Gmail connection status"""
-    gmail_token = session.get('gmail_token')
-    user_email = session.get('gmail_user_email')
+app.json = TimedJSONProvider(app)
+
+
+def log_request_timing(timer, method, path, status, request_id):
+    """Log one structured timing record per request (WARNING level when slow)"""
+    phases, total_ms = timer.breakdown()
+    slow = total_ms >= SLOW_REQUEST_MS
+    logger.log(
+        logging.WARNING if slow else logging.INFO,
+        "%s %s %s %.0f ms%s", method, path, status, total_ms, ' (slow)' if slow else '',
+        extra={
+            'event': 'request_timing',
+            'request_id': request_id,
+            'method': method,
+            'path': path,
+            'status': status,
+            'total_ms': total_ms,
+            'slow': slow,
+            'phases': phases
+        }
+    )
+
+
+@app.before_request
+def start_request_timer():
+    """Start timing the request"""
+    g.timer = RequestTimer()
+
+
+@app.after_request
+def add_server_timing(response):
+    """Emit the Server-Timing header and log the breakdown once the response is sent"""
+    timer = current_timer()
+    if timer is None:
+        return response
     
-    return jsonify({
-        'connected': gmail_token is not None,
-        'email': user_email if gmail_token else None
-    })
+    phases, total_ms = timer.breakdown()
+    entries = []
+    for name, phase in phases.items():
+        if name == 'app':
+            entries.append(f'app;dur={phase["ms"]}')
+        else:
+            entries.append(f'{name};dur={phase["ms"]};desc="{phase["calls"]} call(s)"')
+    entries.append(f'total;dur={total_ms}')
+    response.headers['Server-Timing'] = ', '.join(entries)
+    
+    if not request.path.startswith('/static/'):
+        method, path, status, request_id = request.method, request.path, response.status_code, g.get('request_id', '-')
+        # Logged on close so streamed responses report their full duration
+        response.call_on_close(lambda: log_request_timing(timer, method, path, status, request_id))
+    return response
 
 
-@app.route('/api/gmail_disconnect', methods=['POST'])
-def gmail_disconnect():
-    """Disconnect Gmail"""
-    session.pop('gmail_token', None)
-    session.pop('gmail_user_email', None)
-    session.pop('gmail_oauth_state', None)
+# ============================================
+# PROMETHEUS METRICS
+# ============================================
+
+def cleanup_dead_metrics_files():
+    """Remove metric files left behind by worker processes that no longer exist"""
+    for filename in os.listdir(METRICS_DIR):
+        match = re.search(r'_(\d+)\.db$', filename)
+        if not match:
+            continue
+        try:
+            os.kill(int(match.group(1)), 0)
+        except ProcessLookupError:
+            os.remove(os.path.join(METRICS_DIR, filename))
+        except OSError:
+            pass  # Process exists but belongs to another user
+
+
+# Multiprocess mode must be configured before prometheus_client is imported
+os.environ['PROMETHEUS_MULTIPROC_DIR'] = METRICS_DIR
+os.makedirs(METRICS_DIR, exist_ok=True)
+cleanup_dead_metrics_files()
+
+from prometheus_client import (  # noqa: E402
+    CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess, CONTENT_TYPE_LATEST
+)
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+HTTP_REQUESTS = Counter(
+    'prv_http_requests_total', 'HTTP requests handled', ['method', 'route', 'status'])
+HTTP_LATENCY = Histogram(
+    'prv_http_request_duration_seconds', 'HTTP request latency', ['route'], buckets=LATENCY_BUCKETS)
+HTTP_IN_FLIGHT = Gauge(
+    'prv_http_requests_in_flight', 'HTTP requests currently being handled', multiprocess_mode='livesum')
+UPSTREAM_REQUESTS = Counter(
+    'prv_upstream_requests_total', 'Calls to upstream APIs', ['upstream', 'outcome'])
+UPSTREAM_LATENCY = Histogram(
+    'prv_upstream_request_duration_seconds', 'Upstream API call latency', ['upstream'], buckets=LATENCY_BUCKETS)
+BULK_EMAILS = Counter(
+    'prv_bulk_emails_total', 'Bulk campaign emails processed', ['result'])
+CACHE_LOOKUPS = Counter(
+    'prv_cache_lookups_total', 'Cache lookups', ['cache', 'result'])
+CIRCUIT_STATE = Gauge(
+    'prv_circuit_state', 'Upstream circuit breaker state (0 closed, 1 half-open, 2 open), worst worker',
+    ['upstream'], multiprocess_mode='max')
+CIRCUIT_REJECTIONS = Counter(
+    'prv_circuit_rejections_total', 'Upstream calls rejected by an open circuit breaker', ['upstream'])
+SINGLE_FLIGHT_CALLS = Counter(
+    'prv_single_flight_total', 'Coalesced upstream queries (leader = fetched, follower = shared result)',
+    ['query', 'role'])
+PERSONALIZED_DRAFTS = Counter(
+    'prv_personalized_drafts_total', 'AI-personalized drafts (generated, cached = reused, failed)', ['result'])
+OPENAI_TOKENS = Counter(
+    'prv_openai_tokens_total', 'OpenAI tokens used by background generation', ['kind'])
+EMAIL_SUMMARIES = Counter(
+    'prv_email_summaries_total', 'Email history summaries (full, incremental, covered = by an earlier summary, cached)',
+    ['mode'])
+OPENAI_THREAD_POOL = Counter(
+    'prv_openai_thread_pool_total', 'New chat sessions given a pre-created thread (hit) or not (miss)', ['result'])
+
+
+def record_cache_lookup(cache_name, hit):
+    """Count a cache hit or miss (hit ratio = hits / all lookups)"""
+    CACHE_LOOKUPS.labels(cache_name, 'hit' if hit else 'miss').inc()
+
+
+@app.before_request
+def start_request_metrics():
+    """Track in-flight requests"""
+    g.metrics_route = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_IN_FLIGHT.inc()
+
+
+@app.after_request
+def record_response_status(response):
+    """Remember the status code for the request metrics"""
+    g.metrics_status = response.status_code
+    return response
+
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    """Count the request and observe its latency"""
+    if 'metrics_route' not in g:
+        return
+    HTTP_IN_FLIGHT.dec()
+    status = g.get('metrics_status', 500)
+    HTTP_REQUESTS.labels(request.method, g.metrics_route, str(status)).inc()
+    HTTP_LATENCY.labels(g.metrics_route).observe(g.timer.elapsed_ms() / 1000)
+
+
+@app.route('/metrics')
+@requires_auth
+def metrics():
+    """Prometheus metrics, aggregated across all gunicorn workers"""
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+# ============================================
+# REQUEST PROFILING
+# ============================================
+
+class StackSampler:
+    """Background thread that periodically samples the stacks of registered request threads"""
     
-    return jsonify({
-        'success': True
-    })
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stacks = {}  # thread ident -> {collapsed stack: sample count}
+        self.thread = None
+    
+    def start(self, ident):
+        with self.lock:
+            self.stacks[ident] = {}
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profile-sampler', daemon=True)
+                self.thread.start()
+    
+    def stop(self, ident):
+        with self.lock:
+            return self.stacks.pop(ident, {})
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.stacks:
+                    self.thread = None  # Exit while idle; restarted by the next start()
+                    return
+                frames = sys._current_frames()
+                for ident, counts in self.stacks.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        key = collapse_stack(frame)
+                        counts[key] = counts.get(key, 0) + 1
 
 
-@app.route('/api/save_config', methods=['POST'])
-def save_config():
-    """Save API configuration"""
-    try:
-        data = request.json
-        
-        config = {}
-        if os.path.exists(CONFIG_FILE):
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-        
-        # Update config
-        if 'openai_api_key' in data:
-            config['openai_api_key'] = data['openai_api_key']
-        
-        if 'gmail_credentials' in data:
-            # Save Gmail credentials to file
-            with open(GMAIL_CREDENTIALS_PATH, 'w') as f:
-                json.dump(data['gmail_credentials'], f, indent=2)
-        
-        # Save config
-        with open(CONFIG_FILE, 'w') as f:
-            json.dump(config, f, indent=2)
-        
-        return jsonify({
-            'success': True,
-            'message': 'Configuration saved! Please restart the application for changes to take effect.'
-        })
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+def collapse_stack(frame):
+    """Stack as 'file:function;file:function;...' from outermost to innermost (flame graph format)"""
+    names = []
+    while frame is not None:
+        names.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
 
 
-def extract_message_body(payload):
-    """Extract text body from Gmail message payload"""
-    import re
-    import base64
+profile_sampler = StackSampler(PROFILE_SAMPLE_INTERVAL)
+# Only one cProfile profiler may run at a time per process
+profiler_lock = threading.Lock()
+
+
+def reset_profiling_after_fork():
+    """The sampler thread does not survive fork - start fresh in each worker"""
+    global profile_sampler, profiler_lock
+    profile_sampler = StackSampler(PROFILE_SAMPLE_INTERVAL)
+    profiler_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_profiling_after_fork)
+
+
+def can_profile():
+    """Only users listed in PROFILE_USERS may profile (anyone locally when auth is off)"""
+    if not BASIC_AUTH_USERS:
+        return not IS_PRODUCTION
+    auth = request.authorization
+    return bool(auth and check_auth(auth.username, auth.password) and auth.username in PROFILE_USERS)
+
+
+def save_profile(kind, write):
+    """Write a profile file via write(path), prune old profiles and return the file name"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    extension = 'prof' if kind == 'cprofile' else 'txt'
+    name = f"{datetime.now():%Y%m%d-%H%M%S}-{request.endpoint or 'unknown'}-{kind}-{secrets.token_hex(3)}.{extension}"
+    write(os.path.join(PROFILE_DIR, name))
+    prune_profiles()
+    return name
+
+
+def prune_profiles():
+    """Keep at most PROFILE_MAX_FILES profiles and PROFILE_MAX_MB on disk (newest kept)"""
+    entries = sorted(os.scandir(PROFILE_DIR), key=lambda e: e.stat().st_mtime, reverse=True)
+    total_bytes = 0
+    for index, entry in enumerate(entries):
+        total_bytes += entry.stat().st_size
+        if index >= PROFILE_MAX_FILES or total_bytes > PROFILE_MAX_MB * 1024 * 1024:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+
+@app.before_request
+def start_profiling():
+    """Start cProfile when requested, or stack sampling for slow-request capture"""
+    if request.path.startswith('/static/') or request.path.startswith('/api/profiles'):
+        return
+    if request.headers.get('X-Profile') or request.args.get('profile'):
+        if can_profile() and profiler_lock.acquire(blocking=False):
+            g.profiler = cProfile.Profile()
+            g.profiler.enable()
+    elif PROFILE_SLOW_MS and random.random() < PROFILE_SAMPLE_RATE:
+        g.sampled_thread = threading.get_ident()
+        profile_sampler.start(g.sampled_thread)
+
+
+@app.after_request
+def finish_profiling(response):
+    """Store the request's profile and point to it via the X-Profile-Id header"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profiler_lock.release()
+        name = save_profile('cprofile', profiler.dump_stats)
+        response.headers['X-Profile-Id'] = name
     
-    body = ""
+    sampled_thread = g.pop('sampled_thread', None)
+    if sampled_thread is not None:
+        counts = profile_sampler.stop(sampled_thread)
+        elapsed_ms = g.timer.elapsed_ms()
+        if elapsed_ms >= PROFILE_SLOW_MS and counts:
+            def write(path):
+                with open(path, 'w') as f:
+                    for stack, count in sorted(counts.items(), key=lambda item: -item[1]):
+                        f.write(f'{stack} {count}\n')
+            name = save_profile('sampled', write)
+            logger.warning("Slow request %s %s (%.0f ms) - profile saved: %s", request.method, request.path, elapsed_ms, name)
+    return response
+
+
+@app.teardown_request
+def cleanup_profiling(exc):
+    """Make sure profilers are stopped if the request failed before after_request"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        profiler_lock.release()
+    sampled_thread = g.pop('sampled_thread', None)
+    if sampled_thread is not None:
+        profile_sampler.stop(sampled_thread)
+
+
+@app.route('/api/profiles', methods=['GET'])
+@requires_auth
+def list_profiles():
+    """List stored profiles (newest first)"""
+    if not can_profile():
+        return jsonify({'error': 'Profiling not allowed for this user'}), 403
     
-    if 'parts' in payload:
-        for part in payload['parts']:
-            if part['mimeType'] == 'text/plain':
-                if 'data' in part['body']:
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
-                    break
-            elif part['mimeType'] == 'text/html' and not body:
-                if 'data' in part['body']:
-                    body = base64.urlsafe_b64decode(part['body']['data']).decode('utf-8', errors='ignore')
-            elif 'parts' in part:
-                body = extract_message_body(part)
-                if body:
-                    break
-    elif 'body' in payload and 'data' in payload['body']:
-        body = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8', errors='ignore')
-    
-    # If HTML, clean it
-    if body and ('<html' in body.lower() or '<!doctype' in body.lower()):
-        # Remove style, script, head blocks
-        body = re.sub(r'<style[^>]*>.*?</style>', '', body, flags=re.DOTALL | re.IGNORECASE)
-        body = re.sub(r'<script[^>]*>.*?</script>', '', body, flags=re.DOTALL | re.IGNORECASE)
-        body = re.sub(r'<head[^>]*>.*?</head>', '', body, flags=re.DOTALL | re.IGNORECASE)
-        body = re.sub(r'<!--.*?-->', '', body, flags=re.DOTALL)
-        # Remove HTML tags
-        body = re.sub(r'<[^>]+>', ' ', body)
-        # Decode HTML entities
-        body = body.replace('&nbsp;', ' ').replace('&amp;', '&').replace('&lt;', '<').replace('&gt;', '>').replace('&quot;', '"')
-        # Clean up whitespace
-        body = re.sub(r'\s+', ' ', body)
+    profiles = []
+    if os.path.isdir(PROFILE_DIR):
+        for entry in sorted(os.scandir(PROFILE_DIR), key=lambda e: e.stat().st_mtime, reverse=True):
+            profiles.append({
+                'name': entry.name,
+                'size': entry.stat().st_size,
+                'created': datetime.fromtimestamp(entry.stat().st_mtime).isoformat()
+            })
+    return jsonify({'success': True, 'profiles': profiles})
+
+
+@app.route('/api/profiles/<name>', methods=['GET'])
+@requires_auth
+def download_profile(name):
+    """Download a stored profile (?format=text renders a cProfile file as a pstats report)"""
+    if not can_profile():
+        return jsonify({'error': 'Profiling not allowed for this user'}), 403
     
-    return body.strip()
+    name = secure_filename(name)
+    path = os.path.join(PROFILE_DIR, name)
+    if not os.path.isfile(path):
+        return jsonify({'error': 'Profile not found'}), 404
+    
+    if name.endswith('.prof') and request.args.get('format') == 'text':
+        report = io.StringIO()
+        pstats.Stats(path, stream=report).sort_stats('cumulative').print_stats(60)
+        return Response(report.getvalue(), mimetype='text/plain')
+    
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, as_attachment=True)
 
 
-@app.route('/api/gmail_auth_url', methods=['GET'])
-def gmail_auth_url():
-    """Generate Gmail OAuth URL for user authorization"""
-    try:
-        if not os.path.exists(GMAIL_CREDENTIALS_PATH):
-            return jsonify({
-                'error': 'Gmail API is not configured.',
-                'needs_setup': True
+# ============================================
+# REQUEST DEADLINES
+# ============================================
+
+class DeadlineExceeded(Exception):
+    """Raised instead of starting upstream work once the request's time budget is used up"""
+    
+    def __init__(self, message='Request time budget exhausted'):
+        super().__init__(message)
+
+
+class Deadline:
+    """Time budget for one request, propagated into upstream calls and long loops"""
+    
+    def __init__(self, seconds):
+        self.expires_at = time.monotonic() + seconds
+    
+    def remaining(self):
+        return self.expires_at - time.monotonic() - DEADLINE_RESERVE_SECONDS
+    
+    def expired(self):
+        return self.remaining() <= 0
+    
+    def timeout(self, default):
+        """Upstream timeout capped to the remaining budget"""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded()
+        return min(default, remaining)
+
+
+def current_deadline():
+    """Deadline of the active request (None outside a request)"""
+    return g.get('deadline') if has_request_context() else None
+
+
+@app.before_request
+def start_request_deadline():
+    """Give every request a deadline; clients may ask for a shorter one via X-Request-Timeout"""
+    budget = REQUEST_DEADLINE_SECONDS
+    try:
+        requested = float(request.headers.get('X-Request-Timeout', 0))
+    except ValueError:
+        requested = 0
+    if 0 < requested < budget:
+        budget = requested
+    g.deadline = Deadline(budget)
+
+
+def encode_cursor(state):
+    """Opaque continuation cursor for resuming a partial result"""
+    return base64.urlsafe_b64encode(json.dumps(state).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a continuation cursor (raises ValueError if it is malformed)"""
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(state, dict):
+        raise ValueError('Invalid cursor')
+    return state
+
+
+# ============================================
+# CIRCUIT BREAKERS
+# ============================================
+
+UPSTREAM_NAMES = {'minicrm': 'MiniCRM', 'gmail': 'Gmail', 'openai': 'OpenAI'}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open"""
+    
+    def __init__(self, upstream, retry_after):
+        self.upstream = upstream
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(f'{UPSTREAM_NAMES.get(upstream, upstream)} is temporarily unavailable '
+                         f'(too many failed or slow calls) - retry in {self.retry_after}s')
+
+
+class CircuitBreaker:
+    """Per-worker breaker for one upstream: closed -> open on a high failure/slow rate, half-open probe -> closed"""
+    
+    STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+    
+    def __init__(self, upstream, slow_call_seconds):
+        self.upstream = upstream
+        self.slow_call_seconds = slow_call_seconds
+        self.lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.state = 'closed'
+        self.outcomes = deque()  # (monotonic time, failed, slow) inside the rolling window
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.last_error = None
+        CIRCUIT_STATE.labels(self.upstream).set(0)
+    
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit breaker %s: %s -> %s", self.upstream, self.state, state)
+        self.state = state
+        CIRCUIT_STATE.labels(self.upstream).set(self.STATES[state])
+    
+    def before_call(self):
+        """Reserve a call slot, or raise CircuitOpenError to fail fast"""
+        with self.lock:
+            if self.state == 'open':
+                waited = time.monotonic() - self.opened_at
+                if waited < CIRCUIT_OPEN_SECONDS:
+                    raise CircuitOpenError(self.upstream, CIRCUIT_OPEN_SECONDS - waited)
+                self._set_state('half_open')
+            if self.state == 'half_open':
+                # Only one probe at a time - everyone else keeps failing fast until it reports back
+                if self.probe_in_flight:
+                    raise CircuitOpenError(self.upstream, 1)
+                self.probe_in_flight = True
+    
+    def record(self, failed, seconds, error=None, check_latency=True):
+        """Report the outcome of a call reserved with before_call"""
+        slow = check_latency and seconds >= self.slow_call_seconds
+        now = time.monotonic()
+        with self.lock:
+            if failed or slow:
+                self.last_error = error or ('slow call: %.1fs' % seconds)
+            if self.state == 'half_open':
+                self.probe_in_flight = False
+                self.outcomes.clear()
+                if failed or slow:
+                    self.opened_at = now
+                    self._set_state('open')
+                else:
+                    self._set_state('closed')
+                return
+            if self.state == 'open':
+                return  # Late result of a call started before the breaker opened
+            self.outcomes.append((now, failed, slow))
+            while self.outcomes and self.outcomes[0][0] < now - CIRCUIT_WINDOW_SECONDS:
+                self.outcomes.popleft()
+            bad = sum(1 for _, f, s in self.outcomes if f or s)
+            if len(self.outcomes) >= CIRCUIT_MIN_CALLS and bad / len(self.outcomes) >= CIRCUIT_FAILURE_RATE:
+                self.opened_at = now
+                self._set_state('open')
+    
+    def snapshot(self):
+        """State for the status endpoint"""
+        with self.lock:
+            calls = len(self.outcomes)
+            return {
+                'name': UPSTREAM_NAMES.get(self.upstream, self.upstream),
+                'state': self.state,
+                'calls_in_window': calls,
+                'failed_in_window': sum(1 for _, f, _ in self.outcomes if f),
+                'slow_in_window': sum(1 for _, _, s in self.outcomes if s),
+                'retry_after': max(0, int(self.opened_at + CIRCUIT_OPEN_SECONDS - time.monotonic()))
+                               if self.state == 'open' else 0,
+                'last_error': self.last_error
+            }
+
+
+circuit_breakers = {name: CircuitBreaker(name, slow) for name, slow in CIRCUIT_SLOW_CALL_SECONDS.items()}
+
+
+def reset_breakers_after_fork():
+    """Each worker judges upstream health from its own calls; locks must not be inherited held"""
+    for breaker in circuit_breakers.values():
+        breaker.lock = threading.Lock()
+        breaker.reset()
+
+
+os.register_at_fork(after_in_child=reset_breakers_after_fork)
+
+
+def degraded_upstreams():
+    """Upstreams this worker is currently failing fast for (open or half-open breaker)"""
+    return sorted(name for name, breaker in circuit_breakers.items() if breaker.state != 'closed')
+
+
+def circuit_open_response(error):
+    """503 response for a request that could not be served because an upstream's breaker is open"""
+    response = jsonify({
+        'error': str(error),
+        'degraded': [error.upstream],
+        'retry_after': error.retry_after
+    })
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 503
+
+
+@app.route('/api/upstream_status', methods=['GET'])
+@requires_auth
+def upstream_status():
+    """Circuit breaker state per upstream (as seen by the worker serving this request)"""
+    return jsonify({
+        'degraded': degraded_upstreams(),
+        'upstreams': {name: breaker.snapshot() for name, breaker in circuit_breakers.items()}
+    })
+
+
+# ============================================
+# UPSTREAM CALLS (MiniCRM, Gmail, OpenAI)
+# ============================================
+
+@contextmanager
+def upstream_call(upstream, check_latency=True):
+    """Time an upstream API call (Server-Timing + metrics) behind its circuit breaker; set call['error'] for failed responses
+
+    check_latency=False for blocks that are slow by design (e.g. polling an assistant run).
+    """
+    breaker = circuit_breakers[upstream]
+    try:
+        breaker.before_call()
+    except CircuitOpenError:
+        CIRCUIT_REJECTIONS.labels(upstream).inc()
+        raise
+    call = {'error': False}
+    start = time.perf_counter()
+    try:
+        with timed(upstream):
+            yield call
+    except DeadlineExceeded:
+        raise  # Our own budget ran out - says nothing about the upstream's health
+    except Exception as e:
+        call['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        UPSTREAM_REQUESTS.labels(upstream, 'error' if call['error'] else 'success').inc()
+        UPSTREAM_LATENCY.labels(upstream).observe(elapsed)
+        breaker.record(bool(call['error']), elapsed,
+                       error=call['error'] if isinstance(call['error'], str) else None,
+                       check_latency=check_latency)
+
+
+def minicrm_request(method, url, **kwargs):
+    """Call the MiniCRM R3 API with auth, recorded as the 'minicrm' upstream"""
+    kwargs.setdefault('timeout', 10)
+    deadline = current_deadline()
+    if deadline is not None:
+        kwargs['timeout'] = deadline.timeout(kwargs['timeout'])
+    with upstream_call('minicrm') as call:
+        response = requests.request(method, url, auth=(MINICRM_SYSTEM_ID, MINICRM_API_KEY), **kwargs)
+        if response.status_code >= 500 or response.status_code == 429:
+            call['error'] = f'HTTP {response.status_code}'
+        return response
+
+
+def gmail_credentials(token):
+    """OAuth credentials from a stored Gmail token dict (as kept in the session)"""
+    from google.oauth2.credentials import Credentials
+    return Credentials(
+        token=token['token'],
+        refresh_token=token.get('refresh_token'),
+        token_uri=token['token_uri'],
+        client_id=token['client_id'],
+        client_secret=token['client_secret'],
+        scopes=token['scopes']
+    )
+
+
+def stored_gmail_token(token):
+    """What bulk_store keeps of a Gmail token: refresh token and scopes only - the access token expires
+    within the hour and the client id/secret are read back from GMAIL_CREDENTIALS_PATH"""
+    return json.dumps({
+        'refresh_token': token.get('refresh_token'),
+        'token_uri': token['token_uri'],
+        'scopes': token['scopes']
+    })
+
+
+def stored_gmail_credentials(stored):
+    """OAuth credentials from a token kept in bulk_store (see stored_gmail_token); the access token is
+    fetched with the refresh token on first use"""
+    token = json.loads(stored)
+    if 'client_secret' not in token:
+        with open(GMAIL_CREDENTIALS_PATH) as f:
+            client = next(iter(json.load(f).values()))  # {"web": {...}} or {"installed": {...}}
+        token = dict(token, token=None, client_id=client['client_id'], client_secret=client['client_secret'])
+    return gmail_credentials(token)
+
+
+def build_gmail_service(build, creds):
+    """Gmail API client (build = googleapiclient.discovery.build, imported lazily by the caller)"""
+    client_options = {'api_endpoint': GMAIL_API_URL} if GMAIL_API_URL else None
+    return build('gmail', 'v1', credentials=creds, client_options=client_options)
+
+
+def gmail_execute(gmail_request):
+    """Execute a Gmail API request, recorded as the 'gmail' upstream"""
+    deadline = current_deadline()
+    if deadline is not None and deadline.expired():
+        raise DeadlineExceeded()
+    with upstream_call('gmail'):
+        return gmail_request.execute()
+
+
+# ============================================
+# REQUEST COALESCING (single flight)
+# ============================================
+
+SINGLE_FLIGHT_FILE_TTL = 300  # Seconds a shared result/lock file is kept before pruning
+SINGLE_FLIGHT_POLL_SECONDS = 0.05
+
+os.makedirs(SINGLE_FLIGHT_DIR, exist_ok=True)
+
+
+class Flight:
+    """An in-progress call that other threads of this worker can wait for"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+flights = {}
+flights_lock = threading.Lock()
+last_flight_prune = 0.0
+
+
+def reset_flights_after_fork():
+    """Flights belong to the thread that started them - none survive into a new worker"""
+    global flights, flights_lock
+    flights = {}
+    flights_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_flights_after_fork)
+
+
+def prune_single_flight_files():
+    """Remove stale lock/result files (at most once a minute per worker)"""
+    global last_flight_prune
+    now = time.time()
+    if now - last_flight_prune < 60:
+        return
+    last_flight_prune = now
+    # A lock file removed while another worker opens it only costs one duplicate fetch
+    for filename in os.listdir(SINGLE_FLIGHT_DIR):
+        path = os.path.join(SINGLE_FLIGHT_DIR, filename)
+        try:
+            if os.path.getmtime(path) < now - SINGLE_FLIGHT_FILE_TTL:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def fetch_across_workers(query, digest, fetch, shareable):
+    """Run fetch() holding a per-key file lock; share the result with workers that waited for it"""
+    if fcntl is None:
+        SINGLE_FLIGHT_CALLS.labels(query, 'leader').inc()
+        return fetch()
+    
+    lock_path = os.path.join(SINGLE_FLIGHT_DIR, digest + '.lock')
+    result_path = os.path.join(SINGLE_FLIGHT_DIR, digest + '.json')
+    started = time.time()
+    deadline = current_deadline()
+    
+    with open(lock_path, 'a') as lock_file:
+        # Poll instead of blocking so a waiting request still honours its deadline
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if deadline is not None and deadline.expired():
+                    raise DeadlineExceeded()
+                time.sleep(SINGLE_FLIGHT_POLL_SECONDS)
+        
+        try:
+            # Another worker finished the same call while we were waiting - use its result
+            try:
+                if os.path.getmtime(result_path) >= started:
+                    with open(result_path, 'r', encoding='utf-8') as f:
+                        result = json.load(f)
+                    SINGLE_FLIGHT_CALLS.labels(query, 'follower').inc()
+                    return result
+            except (OSError, ValueError):
+                pass
+            
+            SINGLE_FLIGHT_CALLS.labels(query, 'leader').inc()
+            result = fetch()
+            if shareable is not None and not shareable(result):
+                return result  # Waiting workers run their own call
+            
+            temp_path = f'{result_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(result, f)
+            os.replace(temp_path, result_path)
+            return result
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            prune_single_flight_files()
+
+
+def single_flight(key, fetch, shareable=None):
+    """Run fetch() once for identical concurrent calls (same key tuple, first item names the query)
+
+    Callers arriving while a call is in flight - in this worker or another one - get its result
+    instead of repeating the upstream work. fetch() must return JSON-serializable data and must not
+    depend on who is asking; apply per-user filtering to the shared result afterwards.
+    Results shareable(result) rejects (e.g. partial ones cut short by the leader's deadline) are
+    not handed to waiting callers - they run their own call instead.
+    """
+    query = key[0]
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:32]
+    
+    with flights_lock:
+        flight = flights.get(digest)
+        is_leader = flight is None
+        if is_leader:
+            flight = flights[digest] = Flight()
+    
+    if not is_leader:
+        deadline = current_deadline()
+        if not flight.done.wait(deadline.remaining() if deadline is not None else None):
+            raise DeadlineExceeded()
+        if flight.error is not None:
+            SINGLE_FLIGHT_CALLS.labels(query, 'follower').inc()
+            raise flight.error
+        if shareable is not None and not shareable(flight.result):
+            return single_flight(key, fetch, shareable)
+        SINGLE_FLIGHT_CALLS.labels(query, 'follower').inc()
+        return flight.result
+    
+    try:
+        flight.result = fetch_across_workers(query, digest, fetch, shareable)
+        return flight.result
+    except Exception as e:
+        flight.error = e
+        raise
+    finally:
+        with flights_lock:
+            flights.pop(digest, None)
+        flight.done.set()
+
+
+# ============================================
+# SHARED CACHE
+# ============================================
+
+class SharedCacheStore:
+    """SQLite (WAL) cache tier shared by all gunicorn workers on this machine, survives restarts"""
+    
+    EVICT_EVERY = 100  # Writes between expiry/size sweeps
+    TOUCH_AFTER = 60  # Seconds before a read refreshes accessed_at (keeps reads mostly read-only)
+    
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.reset()
+    
+    def reset(self):
+        self.conn = None
+        self.lock = threading.Lock()
+        self.writes = 0
+    
+    def connection(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, timeout=2, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute("""CREATE TABLE IF NOT EXISTS cache (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                expires_at REAL NOT NULL,
+                accessed_at REAL NOT NULL,
+                PRIMARY KEY (namespace, key)
+            )""")
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)')
+            self.conn = conn
+        return self.conn
+    
+    def get(self, namespace, key):
+        """Return (found, JSON text, expires_at)"""
+        now = time.time()
+        with self.lock:
+            conn = self.connection()
+            row = conn.execute('SELECT value, expires_at, accessed_at FROM cache WHERE namespace = ? AND key = ?',
+                               (namespace, key)).fetchone()
+            if row is None or row[1] <= now:
+                return False, None, 0
+            if now - row[2] > self.TOUCH_AFTER:
+                conn.execute('UPDATE cache SET accessed_at = ? WHERE namespace = ? AND key = ?', (now, namespace, key))
+            return True, row[0], row[1]
+    
+    def set(self, namespace, key, value, expires_at):
+        now = time.time()
+        with self.lock:
+            conn = self.connection()
+            conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?)',
+                         (namespace, key, value, len(value), expires_at, now))
+            self.writes += 1
+            if self.writes % self.EVICT_EVERY == 0:
+                self.evict(conn, now)
+    
+    def delete(self, namespace, key=None):
+        with self.lock:
+            if key is None:
+                self.connection().execute('DELETE FROM cache WHERE namespace = ?', (namespace,))
+            else:
+                self.connection().execute('DELETE FROM cache WHERE namespace = ? AND key = ?', (namespace, key))
+    
+    def evict(self, conn, now):
+        """Drop expired entries, then least recently used ones until the store is under 90% of its bound"""
+        conn.execute('DELETE FROM cache WHERE expires_at <= ?', (now,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        target = total - int(self.max_bytes * 0.9)
+        freed = 0
+        doomed = []
+        for namespace, key, size in conn.execute('SELECT namespace, key, size FROM cache ORDER BY accessed_at'):
+            doomed.append((namespace, key))
+            freed += size
+            if freed >= target:
+                break
+        conn.executemany('DELETE FROM cache WHERE namespace = ? AND key = ?', doomed)
+        logger.info("Cache: evicted %d entries (%d KB) to stay under %d KB",
+                    len(doomed), freed // 1024, self.max_bytes // 1024)
+    
+    def stats(self):
+        """Entries and bytes per namespace (live entries only)"""
+        with self.lock:
+            rows = self.connection().execute(
+                'SELECT namespace, COUNT(*), COALESCE(SUM(size), 0) FROM cache WHERE expires_at > ? GROUP BY namespace',
+                (time.time(),)).fetchall()
+        return {namespace: {'entries': count, 'bytes': size} for namespace, count, size in rows}
+
+
+shared_cache_store = SharedCacheStore(CACHE_DB_PATH, int(CACHE_MAX_MB * 1024 * 1024))
+
+
+class Cache:
+    """Namespaced two-tier cache: per-worker LRU, then the shared SQLite store
+
+    Values must be JSON-serializable; treat returned values as read-only (the memory tier
+    hands out the same object to every caller). The cache never raises - a broken shared
+    store just means misses.
+    """
+    
+    def __init__(self, namespace, default_ttl):
+        self.namespace = namespace
+        self.default_ttl = default_ttl
+        self.reset()
+    
+    def reset(self):
+        self.memory = OrderedDict()  # key -> (memory expiry, value)
+        self.lock = threading.Lock()
+        self.counts = {'memory_hits': 0, 'shared_hits': 0, 'misses': 0, 'sets': 0, 'errors': 0}
+    
+    @staticmethod
+    def make_key(key):
+        return key if isinstance(key, str) else json.dumps(key, sort_keys=True, default=str)
+    
+    def remember(self, key, value, expires_at):
+        """Store in the memory tier, evicting the least recently used entry when full"""
+        with self.lock:
+            self.memory[key] = (min(expires_at, time.time() + CACHE_MEMORY_MAX_AGE), value)
+            self.memory.move_to_end(key)
+            while len(self.memory) > CACHE_MEMORY_ITEMS:
+                self.memory.popitem(last=False)
+    
+    def get(self, key, default=None):
+        key = self.make_key(key)
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry[0] > time.time():
+                    self.memory.move_to_end(key)
+                    self.counts['memory_hits'] += 1
+                    record_cache_lookup(self.namespace, True)
+                    return entry[1]
+                del self.memory[key]
+        
+        try:
+            found, text, expires_at = shared_cache_store.get(self.namespace, key)
+        except sqlite3.Error as e:
+            logger.warning("Cache %s: shared store read failed: %s", self.namespace, e)
+            self.counts['errors'] += 1
+            found = False
+        
+        record_cache_lookup(self.namespace, found)
+        if not found:
+            self.counts['misses'] += 1
+            return default
+        value = json.loads(text)
+        self.counts['shared_hits'] += 1
+        self.remember(key, value, expires_at)
+        return value
+    
+    def set(self, key, value, ttl=None):
+        key = self.make_key(key)
+        expires_at = time.time() + (ttl if ttl is not None else self.default_ttl)
+        self.remember(key, value, expires_at)
+        self.counts['sets'] += 1
+        try:
+            shared_cache_store.set(self.namespace, key, json.dumps(value), expires_at)
+        except sqlite3.Error as e:
+            logger.warning("Cache %s: shared store write failed: %s", self.namespace, e)
+            self.counts['errors'] += 1
+    
+    def delete(self, key):
+        key = self.make_key(key)
+        with self.lock:
+            self.memory.pop(key, None)
+        try:
+            shared_cache_store.delete(self.namespace, key)
+        except sqlite3.Error as e:
+            logger.warning("Cache %s: shared store delete failed: %s", self.namespace, e)
+    
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        try:
+            shared_cache_store.delete(self.namespace)
+        except sqlite3.Error as e:
+            logger.warning("Cache %s: shared store clear failed: %s", self.namespace, e)
+    
+    def get_or_fetch(self, key, fetch, ttl=None, cache_if=None):
+        """Cached value for key, or fetch() it once (coalesced across workers) and cache it
+
+        key is a tuple whose first item names the query; cache_if(value) can veto caching (e.g. errors).
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        
+        def fetch_and_store():
+            value = fetch()
+            if cache_if is None or cache_if(value):
+                self.set(key, value, ttl)
+            return value
+        
+        return single_flight(key, fetch_and_store)
+    
+    def stats(self):
+        lookups = self.counts['memory_hits'] + self.counts['shared_hits'] + self.counts['misses']
+        hits = self.counts['memory_hits'] + self.counts['shared_hits']
+        return dict(self.counts, memory_entries=len(self.memory),
+                    hit_ratio=round(hits / lookups, 3) if lookups else None)
+
+
+# One namespace per subsystem - TTL is the default, callers may pass their own
+CACHES = {
+    'minicrm': Cache('minicrm', default_ttl=300),
+    'gmail': Cache('gmail', default_ttl=86400),
+    'openai': Cache('openai', default_ttl=3600),
+}
+
+
+def reset_caches_after_fork():
+    """SQLite connections and locks must not be shared with the parent process"""
+    shared_cache_store.reset()
+    for cache in CACHES.values():
+        cache.reset()
+
+
+os.register_at_fork(after_in_child=reset_caches_after_fork)
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+@requires_auth
+def cache_stats():
+    """Hit/miss counters of this worker per namespace, plus shared store size"""
+    try:
+        shared = shared_cache_store.stats()
+    except sqlite3.Error as e:
+        shared = {'error': str(e)}
+    return jsonify({
+        'worker': {name: cache.stats() for name, cache in CACHES.items()},
+        'shared': shared,
+        'shared_max_mb': CACHE_MAX_MB
+    })
+
+
+@app.route('/api/cache/clear', methods=['POST'])
+@requires_auth
+def cache_clear():
+    """Clear one namespace (or all) - other workers drop their memory copies within CACHE_MEMORY_MAX_AGE"""
+    namespace = (request.get_json(silent=True) or {}).get('namespace')
+    if namespace is not None and namespace not in CACHES:
+        return jsonify({'error': f'Unknown cache namespace: {namespace}'}), 400
+    for name, cache in CACHES.items():
+        if namespace in (None, name):
+            cache.clear()
+    return jsonify({'success': True, 'cleared': namespace or 'all'})
+
+
+# ============================================
+# RESPONSE COMPRESSION
+# ============================================
+
+def choose_content_encoding():
+    """Pick the best response encoding the client accepts (br > gzip), or None"""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted.quality('br') > 0:
+        return 'br'
+    if accepted.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def compress_bytes(data, encoding):
+    """Compress a complete response body with the given encoding"""
+    if encoding == 'br':
+        return brotli.compress(data, quality=COMPRESSION_BROTLI_QUALITY)
+    compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)  # 31 = gzip container
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(chunks, encoding):
+    """Compress a streamed response chunk by chunk, flushing so the client sees data immediately"""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+        for chunk in chunks:
+            data = compressor.process(chunk) + compressor.flush()
+            if data:
+                yield data
+        yield compressor.finish()
+    else:
+        compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+
+
+@app.after_request
+def compress_response(response):
+    """Negotiate gzip/Brotli compression for JSON responses above the size threshold"""
+    if (response.mimetype not in COMPRESSIBLE_MIMETYPES
+            or response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers):
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    
+    encoding = choose_content_encoding()
+    if not encoding:
+        return response
+    
+    if response.is_streamed:
+        # Size is unknown up front - always compress streamed JSON
+        response.response = compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        with timed('compress'):
+            response.set_data(compress_bytes(data, encoding))
+    
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+# ============================================
+# STATIC ASSETS
+# ============================================
+
+def load_asset_manifest():
+    """Load the source -> hashed filename manifest written by build_assets.py"""
+    if not IS_PRODUCTION or not os.path.exists(ASSET_MANIFEST_PATH):
+        return {}
+    try:
+        with open(ASSET_MANIFEST_PATH, 'r') as f:
+            manifest = json.load(f)
+        logger.info("Static asset manifest loaded (%d assets)", len(manifest))
+        return manifest
+    except Exception as e:
+        logger.warning("Could not load asset manifest: %s", e)
+        return {}
+
+
+ASSET_MANIFEST = load_asset_manifest()
+
+
+@app.template_global()
+def asset_url(path):
+    """URL for a static asset - hashed build output if available, else the source file"""
+    if path in ASSET_MANIFEST:
+        return url_for('static', filename=ASSET_MANIFEST[path])
+    # No build output: bust caches with the file's modification time
+    try:
+        version = int(os.path.getmtime(os.path.join(app.static_folder, path)))
+    except OSError:
+        return url_for('static', filename=path)
+    return url_for('static', filename=path, v=version)
+
+
+@app.route('/static/dist/<path:filename>')
+def static_dist(filename):
+    """Serve hashed build output, preferring precompressed .br/.gz variants"""
+    dist_folder = os.path.join(app.static_folder, 'dist')
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    
+    accepted = request.accept_encodings
+    encoding = None
+    for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if accepted.quality(candidate) > 0 and os.path.isfile(os.path.join(dist_folder, filename + suffix)):
+            encoding = candidate
+            filename += suffix
+            break
+    
+    response = send_from_directory(dist_folder, filename, mimetype=mimetype, max_age=ASSET_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+
+@app.route('/')
+@requires_auth
+def index():
+    """Main page"""
+    has_openai = openai_available()
+    has_gmail = os.path.exists(GMAIL_CREDENTIALS_PATH)
+    
+    # Get username from auth if available
+    username = None
+    if request.authorization:
+        username = request.authorization.username
+    
+    with timed('render'):
+        return render_template('index.html', 
+                             assistants=ASSISTANTS,
+                             has_openai=has_openai,
+                             has_gmail=has_gmail,
+                             username=username)
+
+
+@app.route('/api/send_message', methods=['POST'])
+@requires_auth
+def send_message():
+    """Send a message to the AI assistant"""
+    try:
+        # Check if OpenAI is configured
+        client = get_openai_client()
+        if not client:
+            return jsonify({
+                'error': 'OpenAI API is not configured. Please set up your API key in the Settings.'
             }), 400
         
-        from google_auth_oauthlib.flow import Flow
+        data = request.json
+        message = data.get('message', '').strip()
+        assistant_name = data.get('assistant', 'Marketing Expert')
+        session_id = data.get('session_id')
+        run_id = data.get('run_id')  # Resume a run that outlived the previous request's deadline
+        
+        if not message and not run_id:
+            return jsonify({'error': 'Message is required'}), 400
+        
+        # Thread of this conversation (shared by all workers through the transcript store)
+        conv, error = owned_conversation(session_id)
+        if error:
+            return error
+        
+        if run_id:
+            if conv is None:
+                return jsonify({'error': 'Conversation expired. Please send your message again.'}), 400
+            with upstream_call('openai'):
+                run = client.beta.threads.runs.retrieve(
+                    thread_id=conv['thread_id'],
+                    run_id=run_id
+                )
+        else:
+            # New conversation: take a pre-created thread, or create one
+            if conv is None:
+                thread_id = prewarmed_threads.take()
+                if thread_id is None:
+                    with upstream_call('openai'):
+                        thread_id = client.beta.threads.create().id
+                transcripts.start(session_id, thread_id, assistant_name, chat_owner())
+                conv = transcripts.conversation(session_id)
+            
+            # Add user message
+            with upstream_call('openai'):
+                user_message = client.beta.threads.messages.create(
+                    thread_id=conv['thread_id'],
+                    role="user",
+                    content=message
+                )
+            transcripts.append(session_id, [transcript_entry(user_message)], assistant_name)
+            
+            # Get assistant
+            assistant_id = ASSISTANTS[assistant_name]['id']
+            
+            # Run assistant
+            with upstream_call('openai'):
+                run = client.beta.threads.runs.create(
+                    thread_id=conv['thread_id'],
+                    assistant_id=assistant_id
+                )
+        
+        # Wait for completion (polling time counts as OpenAI time)
+        deadline = current_deadline()
+        with upstream_call('openai', check_latency=False):
+            while run.status in ['queued', 'in_progress'] and not deadline.expired():
+                time.sleep(0.5)
+                run = client.beta.threads.runs.retrieve(
+                    thread_id=conv['thread_id'],
+                    run_id=run.id
+                )
+        
+        if run.status in ['queued', 'in_progress']:
+            # Out of time - the run continues on OpenAI's side, the client resumes with run_id
+            return jsonify({
+                'complete': False,
+                'run_id': run.id,
+                'status': run.status,
+                'assistant': assistant_name
+            }), 202
+        
+        if run.status == 'completed':
+            # Only the messages after the newest stored one (the run's reply) are fetched
+            last_message_id = transcripts.conversation(session_id)['last_message_id']
+            new_messages = [transcript_entry(m) for m in
+                            thread_messages_after(client, conv['thread_id'], last_message_id)]
+            transcripts.append(session_id, new_messages, assistant_name)
+            
+            # The run's reply - or the newest assistant message if the API didn't tag it with the run
+            response_text = transcripts.run_reply(session_id, run.id)
+            if response_text is None:
+                replies = [m['content'] for m in new_messages if m['role'] == 'assistant']
+                response_text = replies[-1] if replies else None
+            if response_text is not None:
+                return jsonify({
+                    'complete': True,
+                    'response': response_text,
+                    'assistant': assistant_name,
+                    'timestamp': datetime.now().isoformat()
+                })
+        
+        return jsonify({'error': 'Failed to get response'}), 500
+    
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/clear_conversation', methods=['POST'])
+@requires_auth
+def clear_conversation():
+    """Clear conversation history"""
+    try:
+        data = request.json
+        session_id = data.get('session_id')
+        
+        conv, error = owned_conversation(session_id)
+        if error:
+            return error
+        if conv is not None:
+            transcripts.delete(session_id)
+        
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/check_config', methods=['GET'])
+def check_config():
+    """Check if APIs are configured"""
+    return jsonify({
+        'hasOpenAI': openai_available(),
+        'hasGmail': os.path.exists(GMAIL_CREDENTIALS_PATH)
+    })
+
+
+@app.route('/api/gmail_status', methods=['GET'])
+def gmail_status():
+    """Check Gmail connection status"""
+    gmail_token = session.get('gmail_token')
+    user_email = session.get('gmail_user_email')
+    
+    return jsonify({
+        'connected': gmail_token is not None,
+        'email': user_email if gmail_token else None
+    })
+
+
+@app.route('/api/gmail_disconnect', methods=['POST'])
+def gmail_disconnect():
+    """Disconnect Gmail"""
+    session.pop('gmail_token', None)
+    session.pop('gmail_user_email', None)
+    session.pop('gmail_oauth_state', None)
+    
+    return jsonify({
+        'success': True
+    })
+
+
+@app.route('/api/save_config', methods=['POST'])
+def save_config():
+    """Save API configuration"""
+    try:
+        data = request.json
+        
+        config = {}
+        if os.path.exists(CONFIG_FILE):
+            with open(CONFIG_FILE, 'r') as f:
+                config = json.load(f)
+        
+        # Update config
+        if 'openai_api_key' in data:
+            config['openai_api_key'] = data['openai_api_key']
+        
+        if 'gmail_credentials' in data:
+            # Save Gmail credentials to file
+            with open(GMAIL_CREDENTIALS_PATH, 'w') as f:
+                json.dump(data['gmail_credentials'], f, indent=2)
+        
+        # Save config
+        with open(CONFIG_FILE, 'w') as f:
+            json.dump(config, f, indent=2)
+        
+        return jsonify({
+            'success': True,
+            'message': 'Configuration saved! Please restart the application for changes to take effect.'
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# Precompiled patterns for Gmail body extraction (compiled once, reused per message)
+# One alternation strips style/script/head blocks, comments and tags in a single pass
+HTML_STRIP_RE = re.compile(
+    r'<(style|script|head)\b[^>]*>.*?</\1\s*>|<!--.*?-->|<[^>]+>',
+    re.DOTALL | re.IGNORECASE
+)
+HTML_DETECT_RE = re.compile(r'<(?:html|!doctype)', re.IGNORECASE)
+WHITESPACE_RE = re.compile(r'\s+')
+CHARSET_RE = re.compile(r'charset\s*=\s*["\']?([\w.:-]+)', re.IGNORECASE)
+
+
+def html_to_text(html):
+    """Convert an HTML document to a single line of plain text"""
+    text = HTML_STRIP_RE.sub(' ', html)
+    # Full entity decoding (named, decimal and hex references)
+    text = html_lib.unescape(text)
+    return WHITESPACE_RE.sub(' ', text)
+
+
+def get_part_charset(part):
+    """Get the charset declared in a MIME part's Content-Type header (default: utf-8)"""
+    for header in part.get('headers', ()):
+        if header.get('name', '').lower() == 'content-type':
+            match = CHARSET_RE.search(header.get('value', ''))
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    break
+            break
+    return 'utf-8'
+
+
+def decode_part_body(part):
+    """Decode the base64url body data of a MIME part using its declared charset"""
+    data = part.get('body', {}).get('data')
+    if not data:
+        return ''
+    raw = base64.urlsafe_b64decode(data)
+    return raw.decode(get_part_charset(part), errors='replace')
+
+
+def extract_message_body(payload):
+    """Extract text body from Gmail message payload"""
+    # Walk the MIME tree in document order; the first text/plain part wins,
+    # otherwise fall back to the first text/html part found anywhere
+    plain_part = None
+    html_part = None
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if 'parts' in part:
+            stack.extend(reversed(part['parts']))
+            continue
+        mime_type = part.get('mimeType', '')
+        if mime_type == 'text/plain' and part.get('body', {}).get('data'):
+            plain_part = part
+            break
+        if mime_type == 'text/html' and html_part is None and part.get('body', {}).get('data'):
+            html_part = part
+    
+    if plain_part is not None:
+        body = decode_part_body(plain_part)
+        # Some senders put HTML documents into text/plain parts
+        if HTML_DETECT_RE.search(body):
+            body = html_to_text(body)
+    elif html_part is not None:
+        body = html_to_text(decode_part_body(html_part))
+    elif 'parts' not in payload:
+        # Single-part message with an unusual mimeType
+        body = decode_part_body(payload)
+        if HTML_DETECT_RE.search(body):
+            body = html_to_text(body)
+    else:
+        body = ''
+    
+    return body.strip()
+
+
+@app.route('/api/gmail_auth_url', methods=['GET'])
+def gmail_auth_url():
+    """Generate Gmail OAuth URL for user authorization"""
+    try:
+        if not os.path.exists(GMAIL_CREDENTIALS_PATH):
+            return jsonify({
+                'error': 'Gmail API is not configured.',
+                'needs_setup': True
+            }), 400
+        
+        from google_auth_oauthlib.flow import Flow
+        
+        SCOPES = [
+            'https://www.googleapis.com/auth/gmail.readonly',
+            'https://www.googleapis.com/auth/gmail.send'
+        ]
+        
+        # Allow insecure transport for local development
+        if not IS_PRODUCTION:
+            os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+        
+        # Create flow
+        flow = Flow.from_client_secrets_file(
+            GMAIL_CREDENTIALS_PATH,
+            scopes=SCOPES,
+            redirect_uri=request.host_url.rstrip('/') + '/api/gmail_callback'
+        )
+        
+        authorization_url, state = flow.authorization_url(
+            access_type='offline',
+            include_granted_scopes='true',
+            prompt='consent'
+        )
+        
+        # Store state in session
+        session['gmail_oauth_state'] = state
+        
+        return jsonify({
+            'auth_url': authorization_url
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/gmail_callback')
+def gmail_callback():
+    """Handle Gmail OAuth callback"""
+    try:
+        from google_auth_oauthlib.flow import Flow
+        from google.oauth2.credentials import Credentials
+        
+        SCOPES = [
+            'https://www.googleapis.com/auth/gmail.readonly',
+            'https://www.googleapis.com/auth/gmail.send'
+        ]
+        
+        # Verify state
+        state = session.get('gmail_oauth_state')
+        if not state:
+            return '<h1>Error: Invalid state</h1><p>Please try again.</p>', 400
+        
+        # Allow insecure transport for local development
+        if not IS_PRODUCTION:
+            os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+        
+        # Create flow with same redirect URI
+        flow = Flow.from_client_secrets_file(
+            GMAIL_CREDENTIALS_PATH,
+            scopes=SCOPES,
+            state=state,
+            redirect_uri=request.host_url.rstrip('/') + '/api/gmail_callback'
+        )
+        
+        # Fetch token
+        flow.fetch_token(authorization_response=request.url)
+        
+        # Get credentials
+        creds = flow.credentials
+        
+        # Get user email from Google
+        try:
+            from googleapiclient.discovery import build
+            service = build_gmail_service(build, creds)
+            profile = gmail_execute(service.users().getProfile(userId='me'))
+            user_email = profile.get('emailAddress', 'Unknown')
+        except:
+            user_email = 'Connected'
+        
+        # Save token for this user session
+        session['gmail_token'] = {
+            'token': creds.token,
+            'refresh_token': creds.refresh_token,
+            'token_uri': creds.token_uri,
+            'client_id': creds.client_id,
+            'client_secret': creds.client_secret,
+            'scopes': creds.scopes
+        }
+        
+        # Save user email
+        session['gmail_user_email'] = user_email
+        
+        # Return success page
+        return '''
+        <html>
+        <head>
+            <title>Gmail Connected!</title>
+            <style>
+                body {
+                    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
+                    display: flex;
+                    justify-content: center;
+                    align-items: center;
+                    height: 100vh;
+                    margin: 0;
+                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                }
+                .container {
+                    background: white;
+                    padding: 48px;
+                    border-radius: 16px;
+                    box-shadow: 0 20px 60px rgba(0,0,0,0.3);
+                    text-align: center;
+                    max-width: 400px;
+                }
+                h1 { color: #27ae60; margin-bottom: 16px; }
+                p { color: #666; margin-bottom: 24px; line-height: 1.6; }
+                button {
+                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                    color: white;
+                    border: none;
+                    padding: 12px 32px;
+                    border-radius: 8px;
+                    font-size: 16px;
+                    font-weight: 600;
+                    cursor: pointer;
+                }
+                button:hover { opacity: 0.9; }
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <h1>✅ Gmail Connected!</h1>
+                <p>Your Gmail account has been successfully connected. You can now load email history.</p>
+                <button onclick="window.close()">Close Window</button>
+                <script>
+                    setTimeout(() => {
+                        window.close();
+                        if (!window.closed) {
+                            window.location.href = '/';
+                        }
+                    }, 3000);
+                </script>
+            </div>
+        </body>
+        </html>
+        '''
+        
+    except Exception as e:
+        return f'<h1>Error</h1><p>{str(e)}</p>', 500
+
+
+def summarize_message(message_id, msg_data):
+    """Turn a Gmail API message (format='full') into the dict the UI shows"""
+    from email.utils import parsedate_to_datetime
+    
+    headers = msg_data['payload']['headers']
+    subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
+    from_email = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
+    date_str = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
+    
+    # Parse date
+    try:
+        date_obj = parsedate_to_datetime(date_str) if date_str else datetime.now()
+        formatted_date = date_obj.strftime('%Y-%m-%d %H:%M')
+    except:
+        formatted_date = date_str or 'Unknown date'
+    
+    # Extract full body
+    with timed('parse'):
+        body = extract_message_body(msg_data['payload'])
+    
+    # Determine direction
+    is_from_me = any(x in from_email.lower() for x in ["ince@prv.hu", "czechner ince", "czechner"])
+    direction = "KÜLDTEM (Czechner Ince)" if is_from_me else "KAPTAM"
+    
+    return {
+        'id': message_id,
+        'subject': subject,
+        'from': from_email,
+        'date': formatted_date,
+        'body': body,  # Full body, not truncated
+        'direction': direction
+    }
+
+
+@app.route('/api/load_emails', methods=['POST'])
+def load_emails():
+    """Load email history from Gmail"""
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Invalid request'}), 400
+            
+        email_address = data.get('email', '').strip()
+        
+        if not email_address:
+            return jsonify({'error': 'Email address is required'}), 400
+        
+        # Check if user has authorized Gmail
+        gmail_token = session.get('gmail_token')
+        if not gmail_token:
+            return jsonify({
+                'error': 'Gmail not authorized. Please connect your Gmail account first.',
+                'needs_auth': True
+            }), 401
+        
+        # Check if Gmail API is available
+        try:
+            from google.auth.transport.requests import Request
+            from google.oauth2.credentials import Credentials
+            from googleapiclient.discovery import build
+        except ImportError as e:
+            return jsonify({'error': f'Gmail API libraries not installed: {str(e)}'}), 400
+        
+        # Create credentials from session
+        creds = Credentials(
+            token=gmail_token['token'],
+            refresh_token=gmail_token.get('refresh_token'),
+            token_uri=gmail_token['token_uri'],
+            client_id=gmail_token['client_id'],
+            client_secret=gmail_token['client_secret'],
+            scopes=gmail_token['scopes']
+        )
+        
+        # Refresh if expired
+        if creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+                # Update session with new token
+                session['gmail_token']['token'] = creds.token
+            except Exception as e:
+                return jsonify({
+                    'error': 'Gmail token expired. Please reconnect your Gmail account.',
+                    'needs_auth': True
+                }), 401
+        
+        service = build_gmail_service(build, creds)
+        
+        # Search for emails
+        query = f'from:{email_address} OR to:{email_address}'
+        results = gmail_execute(service.users().messages().list(userId='me', q=query, maxResults=20))
+        messages = results.get('messages', [])
+        
+        email_list = []
+        deadline = current_deadline()
+        complete = True
+        gmail_cache = CACHES['gmail']
+        mailbox = session.get('gmail_user_email')  # Message IDs are only unique per mailbox
+        for msg in messages:
+            if deadline.expired():
+                complete = False  # Return the emails loaded so far
+                break
+            
+            # Messages never change - a cached parse skips both the Gmail call and body extraction
+            cache_key = ('message', mailbox, msg['id'])
+            email_entry = gmail_cache.get(cache_key) if mailbox else None
+            if email_entry is None:
+                try:
+                    msg_data = gmail_execute(service.users().messages().get(userId='me', id=msg['id'], format='full'))
+                except CircuitOpenError:
+                    complete = False  # Gmail is failing - return what we have instead of an error
+                    break
+                email_entry = summarize_message(msg['id'], msg_data)
+                if mailbox:
+                    gmail_cache.set(cache_key, email_entry)
+            
+            email_list.append(email_entry)
+        
+        return jsonify({
+            'success': True,
+            'email': email_address,
+            'count': len(email_list),
+            'emails': email_list,
+            'complete': complete,
+            'degraded': degraded_upstreams()
+        })
+    
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.exception("Error in load_emails: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+def allowed_file(filename):
+    """Check if file extension is allowed"""
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+# Header names (lowercased) recognized for each contact field, best first
+CONTACT_COLUMN_ALIASES = {
+    'company': ['company', 'company name', 'company_name', 'ceg', 'cég', 'cégnév'],
+    'person': ['person', 'person name', 'person_name', 'name', 'contact', 'nev', 'név', 'kapcsolattarto', 'kapcsolattartó'],
+    'email': ['email', 'e-mail', 'email address', 'email_address', 'mail'],
+}
+UPLOAD_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def cell_text(value):
+    """Spreadsheet cell as stripped text ('' for empty cells)"""
+    return '' if value is None else str(value).strip()
+
+
+def looks_like_email(value):
+    """Basic email validation (same rule the contact parser uses)"""
+    return '@' in value and '.' in value
+
+
+def propose_column_mapping(header, rows):
+    """Field -> column index for a header row; an unnamed email column is found by its values"""
+    names = [cell_text(name).lower() for name in header]
+    mapping = {}
+    for field, aliases in CONTACT_COLUMN_ALIASES.items():
+        for alias in aliases:
+            if alias in names:
+                mapping[field] = names.index(alias)
+                break
+    if 'email' not in mapping and rows:
+        hits = [sum(looks_like_email(cell_text(row[i]) if i < len(row) else '') for row in rows)
+                for i in range(len(names))]
+        if hits and max(hits) * 2 > len(rows):
+            mapping['email'] = hits.index(max(hits))
+    return mapping
+
+
+def sniff_sheet(name, rows):
+    """Find the header row among a sheet's first rows and propose a column mapping
+    
+    The header is the row naming the most contact fields (title rows above it are skipped);
+    without one, the first non-empty row. header_row is -1 when the data starts right away."""
+    rows = [list(row) for row in rows]
+    best = None
+    for index, row in enumerate(rows):
+        if not any(cell_text(value) for value in row):
+            continue
+        mapping = propose_column_mapping(row, rows[index + 1:])
+        if best is None or len(mapping) > len(best[1]):
+            best = (index, mapping)
+    header_row, mapping = best or (0, {})
+    header = rows[header_row] if rows else []
+    if 'email' in mapping and looks_like_email(cell_text(header[mapping['email']])):
+        header_row, header = header_row - 1, []  # No header - the "header" is the first contact
+    width = max((len(row) for row in rows), default=0)
+    return {
+        'name': name,
+        'header_row': header_row,
+        'columns': [cell_text(header[i]) if i < len(header) else '' for i in range(width)],
+        'mapping': mapping,
+        'preview': [[cell_text(value) for value in row] for row in rows[header_row + 1:header_row + 6]],
+    }
+
+
+def upload_path(upload_id):
+    """Saved file of a sniffed upload, or None if it is unknown or expired"""
+    if not upload_id or not UPLOAD_ID_RE.match(upload_id):
+        return None
+    for extension in ALLOWED_EXTENSIONS:
+        path = os.path.join(app.config['UPLOAD_FOLDER'], f'{upload_id}.{extension}')
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def prune_uploads():
+    """Delete sniffed uploads nobody confirmed within UPLOAD_TTL_SECONDS"""
+    cutoff = time.time() - UPLOAD_TTL_SECONDS
+    for name in os.listdir(app.config['UPLOAD_FOLDER']):
+        path = os.path.join(app.config['UPLOAD_FOLDER'], name)
+        if UPLOAD_ID_RE.match(name.rsplit('.', 1)[0]):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass  # Another worker got there first
+
+
+def sniff_upload(path):
+    """Sheet names plus header, proposed mapping and preview of every sheet - reads only the first rows"""
+    with timed('sniff'):
+        if path.endswith('.csv'):
+            with open(path, newline='', encoding='utf-8-sig') as f:
+                return [sniff_sheet('CSV', itertools.islice(csv.reader(f), UPLOAD_SNIFF_ROWS))]
+        if path.endswith('.xls'):
+            import pandas as pd
+            frames = pd.read_excel(path, sheet_name=None, header=None, nrows=UPLOAD_SNIFF_ROWS, dtype=str)
+            return [sniff_sheet(name, df.where(df.notna(), None).values.tolist()) for name, df in frames.items()]
+        from openpyxl import load_workbook
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        try:
+            return [sniff_sheet(sheet.title, sheet.iter_rows(max_row=UPLOAD_SNIFF_ROWS, values_only=True))
+                    for sheet in workbook.worksheets]
+        finally:
+            workbook.close()
+
+
+def suggested_sheet(sheets):
+    """Index of the sheet most likely to hold the contacts (None if no sheet has an email column)"""
+    candidates = [i for i, sheet in enumerate(sheets) if 'email' in sheet['mapping']]
+    return max(candidates, key=lambda i: len(sheets[i]['mapping'])) if candidates else None
+
+
+def parse_contacts(path, sheet_name, header_row, mapping):
+    """Contacts from the chosen sheet, reading only the mapped columns below the header row"""
+    fields = list(CONTACT_COLUMN_ALIASES)
+    indexes = [mapping[field] for field in fields]
+    with timed('parse'):
+        if path.endswith('.xlsx'):
+            from openpyxl import load_workbook
+            workbook = load_workbook(path, read_only=True, data_only=True)
+            try:
+                first = min(indexes)
+                rows = [[row[i - first] if i - first < len(row) else None for i in indexes]
+                        for row in workbook[sheet_name].iter_rows(min_row=header_row + 2, min_col=first + 1,
+                                                                  max_col=max(indexes) + 1, values_only=True)]
+            finally:
+                workbook.close()
+        else:
+            import pandas as pd
+            columns = sorted(set(indexes))
+            options = dict(header=None, skiprows=header_row + 1, usecols=columns, dtype=str, keep_default_na=False)
+            if path.endswith('.csv'):
+                df = pd.read_csv(path, encoding='utf-8-sig', **options)
+            else:
+                df = pd.read_excel(path, sheet_name=sheet_name, **options)
+            rows = df[indexes].values.tolist() if len(df) else []
+    
+    contacts = []
+    for row in rows:
+        contact = {field: cell_text(value) for field, value in zip(fields, row)}
+        if contact['email'] and looks_like_email(contact['email']):
+            contacts.append(contact)
+    return contacts
+
+
+@app.route('/api/upload_excel/sniff', methods=['POST'])
+@requires_auth
+def sniff_excel():
+    """Save an uploaded contact list and propose a sheet and column mapping from its first rows
+    
+    The file is kept (upload_id) until the user confirms the choice with /api/upload_excel."""
+    try:
+        file = request.files.get('file')
+        if file is None or file.filename == '':
+            return jsonify({'error': 'No file provided'}), 400
+        if not allowed_file(file.filename):
+            return jsonify({'error': 'Invalid file type. Please upload .xlsx, .xls, or .csv file'}), 400
+        
+        prune_uploads()
+        upload_id = uuid.uuid4().hex
+        extension = file.filename.rsplit('.', 1)[1].lower()
+        path = os.path.join(app.config['UPLOAD_FOLDER'], f'{upload_id}.{extension}')
+        file.save(path)
+        try:
+            sheets = sniff_upload(path)
+        except Exception as e:
+            os.remove(path)
+            return jsonify({'error': f'Failed to parse file: {str(e)}'}), 400
+        
+        return jsonify({
+            'upload_id': upload_id,
+            'filename': file.filename,
+            'fields': list(CONTACT_COLUMN_ALIASES),
+            'sheets': sheets,
+            'suggested_sheet': suggested_sheet(sheets)
+        })
+    except Exception as e:
+        logger.exception("Error in sniff_excel: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/upload_excel', methods=['POST'])
+def upload_excel():
+    """Parse a contact list into the session
+    
+    JSON {upload_id, sheet, header_row, mapping} parses a sniffed upload with the confirmed sheet
+    and columns (header_row: 0-based, -1 = no header); a multipart file is sniffed and parsed in
+    one go with the proposed ones."""
+    try:
+        if 'file' in request.files:
+            file = request.files['file']
+            if file.filename == '':
+                return jsonify({'error': 'No file selected'}), 400
+            if not allowed_file(file.filename):
+                return jsonify({'error': 'Invalid file type. Please upload .xlsx, .xls, or .csv file'}), 400
+            extension = file.filename.rsplit('.', 1)[1].lower()
+            path = os.path.join(app.config['UPLOAD_FOLDER'], f'{uuid.uuid4().hex}.{extension}')
+            file.save(path)
+            try:
+                sheets = sniff_upload(path)
+            except Exception as e:
+                os.remove(path)
+                return jsonify({'error': f'Failed to parse file: {str(e)}'}), 400
+            index = suggested_sheet(sheets)
+            sheet = sheets[index if index is not None else 0]
+            choice = {'sheet': sheet['name'], 'header_row': sheet['header_row'], 'mapping': sheet['mapping']}
+        else:
+            choice = request.get_json(silent=True) or {}
+            path = upload_path(choice.get('upload_id'))
+            if path is None:
+                return jsonify({'error': 'Upload not found or expired - please upload the file again'}), 404
+            try:
+                sheets = sniff_upload(path)
+            except Exception as e:
+                return jsonify({'error': f'Failed to parse file: {str(e)}'}), 400
+            sheet = next((s for s in sheets if s['name'] == choice.get('sheet')), None)
+            if sheet is None:
+                return jsonify({'error': f"Unknown sheet: {choice.get('sheet')}"}), 400
+        
+        # Validate the column choice against the sheet
+        try:
+            header_row = int(choice.get('header_row', 0))
+            mapping = {field: int(column) for field, column in (choice.get('mapping') or {}).items()
+                       if field in CONTACT_COLUMN_ALIASES and column is not None and column != ''}
+        except (TypeError, ValueError):
+            return jsonify({'error': 'header_row and mapping columns must be numbers'}), 400
+        # A column outside the sheet counts as missing (pandas rejects out-of-bounds usecols)
+        missing = [field for field in CONTACT_COLUMN_ALIASES
+                   if not 0 <= mapping.get(field, -1) < len(sheet['columns'])]
+        if missing or not -1 <= header_row < UPLOAD_SNIFF_ROWS:
+            if 'file' in request.files:
+                os.remove(path)
+            found = ', '.join(name for name in sheet['columns'] if name)
+            return jsonify({
+                'error': f"Missing required columns: {', '.join(missing) or 'invalid header row'}. "
+                         f"Found columns on sheet {sheet['name']}: {found}",
+                'sheets': sheets
+            }), 400
+        
+        try:
+            contacts = parse_contacts(path, sheet['name'], header_row, mapping)
+        except Exception as e:
+            return jsonify({'error': f'Failed to parse file: {str(e)}'}), 400
+        finally:
+            # Clean up file
+            os.remove(path)
+        
+        if len(contacts) == 0:
+            return jsonify({'error': 'No valid contacts found in file'}), 400
+        
+        # Store contacts in session for later use
+        session['bulk_email_contacts'] = contacts
+        
+        return jsonify({
+            'success': True,
+            'count': len(contacts),
+            'contacts': contacts[:10],  # Return first 10 for preview
+            'total_contacts': len(contacts),
+            'sheet': sheet['name']
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def select_bulk_contacts(data):
+    """Uploaded contacts, narrowed to the optional `emails` selection (e.g. after MiniCRM enrichment filtering)"""
+    contacts = session.get('bulk_email_contacts', [])
+    selected = data.get('emails')
+    if selected is not None:
+        selected = {email.strip().lower() for email in selected}
+        contacts = [c for c in contacts if c['email'].strip().lower() in selected]
+    return contacts
+
+
+def bulk_template(data):
+    """Email template fields of a bulk send/render request; raises ValueError if it can't be used"""
+    template = {
+        'subject': (data.get('subject') or '').strip(),
+        'body': (data.get('body') or '').strip(),
+        'sender_name': (data.get('sender_name') or '').strip(),
+        'signature': (data.get('signature') or '').strip(),
+        'openers': {}
+    }
+    if not template['subject'] or not template['body']:
+        raise ValueError('Email subject and body are required')
+    
+    # {{opener}} is filled from a reviewed AI-personalization job (email -> draft text)
+    if '{{opener}}' in template['body']:
+        job_id = data.get('personalize_job_id')
+        if not job_id or bulk_store.job(job_id) is None:
+            raise ValueError('The template uses {{opener}} - generate personalized drafts first')
+        template['openers'] = bulk_store.openers(job_id)
+    
+    # The logo is embedded next to the signature - read it once, not per contact
+    template['logo'] = None
+    if template['signature']:
+        try:
+            with open('prv.png', 'rb') as img:
+                template['logo'] = img.read()
+        except OSError as e:
+            logger.warning("Could not read logo: %s", e)
+    return template
+
+
+def render_bulk_message(contact, template, user_email):
+    """Personalized subject, HTML body and Gmail-ready raw message (base64url MIME) for one contact
+
+    Raises ValueError if the contact can't be rendered (e.g. no personalized opener).
+    """
+    from email.mime.text import MIMEText
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.image import MIMEImage
+    
+    # Replace placeholders in subject and body
+    subject = template['subject'].replace('{{company}}', contact['company'])
+    subject = subject.replace('{{person}}', contact['person'])
+    subject = subject.replace('{{email}}', contact['email'])
+    
+    body = template['body'].replace('{{company}}', contact['company'])
+    body = body.replace('{{person}}', contact['person'])
+    body = body.replace('{{email}}', contact['email'])
+    if '{{opener}}' in body:
+        opener = template['openers'].get(contact['email'].strip().lower())
+        if not opener:
+            raise ValueError('No personalized opener for this contact')
+        body = body.replace('{{opener}}', opener)
+    
+    # Create message
+    message = MIMEMultipart('related')
+    message['To'] = contact['email']
+    message['Subject'] = subject
+    
+    # Set From header with display name if provided
+    sender_name = template['sender_name']
+    if sender_name and user_email:
+        message['From'] = f'{sender_name} <{user_email}>'
+    elif user_email:
+        message['From'] = user_email
+    
+    # Convert body to HTML with line breaks
+    html_body = body.replace('\n', '<br>')
+    
+    # Build HTML signature with logo if signature provided
+    signature = template['signature']
+    if signature:
+        # Replace placeholders in signature
+        sig = signature.replace('{{company}}', contact['company'])
+        sig = sig.replace('{{person}}', contact['person'])
+        sig = sig.replace('{{email}}', contact['email'])
+        
+        # HTML signature with embedded logo (logo on top)
+        html_signature = f'''
+        <div style="margin-top: 20px; border-top: 1px solid #e0e0e0; padding-top: 20px;">
+            <table cellpadding="0" cellspacing="0" border="0">
+                <tr>
+                    <td style="text-align: left;">
+                        <img src="cid:prv_logo" alt="PRV Logo" width="120" style="display: block; margin-bottom: 15px;">
+                        <div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.6; color: #333;">
+                            {sig.replace(chr(10), '<br>')}
+                        </div>
+                    </td>
+                </tr>
+            </table>
+        </div>
+        '''
+        full_html = f'<html><body><div style="font-family: Arial, sans-serif; font-size: 14px; color: #333;">{html_body}</div>{html_signature}</body></html>'
+    else:
+        full_html = f'<html><body><div style="font-family: Arial, sans-serif; font-size: 14px; color: #333;">{html_body}</div></body></html>'
+    
+    # Add HTML body
+    message.attach(MIMEText(full_html, 'html'))
+    
+    # Embed logo image if signature is provided
+    if signature and template['logo']:
+        logo_img = MIMEImage(template['logo'])
+        logo_img.add_header('Content-ID', '<prv_logo>')
+        logo_img.add_header('Content-Disposition', 'inline', filename='prv.png')
+        message.attach(logo_img)
+    
+    # Encode message
+    raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+    return subject, full_html, raw_message
+
+
+@app.route('/api/send_bulk_emails', methods=['POST'])
+def send_bulk_emails():
+    """Send bulk emails to contact list (rendered per contact, or drained from a pre-rendered spool)
+
+    With use_sender_pool the messages are spread over the registered sender pool accounts instead
+    of being sent from the connected Gmail account.
+    """
+    try:
+        # Get email template from request
+        data = request.json
+        use_pool = bool(data.get('use_sender_pool'))
+        
+        # Check if user has authorized Gmail (pool accounts use their own stored tokens)
+        gmail_token = session.get('gmail_token')
+        if not gmail_token and not use_pool:
+            return jsonify({
+                'error': 'Gmail not authorized. Please connect your Gmail account first.',
+                'needs_auth': True
+            }), 401
+        
+        start_index = int(data.get('start_index', 0))  # Continue a run that stopped at its deadline
+        
+        spool_id = data.get('spool_id')
+        if spool_id:
+            # Messages were rendered ahead of time - sending only reads them back
+            spool_info = bulk_store.spool(spool_id)
+            if spool_info is None:
+                return jsonify({'error': 'Rendered campaign not found. Please render it again.'}), 404
+            if not spool_info['complete']:
+                return jsonify({'error': 'The campaign is still being rendered'}), 409
+            spool = CampaignSpool(spool_id)
+            total_contacts = spool.count()
+            default_campaign = spool_info['campaign']
+            
+            def messages():
+                for index in range(start_index, total_contacts, SPOOL_READ_BATCH):
+                    batch = spool.read(index, min(index + SPOOL_READ_BATCH, total_contacts), with_raw=True)
+                    yield from enumerate(batch, start=index)
+        else:
+            # Get contacts from session
+            if not session.get('bulk_email_contacts'):
+                return jsonify({'error': 'No contacts loaded. Please upload an Excel file first.'}), 400
+            
+            # Indexes below refer to the selection
+            contacts = select_bulk_contacts(data)
+            if not contacts:
+                return jsonify({'error': 'No contacts selected'}), 400
+            try:
+                template = bulk_template(data)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            total_contacts = len(contacts)
+            default_campaign = template['subject']
+            
+            def messages():
+                for index in range(start_index, total_contacts):
+                    yield index, (contacts[index], None)
+        
+        # Send emails
+        results = {
+            'success': [],
+            'failed': [],
+            'skipped': []
+        }
+        
+        def response(next_index, **extra):
+            return jsonify(dict({
+                'success': True,
+                'results': results,
+                'total_sent': len(results['success']),
+                'total_failed': len(results['failed']),
+                'total_skipped': len(results['skipped']),
+                'complete': next_index is None,
+                'next_index': next_index,
+                'total_contacts': total_contacts,
+                'degraded': degraded_upstreams()
+            }, **extra))
+        
+        # Ledger rules: unsubscribes are always skipped; by default nobody gets the same campaign twice
+        campaign = (data.get('campaign') or default_campaign).strip()
+        skip_recent_days = data.get('skip_recent_days')
+        recent_cutoff = time.time() - float(skip_recent_days) * 86400 if skip_recent_days else None
+        send_ledger.refresh()
+        campaign_recipients = send_ledger.campaign_recipients(campaign) if data.get('skip_sent_in_campaign', True) else None
+        
+        if use_pool:
+            strategy = data.get('pool_strategy') or 'quota'
+            if strategy not in SENDER_POOL_STRATEGIES:
+                return jsonify({'error': f'Unknown pool_strategy: {strategy}'}), 400
+            if spool_id:
+                # Rendered with the renderer's address - each account sends under its own
+                sender_name = spool_info['settings'].get('sender_name') or ''
+                
+                def prepare(contact, raw_message, account):
+                    return switch_from_header(raw_message, sender_name, account)
+            else:
+                def prepare(contact, raw_message, account):
+                    return render_bulk_message(contact, template, account)[2]
+            
+            next_index, accounts, pool_exhausted = send_with_sender_pool(
+                messages(), prepare, strategy, campaign, campaign_recipients, recent_cutoff, results)
+            return response(next_index, accounts=accounts, pool_exhausted=pool_exhausted)
+        
+        # Import Gmail libraries
+        try:
+            from google.auth.transport.requests import Request
+            from google.oauth2.credentials import Credentials
+            from googleapiclient.discovery import build
+        except ImportError as e:
+            return jsonify({'error': f'Gmail API libraries not installed: {str(e)}'}), 400
+        
+        # Create credentials from session
+        creds = Credentials(
+            token=gmail_token['token'],
+            refresh_token=gmail_token.get('refresh_token'),
+            token_uri=gmail_token['token_uri'],
+            client_id=gmail_token['client_id'],
+            client_secret=gmail_token['client_secret'],
+            scopes=gmail_token['scopes']
+        )
+        
+        # Refresh if expired
+        if creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+                session['gmail_token']['token'] = creds.token
+            except Exception as e:
+                return jsonify({
+                    'error': 'Gmail token expired. Please reconnect your Gmail account.',
+                    'needs_auth': True
+                }), 401
+        
+        # Build Gmail service
+        service = build_gmail_service(build, creds)
+        
+        # Get user's email address for From header
+        user_email = None
+        if not spool_id:
+            try:
+                profile = gmail_execute(service.users().getProfile(userId='me'))
+                user_email = profile.get('emailAddress', '')
+            except:
+                user_email = session.get('gmail_user_email', '')
+        
+        deadline = current_deadline()
+        next_index = None
+        for index, (contact, raw_message) in messages():
+            if deadline.expired():
+                next_index = index
+                break
+            recipient = normalize_recipient(contact['email'])
+            reason = send_ledger.skip_reason(recipient, campaign_recipients, recent_cutoff)
+            if reason:
+                BULK_EMAILS.labels('skipped').inc()
+                results['skipped'].append({
+                    'email': contact['email'],
+                    'person': contact['person'],
+                    'company': contact['company'],
+                    'reason': reason
+                })
+                continue
+            try:
+                if spool_id and contact.get('error'):
+                    raise ValueError(contact['error'])  # Could not be rendered
+                if raw_message is None:
+                    raw_message = render_bulk_message(contact, template, user_email)[2]
+                
+                # Send via Gmail API
+                send_result = gmail_execute(service.users().messages().send(
+                    userId='me',
+                    body={'raw': raw_message}
+                ))
+                
+                BULK_EMAILS.labels('sent').inc()
+                send_ledger.record(recipient, campaign, user_email or session.get('gmail_user_email', ''),
+                                   send_result.get('id'))
+                if campaign_recipients is not None:
+                    campaign_recipients.add(recipient)  # Duplicate rows later in the list are skipped
+                results['success'].append({
+                    'email': contact['email'],
+                    'person': contact['person'],
+                    'company': contact['company']
+                })
+                
+                # Small delay to avoid rate limiting
+                time.sleep(0.5)
+                
+            except (DeadlineExceeded, CircuitOpenError):
+                next_index = index  # Not sent - retry this contact on resume
+                break
+            except Exception as e:
+                BULK_EMAILS.labels('failed').inc()
+                results['failed'].append({
+                    'email': contact['email'],
+                    'person': contact['person'],
+                    'company': contact['company'],
+                    'error': str(e)
+                })
+        
+        return response(next_index)
+    
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.exception("Error in send_bulk_emails: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+def open_browser():
+    """Open browser after a short delay (local development only)"""
+    import webbrowser
+    time.sleep(1.5)
+    webbrowser.open('http://localhost:5000')
+
+
+# ============================================
+# MINICRM API ENDPOINTS
+# ============================================
+
+@app.route('/api/minicrm/status', methods=['GET'])
+@requires_auth
+def minicrm_status():
+    """Check if MiniCRM integration is enabled"""
+    return jsonify({
+        'enabled': MINICRM_ENABLED,
+        'system_id': MINICRM_SYSTEM_ID if MINICRM_ENABLED else None
+    })
+
+
+def find_minicrm_contacts(email, deadline=None, limiter=None):
+    """Search MiniCRM contacts by email; returns {'status_code', 'text', 'data'}
+
+    Shared customers are looked up by several users - cache hits skip MiniCRM entirely and
+    concurrent misses share one call (errors are not cached). deadline/limiter are for
+    callers outside the request thread (see enrich_contacts).
+    """
+    def search():
+        if limiter is not None:
+            limiter.acquire(deadline)
+        response = minicrm_request('GET', f"{MINICRM_API_URL}/Contact", params={'Email': email},
+                                   timeout=deadline.timeout(10) if deadline else 10)
+        logger.debug("MiniCRM contact search: status %s, body %.200s", response.status_code, response.text)
+        return {
+            'status_code': response.status_code,
+            'text': response.text[:200],
+            'data': response.json() if response.status_code == 200 else None
+        }
+    
+    return CACHES['minicrm'].get_or_fetch(('find_contact', email), search,
+                                          cache_if=lambda result: result['status_code'] == 200)
+
+
+@app.route('/api/minicrm/find_contact', methods=['POST'])
+@requires_auth
+def minicrm_find_contact():
+    """Find contact in MiniCRM by email address"""
+    if not MINICRM_ENABLED:
+        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+    
+    try:
+        data = request.json
+        email = data.get('email', '').strip()
+        
+        if not email:
+            return jsonify({'error': 'Email address required'}), 400
+        
+        # MiniCRM API call to search contacts by email (cached and coalesced)
+        search = find_minicrm_contacts(email)
+        
+        if search['status_code'] == 200:
+            data = search['data']
+            
+            # MiniCRM API returns: {"Count": 1, "Results": {"28261": {...}}}
+            results = data.get('Results', {})
+            count = data.get('Count', 0)
+            
+            logger.debug("Found %s contacts", count)
+            
+            if results and count > 0:
+                # IMPORTANT: Multiple contacts with same email may exist!
+                # Each contact may be linked to different Business/Projects
+                # We need to collect ALL BusinessIds to query all projects
+                
+                all_business_ids = []
+                primary_contact = None
+                
+                for contact_id, contact in results.items():
+                    business_id = contact.get('BusinessId')
+                    if business_id:
+                        all_business_ids.append(business_id)
+                    
+                    # Use first contact as primary for display
+                    if not primary_contact:
+                        primary_contact = contact
+                
+                logger.debug("Collected %d Business IDs: %s", len(all_business_ids), all_business_ids)
+                
+                if not primary_contact:
+                    return jsonify({'found': False, 'message': 'No valid contact found'})
+                
+                return jsonify({
+                    'found': True,
+                    'contact': {
+                        'id': primary_contact.get('Id'),
+                        'name': primary_contact.get('Name'),
+                        'email': primary_contact.get('Email'),
+                        'company': primary_contact.get('Company'),
+                        'phone': primary_contact.get('Phone'),
+                        'business_ids': all_business_ids,  # ← ALL BusinessIds (plural)!
+                        'business_id': all_business_ids[0] if all_business_ids else None  # ← Keep for backwards compat
+                    }
+                })
+            else:
+                return jsonify({'found': False, 'message': 'No contact found with this email'})
+        else:
+            error_msg = f"MiniCRM API error: {search['status_code']} - {search['text']}"
+            logger.warning(error_msg)
+            return jsonify({'error': error_msg}), search['status_code']
+    
+    except (requests.exceptions.Timeout, DeadlineExceeded):
+        # DeadlineExceeded: waited for an identical lookup until the request's time ran out
+        logger.warning("MiniCRM API timeout (find_contact)")
+        return jsonify({'error': 'MiniCRM API timeout'}), 408
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.exception("Error finding contact: %s: %s", type(e).__name__, e)
+        return jsonify({'error': f'{type(e).__name__}: {str(e)}'}), 500
+
+
+@app.route('/api/minicrm/get_todos', methods=['POST'])
+@requires_auth
+def minicrm_get_todos():
+    """Get todos (tasks) for a contact from MiniCRM"""
+    if not MINICRM_ENABLED:
+        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+    
+    try:
+        data = request.json
+        business_id = data.get('business_id')
+        business_ids = data.get('business_ids', [])  # NEW: Accept multiple BusinessIds!
+        contact_name = data.get('contact_name', 'Unknown')
+        category_id = data.get('category_id')  # Optional: filter by Termék (Product/Category)
+        filter_user = data.get('filter_user')  # Optional: filter by assigned user
+        include_closed = data.get('include_closed', False)  # Optional: include closed/completed todos
+        
+        # Support both single business_id and multiple business_ids
+        if not business_ids and business_id:
+            business_ids = [business_id]
+        
+        if not business_ids:
+            return jsonify({'error': 'Business ID(s) required to find projects and todos'}), 400
+        
+        logger.debug("Getting todos for %s - %d Business ID(s): %s (Category: %s, Filter User: %s, Include Closed: %s)",
+                     contact_name, len(business_ids), business_ids, category_id or 'All', filter_user or 'All',
+                     include_closed)
+        
+        # Step 1: Get all Projects for ALL Business IDs
+        # MiniCRM structure: Contact → Business → Projects → ToDoList
+        # Multiple contacts with same email = multiple BusinessIds to check!
+        projects_url = f"{MINICRM_API_URL}/Project"
+        
+        # Resuming a partial result: project lookups come from the cache, todos continue after the last project
+        cursor_state = {}
+        if data.get('cursor'):
+            try:
+                cursor_state = decode_cursor(data['cursor'])
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+        resume_after_id = cursor_state.get('after_project_id')
+        
+        def business_projects(business_id):
+            """Projects of one business (category-filtered) - cached, so a resumed request skips the lookups"""
+            def fetch():
+                projects_params = {'MainContactId': business_id}
+                
+                # Add CategoryId filter if specified (to get only ACS or PCS projects)
+                if category_id:
+                    projects_params['CategoryId'] = category_id
+                
+                projects_response = minicrm_request('GET', projects_url, params=projects_params, timeout=10)
+                if projects_response.status_code != 200:
+                    logger.warning("Failed to get projects for business %s: %s", business_id, projects_response.status_code)
+                    return {'error': projects_response.status_code}
+                
+                projects_data = projects_response.json()
+                projects_results = projects_data.get('Results', {})
+                projects_count = projects_data.get('Count', 0)
+                found = {}
+                
+                logger.debug("Found %s projects for business %s", projects_count, business_id)
+                
+                # Handle both dict and list response formats
+                if isinstance(projects_results, dict):
+                    # Dict format: {"12651": {...}, "12690": {...}}
+                    # WARNING: Search results may not include CategoryId!
+                    # Need to fetch full project details if CategoryId missing
+                    
+                    for project_id_str, project_info in projects_results.items():
+                        project_id = project_info.get('Id')
+                        project_category = project_info.get('CategoryId')
+                        
+                        # If CategoryId not in search result and we have a filter, fetch full details
+                        if not project_category and category_id:
+                            project_url = project_info.get('Url')
+                            if project_url:
+                                try:
+                                    full_project_response = minicrm_request('GET', project_url, timeout=10)
+                                    if full_project_response.status_code == 200:
+                                        full_project_info = full_project_response.json()
+                                        project_category = full_project_info.get('CategoryId')
+                                        
+                                        # Update project_info with full data
+                                        project_info = full_project_info
+                                except (CircuitOpenError, DeadlineExceeded):
+                                    raise
+                                except Exception as e:
+                                    if isinstance(e, requests.exceptions.Timeout) and current_deadline().expired():
+                                        raise  # Cut short by our budget - don't cache a lookup missing this project
+                                    logger.warning("Error fetching full project %s: %s", project_id, e)
+                        
+                        # Only add if CategoryId matches filter (or no filter)
+                        if not category_id or str(project_category) == str(category_id):
+                            found[project_id_str] = project_info
+                        else:
+                            logger.debug("Skipped project %s (CategoryId %s != filter %s)", project_id, project_category, category_id)
+                
+                elif isinstance(projects_results, list):
+                    # List format: [{...}, {...}]
+                    for project_info in projects_results:
+                        project_id = project_info.get('Id')
+                        if project_id:
+                            found[str(project_id)] = project_info
+                else:
+                    logger.warning("Unexpected projects_results type: %s", type(projects_results).__name__)
+                return {'projects': found}
+            
+            return CACHES['minicrm'].get_or_fetch(('contact_projects', business_id, category_id), fetch,
+                                                  cache_if=lambda value: 'error' not in value)
+        
+        all_projects_results = {}
+        deadline = current_deadline()
+        complete = True
+        circuit_error = None
+        businesses_looked_up = 0
+        
+        for business_id in business_ids:
+            if deadline.expired():
+                complete = False
+                break
+            try:
+                all_projects_results.update(business_projects(business_id).get('projects', {}))
+            except CircuitOpenError as e:
+                circuit_error = e
+                complete = False
+                break
+            except DeadlineExceeded:
+                complete = False
+                break
+            except Exception as e:
+                if isinstance(e, requests.exceptions.Timeout) and deadline.expired():
+                    complete = False  # Cut short by our own budget - the resume looks it up again
+                    break
+                logger.warning("Error getting projects for business %s: %s", business_id, e)
+            businesses_looked_up += 1
+        
+        if not complete and not circuit_error:
+            # Out of time while looking up projects - nothing checked yet. Lookups done so far are
+            # cached, so a retry gets further; stop the client if this run made no progress
+            stalled = businesses_looked_up <= cursor_state.get('businesses_looked_up', 0)
+            return jsonify({
+                'success': True,
+                'todos': [],
+                'count': 0,
+                'complete': False,
+                'cursor': None if stalled else encode_cursor({'businesses_looked_up': businesses_looked_up,
+                                                              'after_project_id': resume_after_id}),
+                **({'error': 'MiniCRM is too slow to look up the projects - try again later'} if stalled else {}),
+                'degraded': degraded_upstreams()
+            })
+        
+        total_projects = len(all_projects_results)
+        logger.debug("Total projects found across %d Business ID(s): %d", len(business_ids), total_projects)
+        
+        if total_projects == 0:
+            if circuit_error:
+                return circuit_open_response(circuit_error)
+            return jsonify({'success': True, 'todos': [], 'message': 'No projects found', 'complete': complete})
+        
+        # Step 2: Get todos from all projects, in ID order so a cursor can say "everything up to this ID is done"
+        def project_sort_key(item):
+            return int(item[0]) if str(item[0]).isdigit() else 0
+        
+        projects_in_order = sorted(all_projects_results.items(), key=project_sort_key)
+        if resume_after_id is not None:
+            projects_in_order = [item for item in projects_in_order if project_sort_key(item) > resume_after_id]
+        all_todos = []
+        last_project_id = resume_after_id
+        
+        for project_index, (project_id_str, project_info) in enumerate(projects_in_order, 1):
+            if deadline.expired():
+                complete = False
+                break
+            project_id = project_info.get('Id')
+            project_name = project_info.get('Name')
+            
+            # MiniCRM API call to get todos for this project
+            # Correct endpoint: /Api/R3/ToDoList/{project_id}
+            # Status parameter: Open (only active todos), Closed (completed), or All (default)
+            url = f"{MINICRM_API_URL}/ToDoList/{project_id}"
+            todo_params = {}
+            
+            # Determine which todos to fetch based on include_closed flag
+            # (ALL todos = Open + Closed - don't specify Status param)
+            if not include_closed:
+                # Fetch only Open/active todos
+                todo_params['Status'] = 'Open'
+            
+            try:
+                response = minicrm_request('GET', url, params=todo_params, timeout=10)
+                
+                if response.status_code == 200:
+                    todo_data = response.json()
+                    
+                    # MiniCRM API returns: {"Count": N, "Results": [{...}, {...}]} or {"Count": N, "Results": {"id1": {...}}}
+                    results = todo_data.get('Results', {})
+                    count = todo_data.get('Count', 0)
+                    
+                    # Handle both dict and list response formats
+                    if isinstance(results, dict):
+                        todo_items = results.values()
+                    else:
+                        todo_items = results
+                    
+                    # Collect unique UserIds for debugging (sampled - skipped entirely unless DEBUG)
+                    if log_sampled(project_index):
+                        unique_user_ids = {todo.get('UserId') for todo in todo_items if todo.get('UserId')}
+                        logger.debug("Project %s (ID: %s): %s todos, UserIds %s", project_name, project_id, count, unique_user_ids)
+                    
+                    # Format todos for frontend
+                    for todo in todo_items:
+                        # Filter by user if specified
+                        todo_user_id = todo.get('UserId', '')
+                        
+                        # If filter_user is set, only include todos assigned to that user
+                        if filter_user and todo_user_id:
+                            # UserId in MiniCRM is typically a NUMERIC ID
+                            # User may enter either:
+                            # 1. Numeric ID (e.g., "120420")
+                            # 2. User name (will NOT match numeric UserId!)
+                            
+                            is_match = False
+                            
+                            # Try numeric comparison first
+                            try:
+                                if str(todo_user_id) == str(filter_user):
+                                    is_match = True
+                            except:
+                                pass
+                            
+                            # If still no match and both are strings, try case-insensitive
+                            if not is_match and isinstance(todo_user_id, str) and isinstance(filter_user, str):
+                                if todo_user_id.strip().lower() == filter_user.strip().lower():
+                                    is_match = True
+                            
+                            if not is_match:
+                                continue  # Skip this todo
+                        
+                        formatted_todo = {
+                            'id': todo.get('Id'),
+                            'title': todo.get('Comment') or todo.get('Title') or todo.get('Name', 'Névtelen teendő'),
+                            'description': todo.get('Description', ''),
+                            'deadline': todo.get('Deadline') or todo.get('DueDate'),
+                            'status': todo.get('Status', 'Active'),
+                            'completed': todo.get('Status') == 'Closed',
+                            'project_name': project_name,
+                            'project_id': project_id,
+                            'assigned_to': todo_user_id  # Include assigned user for debugging
+                        }
+                        all_todos.append(formatted_todo)
+                    
+                else:
+                    logger.warning("Failed to get todos for project %s: %s", project_id, response.status_code)
+                    
+            except (DeadlineExceeded, CircuitOpenError):
+                complete = False
+                break
+            except Exception as e:
+                if isinstance(e, requests.exceptions.Timeout) and deadline.expired():
+                    complete = False  # Cut short by our own budget - not done, the resume retries it
+                    break
+                logger.warning("Error getting todos for project %s: %s", project_id, e)
+            last_project_id = project_sort_key((project_id_str, project_info))
+        
+        logger.info("get_todos: %d todos from %d projects%s", len(all_todos), total_projects,
+                    '' if complete else ' - partial')
         
-        SCOPES = [
-            'https://www.googleapis.com/auth/gmail.readonly',
-            'https://www.googleapis.com/auth/gmail.send'
-        ]
+        return jsonify({
+            'success': True,
+            'todos': all_todos,
+            'count': len(all_todos),
+            'complete': complete,
+            'cursor': None if complete else encode_cursor({'businesses_looked_up': businesses_looked_up,
+                                                           'after_project_id': last_project_id}),
+            'degraded': degraded_upstreams()
+        })
+    
+    except requests.exceptions.Timeout:
+        return jsonify({'error': 'MiniCRM API timeout'}), 408
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.exception("Error getting todos: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/minicrm/update_todo', methods=['POST'])
+@requires_auth
+def minicrm_update_todo():
+    """Update todo comment and/or deadline in MiniCRM"""
+    if not MINICRM_ENABLED:
+        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+    
+    try:
+        data = request.json
+        todo_id = data.get('todo_id')
+        comment = data.get('comment')
+        deadline = data.get('deadline')
         
-        # Allow insecure transport for local development
-        if not IS_PRODUCTION:
-            os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+        if not todo_id:
+            return jsonify({'error': 'Todo ID required'}), 400
         
-        # Create flow
-        flow = Flow.from_client_secrets_file(
-            GMAIL_CREDENTIALS_PATH,
-            scopes=SCOPES,
-            redirect_uri=request.host_url.rstrip('/') + '/api/gmail_callback'
-        )
+        if not comment and not deadline:
+            return jsonify({'error': 'At least comment or deadline must be provided'}), 400
         
-        authorization_url, state = flow.authorization_url(
-            access_type='offline',
-            include_granted_scopes='true',
-            prompt='consent'
-        )
+        # MiniCRM API call to update todo
+        # Correct endpoint: /Api/R3/ToDo/{todo_id} (capital D!)
+        url = f"{MINICRM_API_URL}/ToDo/{todo_id}"
         
-        # Store state in session
-        session['gmail_oauth_state'] = state
+        # Build update payload with only provided fields
+        update_data = {}
+        if comment:
+            update_data['Comment'] = comment
+        if deadline:
+            update_data['Deadline'] = deadline
         
-        return jsonify({
-            'auth_url': authorization_url
-        })
+        logger.info("Updating MiniCRM todo %s (%s)", todo_id, ', '.join(update_data))
+        
+        response = minicrm_request('PUT', url, json=update_data, timeout=10)
         
+        if response.status_code == 200:
+            changes = []
+            if comment:
+                changes.append('text')
+            if deadline:
+                changes.append('deadline')
+            
+            return jsonify({
+                'success': True,
+                'message': f'Todo updated successfully ({", ".join(changes)})!',
+                'todo_id': todo_id
+            })
+        else:
+            logger.warning("MiniCRM update error: %s - %.200s", response.status_code, response.text)
+            return jsonify({'error': f'MiniCRM API error: {response.status_code}'}), response.status_code
+    
+    except requests.exceptions.Timeout:
+        return jsonify({'error': 'MiniCRM API timeout'}), 408
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
     except Exception as e:
+        logger.exception("Error updating todo: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/gmail_callback')
-def gmail_callback():
-    """Handle Gmail OAuth callback"""
+@app.route('/api/minicrm/update_todo_deadline', methods=['POST'])
+@requires_auth
+def minicrm_update_todo_deadline():
+    """Update deadline of a todo in MiniCRM (legacy endpoint, redirects to update_todo)"""
+    if not MINICRM_ENABLED:
+        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+    
     try:
-        from google_auth_oauthlib.flow import Flow
-        from google.oauth2.credentials import Credentials
-        
-        SCOPES = [
-            'https://www.googleapis.com/auth/gmail.readonly',
-            'https://www.googleapis.com/auth/gmail.send'
-        ]
+        data = request.json
+        todo_id = data.get('todo_id')
+        new_deadline = data.get('deadline')
         
-        # Verify state
-        state = session.get('gmail_oauth_state')
-        if not state:
-            return '<h1>Error: Invalid state</h1><p>Please try again.</p>', 400
+        if not todo_id or not new_deadline:
+            return jsonify({'error': 'Todo ID and deadline required'}), 400
         
-        # Allow insecure transport for local development
-        if not IS_PRODUCTION:
-            os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = '1'
+        # Redirect to new update_todo endpoint
+        data['comment'] = None  # Only update deadline
+        return minicrm_update_todo()
+    
+    except Exception as e:
+        logger.exception("Error updating todo deadline: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+def scan_daily_todos(category_id, updated_since_str, resume_after_id):
+    """Scan recently updated projects for open todos due today or earlier (same for every user - filter afterwards)
+
+    Returns a JSON-serializable dict so concurrent identical scans can share one result (see single_flight).
+    """
+    from datetime import date
+    
+    # Get ALL projects in the category that were updated recently (with pagination)
+    projects_url = f"{MINICRM_API_URL}/Project"
+    projects_params = {
+        'UpdatedSince': updated_since_str  # Only fetch recently updated projects
+    }
+    if category_id:
+        projects_params['CategoryId'] = category_id
+    
+    def fetch_page(page):
+        """One page of the project list - cached, so a resumed scan skips the pages it already has"""
+        def fetch():
+            response = minicrm_request('GET', projects_url, params=dict(projects_params, Page=page), timeout=45)
+            if response.status_code != 200:
+                return {'error': f'{response.status_code} - {response.text[:200]}'}
+            return {'results': response.json().get('Results', {})}
+        return CACHES['minicrm'].get_or_fetch(('daily_todos_projects', category_id, updated_since_str, page), fetch,
+                                              cache_if=lambda value: 'error' not in value)
+    
+    # Fetch all pages (API returns max 100 per page)
+    all_projects = {}
+    page = 0
+    deadline = current_deadline()
+    complete = True
+    
+    while True:
+        if deadline.expired():
+            complete = False
+            break
         
-        # Create flow with same redirect URI
-        flow = Flow.from_client_secrets_file(
-            GMAIL_CREDENTIALS_PATH,
-            scopes=SCOPES,
-            state=state,
-            redirect_uri=request.host_url.rstrip('/') + '/api/gmail_callback'
-        )
+        try:
+            page_data = fetch_page(page)
+            
+            if 'error' in page_data:
+                logger.warning("Error fetching projects page %d: %s", page, page_data['error'])
+                break
+            
+            projects_results = page_data['results']
+            
+            if not projects_results:
+                # No more results
+                break
+            
+            logger.debug("Page %d: found %d projects", page, len(projects_results))
+            all_projects.update(projects_results)
+            
+            # If we got less than 100, this is the last page
+            if len(projects_results) < 100:
+                break
+            
+            page += 1
+            
+            # Safety limit: max 10 pages (1000 projects)
+            if page >= 10:
+                logger.warning("Reached 10 pages (1000 projects). Stopping pagination.")
+                break
+                
+        except DeadlineExceeded:
+            complete = False
+            break
+        except CircuitOpenError:
+            raise  # Nothing to show without the project list
+        except requests.exceptions.Timeout:
+            logger.warning("Timeout fetching page %d - continuing with %d projects fetched so far", page, len(all_projects))
+            break
+        except Exception as e:
+            logger.warning("Error on page %d: %s - continuing with %d projects", page, e, len(all_projects))
+            break
+    
+    if not complete:
+        # Ran out of time while paging - nothing checked yet. The pages fetched so far are cached, so
+        # the client's retry continues from page `pages_fetched` (the route stops it if that didn't grow)
+        return {'todos': [], 'complete': False, 'last_project_id': resume_after_id, 'pages_fetched': page,
+                'projects_checked': 0, 'projects_total': 0}
+    
+    # Process projects in ID order so a cursor can say "everything up to this ID is done"
+    def project_sort_key(item):
+        return int(item[0]) if str(item[0]).isdigit() else 0
+    
+    projects_results = dict(sorted(all_projects.items(), key=project_sort_key))
+    if resume_after_id is not None:
+        projects_results = {pid: info for pid, info in projects_results.items()
+                            if project_sort_key((pid, info)) > resume_after_id}
+    logger.debug("Total projects to check: %d (updated since %s)", len(projects_results), updated_since_str)
+    
+    today = date.today()
+    all_todos = []
+    
+    # For each project, fetch todos (stopping cleanly at the request deadline)
+    project_count = 0
+    last_project_id = resume_after_id
+    for project_id, project_info in projects_results.items():
+        if deadline.expired():
+            complete = False
+            break
+        project_count += 1
+        project_name = project_info.get('Name', 'Unknown')
         
-        # Fetch token
-        flow.fetch_token(authorization_response=request.url)
+        if log_sampled(project_count):  # Log first few and every Nth (DEBUG only)
+            logger.debug("[%d/%d] Checking project: %s (ID: %s)", project_count, len(projects_results), project_name, project_id)
         
-        # Get credentials
-        creds = flow.credentials
+        # Fetch todos for this project (only Open status)
+        todos_url = f"{MINICRM_API_URL}/ToDoList/{project_id}"
+        todos_params = {'Status': 'Open'}
         
-        # Get user email from Google
         try:
-            from googleapiclient.discovery import build
-            service = build('gmail', 'v1', credentials=creds)
-            profile = service.users().getProfile(userId='me').execute()
-            user_email = profile.get('emailAddress', 'Unknown')
-        except:
-            user_email = 'Connected'
-        
-        # Save token for this user session
-        session['gmail_token'] = {
-            'token': creds.token,
-            'refresh_token': creds.refresh_token,
-            'token_uri': creds.token_uri,
-            'client_id': creds.client_id,
-            'client_secret': creds.client_secret,
-            'scopes': creds.scopes
-        }
-        
-        # Save user email
-        session['gmail_user_email'] = user_email
+            todos_response = minicrm_request('GET', todos_url, params=todos_params, timeout=10)
+            
+            if todos_response.status_code == 200:
+                todos_data = todos_response.json()
+                
+                # Handle both dict and list responses
+                if isinstance(todos_data, dict):
+                    todos_list = todos_data.get('Results', [])
+                else:
+                    todos_list = todos_data
+                
+                # Process each todo
+                todos_found_in_project = 0
+                todos_filtered_by_date = 0
+                
+                for todo in todos_list:
+                    todo_deadline = todo.get('Deadline', '')
+                    
+                    # Filter by deadline (overdue or today only)
+                    if todo_deadline:
+                        try:
+                            deadline_date_str = todo_deadline.split(' ')[0]  # Get YYYY-MM-DD part
+                            deadline_date = datetime.strptime(deadline_date_str, '%Y-%m-%d').date()
+                            
+                            # Only include if overdue or today
+                            if deadline_date <= today:
+                                todo['project_name'] = project_name
+                                todo['project_id'] = project_id
+                                all_todos.append(todo)
+                                todos_found_in_project += 1
+                            else:
+                                todos_filtered_by_date += 1
+                        except ValueError:
+                            # Skip if date parsing fails
+                            continue
+                
+                if log_sampled(project_count) and (todos_filtered_by_date > 0 or todos_found_in_project > 0):
+                    logger.debug("  Kept %d, filtered %d by date", todos_found_in_project, todos_filtered_by_date)
         
-        # Return success page
-        return '''
-        <html>
-        <head>
-            <title>Gmail Connected!</title>
-            <style>
-                body {
-                    font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", Roboto, sans-serif;
-                    display: flex;
-                    justify-content: center;
-                    align-items: center;
-                    height: 100vh;
-                    margin: 0;
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                }
-                .container {
-                    background: white;
-                    padding: 48px;
-                    border-radius: 16px;
-                    box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-                    text-align: center;
-                    max-width: 400px;
-                }
-                h1 { color: #27ae60; margin-bottom: 16px; }
-                p { color: #666; margin-bottom: 24px; line-height: 1.6; }
-                button {
-                    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                    color: white;
-                    border: none;
-                    padding: 12px 32px;
-                    border-radius: 8px;
-                    font-size: 16px;
-                    font-weight: 600;
-                    cursor: pointer;
-                }
-                button:hover { opacity: 0.9; }
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>✅ Gmail Connected!</h1>
-                <p>Your Gmail account has been successfully connected. You can now load email history.</p>
-                <button onclick="window.close()">Close Window</button>
-                <script>
-                    setTimeout(() => {
-                        window.close();
-                        if (!window.closed) {
-                            window.location.href = '/';
-                        }
-                    }, 3000);
-                </script>
-            </div>
-        </body>
-        </html>
-        '''
+        except (DeadlineExceeded, CircuitOpenError):
+            complete = False  # Out of time, or MiniCRM is failing - return what we have
+            break
+        except requests.exceptions.Timeout:
+            if deadline.expired():
+                complete = False  # Cut short by our own budget - not done, the resume retries it
+                break
+            logger.warning("Timeout fetching todos for project %s", project_id)
+        except Exception as e:
+            logger.warning("Error fetching todos for project %s: %s", project_id, e)
         
-    except Exception as e:
-        return f'<h1>Error</h1><p>{str(e)}</p>', 500
+        last_project_id = project_sort_key((project_id, project_info))
+    
+    return {'todos': all_todos, 'complete': complete, 'last_project_id': last_project_id,
+            'projects_checked': project_count, 'projects_total': len(projects_results)}
 
 
-@app.route('/api/load_emails', methods=['POST'])
-def load_emails():
-    """Load email history from Gmail"""
+@app.route('/api/minicrm/daily_todos', methods=['POST'])
+@requires_auth
+def minicrm_daily_todos():
+    """Get all overdue and today's todos from selected category"""
+    if not MINICRM_ENABLED:
+        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+    
     try:
-        data = request.get_json()
-        if not data:
-            return jsonify({'error': 'Invalid request'}), 400
-            
-        email_address = data.get('email', '').strip()
+        data = request.json
+        category_id = data.get('category_id')  # ACS: 23, PCS: 41
+        filter_user_id = data.get('filter_user')
+        lookback_days = data.get('lookback_days', 30)  # Default: only fetch projects updated in last 30 days
         
-        if not email_address:
-            return jsonify({'error': 'Email address is required'}), 400
+        logger.debug("daily_todos: Category %s, Filter User %s, Lookback Days %s", category_id, filter_user_id, lookback_days)
         
-        # Check if user has authorized Gmail
-        gmail_token = session.get('gmail_token')
-        if not gmail_token:
-            return jsonify({
-                'error': 'Gmail not authorized. Please connect your Gmail account first.',
-                'needs_auth': True
-            }), 401
+        # Step 1: Calculate UpdatedSince date (optimization: only fetch recently updated projects)
+        from datetime import date, timedelta
+        cursor = data.get('cursor')
+        resume_after_id = None
+        if cursor:
+            # Resuming a partial result: keep the same project set, skip projects already checked
+            try:
+                cursor_state = decode_cursor(cursor)
+            except ValueError as e:
+                return jsonify({'error': str(e)}), 400
+            updated_since_str = cursor_state.get('updated_since')
+            resume_after_id = cursor_state.get('after_project_id')
+            pages_fetched = cursor_state.get('pages_fetched', 0)
+        else:
+            # Whole days, so everyone opening the view today asks MiniCRM the same question
+            updated_since_date = date.today() - timedelta(days=lookback_days)
+            updated_since_str = updated_since_date.strftime('%Y-%m-%d 00:00:00')
+            pages_fetched = 0
         
-        # Check if Gmail API is available
+        # Step 2-4: Scan projects for due todos - identical concurrent scans share one fetch
         try:
-            from google.auth.transport.requests import Request
-            from google.oauth2.credentials import Credentials
-            from googleapiclient.discovery import build
-            import base64
-            from email.utils import parsedate_to_datetime
-        except ImportError as e:
-            return jsonify({'error': f'Gmail API libraries not installed: {str(e)}'}), 400
+            scan = single_flight(
+                ('daily_todos', category_id, updated_since_str, resume_after_id),
+                lambda: scan_daily_todos(category_id, updated_since_str, resume_after_id),
+                shareable=lambda scan: scan['complete']  # A partial scan ran out of the leader's time, not ours
+            )
+        except DeadlineExceeded:
+            # Waited for an identical scan (in this or another worker) until our time ran out - the
+            # pages it fetched are cached, so the client's retry from the same cursor gets further
+            return jsonify({
+                'success': True,
+                'todos': [],
+                'total': 0,
+                'overdue': 0,
+                'today': 0,
+                'complete': False,
+                'cursor': encode_cursor({
+                    'updated_since': updated_since_str,
+                    'after_project_id': resume_after_id,
+                    'pages_fetched': pages_fetched
+                }),
+                'degraded': degraded_upstreams()
+            })
+        complete = scan['complete']
+        # Still paging: go on only if this run got further through the project list than the last one
+        stalled = not complete and 'pages_fetched' in scan and scan['pages_fetched'] <= pages_fetched
         
-        # Create credentials from session
-        creds = Credentials(
-            token=gmail_token['token'],
-            refresh_token=gmail_token.get('refresh_token'),
-            token_uri=gmail_token['token_uri'],
-            client_id=gmail_token['client_id'],
-            client_secret=gmail_token['client_secret'],
-            scopes=gmail_token['scopes']
-        )
+        # Step 5: Filter by user locally (the shared scan is the same for everyone - build a new list)
+        all_todos = [todo for todo in scan['todos']
+                     if not filter_user_id or str(todo.get('UserId')) == str(filter_user_id)]
         
-        # Refresh if expired
-        if creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-                # Update session with new token
-                session['gmail_token']['token'] = creds.token
-            except Exception as e:
-                return jsonify({
-                    'error': 'Gmail token expired. Please reconnect your Gmail account.',
-                    'needs_auth': True
-                }), 401
+        # Step 6: Sort todos by deadline (oldest first)
+        all_todos.sort(key=lambda x: x.get('Deadline', ''))
         
-        service = build('gmail', 'v1', credentials=creds)
+        # Step 7: Count overdue vs today
+        today_str = date.today().strftime('%Y-%m-%d')
+        overdue_count = 0
+        today_count = 0
         
-        # Search for emails
-        query = f'from:{email_address} OR to:{email_address}'
-        results = service.users().messages().list(userId='me', q=query, maxResults=20).execute()
-        messages = results.get('messages', [])
+        for todo in all_todos:
+            deadline_str = todo.get('Deadline', '').split(' ')[0]
+            if deadline_str < today_str:
+                overdue_count += 1
+            elif deadline_str == today_str:
+                today_count += 1
         
-        email_list = []
-        for msg in messages:
-            msg_data = service.users().messages().get(userId='me', id=msg['id'], format='full').execute()
-            
-            headers = msg_data['payload']['headers']
-            subject = next((h['value'] for h in headers if h['name'].lower() == 'subject'), 'No Subject')
-            from_email = next((h['value'] for h in headers if h['name'].lower() == 'from'), 'Unknown')
-            date_str = next((h['value'] for h in headers if h['name'].lower() == 'date'), '')
-            
-            # Parse date
-            try:
-                date_obj = parsedate_to_datetime(date_str) if date_str else datetime.now()
-                formatted_date = date_obj.strftime('%Y-%m-%d %H:%M')
-            except:
-                formatted_date = date_str or 'Unknown date'
-            
-            # Extract full body
-            body = extract_message_body(msg_data['payload'])
-            
-            # Determine direction
-            is_from_me = any(x in from_email.lower() for x in ["ince@prv.hu", "czechner ince", "czechner"])
-            direction = "KÜLDTEM (Czechner Ince)" if is_from_me else "KAPTAM"
-            
-            email_list.append({
-                'id': msg['id'],
-                'subject': subject,
-                'from': from_email,
-                'date': formatted_date,
-                'body': body,  # Full body, not truncated
-                'direction': direction
-            })
+        degraded = degraded_upstreams()
+        logger.info("daily_todos: %d todos from %d/%d projects (Overdue: %d, Today: %d)%s",
+                    len(all_todos), scan['projects_checked'], scan['projects_total'], overdue_count, today_count,
+                    '' if complete else ' - partial, MiniCRM degraded' if degraded else ' - partial, deadline reached')
         
         return jsonify({
             'success': True,
-            'email': email_address,
-            'count': len(email_list),
-            'emails': email_list
+            'todos': all_todos,
+            'total': len(all_todos),
+            'overdue': overdue_count,
+            'today': today_count,
+            'complete': complete,
+            'cursor': None if complete or stalled else encode_cursor({
+                'updated_since': updated_since_str,
+                'after_project_id': scan['last_project_id'],
+                'pages_fetched': scan.get('pages_fetched', 0)
+            }),
+            **({'error': 'MiniCRM is too slow to list the projects - try again later'} if stalled else {}),
+            'degraded': degraded
+        })
+    
+    except requests.exceptions.Timeout:
+        return jsonify({'error': 'MiniCRM API timeout'}), 408
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except Exception as e:
+        logger.exception("Error fetching daily todos: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+# ============================================
+# CONTACT ENRICHMENT (bulk email lists)
+# ============================================
+
+class RateLimiter:
+    """Token bucket for the threads of this worker: at most `rate` calls per second, bursts up to `burst`"""
+    
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self, deadline=None):
+        """Block until a call is allowed (raises DeadlineExceeded if the deadline passes first)"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and deadline.remaining() < wait:
+                raise DeadlineExceeded()
+            time.sleep(wait)
+
+
+enrich_rate_limiter = RateLimiter(ENRICH_MINICRM_RPS)
+
+
+def reset_rate_limiter_after_fork():
+    """The limiter's lock may have been held by a parent thread at fork time"""
+    enrich_rate_limiter.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=reset_rate_limiter_after_fork)
+
+
+def count_open_todos(business_id, deadline, limiter):
+    """Projects and open todos of a MiniCRM business (cached) - raises on API errors so they aren't cached"""
+    def fetch():
+        limiter.acquire(deadline)
+        response = minicrm_request('GET', f"{MINICRM_API_URL}/Project", params={'MainContactId': business_id},
+                                   timeout=deadline.timeout(10))
+        if response.status_code != 200:
+            raise RuntimeError(f'MiniCRM API error: {response.status_code}')
+        projects = response.json().get('Results', {})
+        project_ids = [p.get('Id') for p in (projects.values() if isinstance(projects, dict) else projects)]
+        
+        open_todos = 0
+        for project_id in project_ids:
+            limiter.acquire(deadline)
+            response = minicrm_request('GET', f"{MINICRM_API_URL}/ToDoList/{project_id}", params={'Status': 'Open'},
+                                       timeout=deadline.timeout(10))
+            if response.status_code != 200:
+                raise RuntimeError(f'MiniCRM API error: {response.status_code}')
+            open_todos += response.json().get('Count', 0)
+        return {'projects': len(project_ids), 'open_todos': open_todos}
+    
+    return CACHES['minicrm'].get_or_fetch(('open_todos', business_id), fetch)
+
+
+def enrich_email(email, deadline, limiter):
+    """MiniCRM annotations for one email address (runs in an enrichment worker thread)"""
+    if deadline.expired():
+        raise DeadlineExceeded()
+    search = find_minicrm_contacts(email, deadline, limiter)
+    if search['status_code'] != 200:
+        return {'error': f"MiniCRM API error: {search['status_code']}"}
+    
+    results = search['data'].get('Results', {})
+    contacts = list(results.values()) if isinstance(results, dict) else results
+    if not contacts:
+        return {'in_minicrm': False}
+    
+    business_ids = list(dict.fromkeys(c.get('BusinessId') for c in contacts if c.get('BusinessId')))
+    projects = 0
+    open_todos = 0
+    for business_id in business_ids:
+        counts = count_open_todos(business_id, deadline, limiter)
+        projects += counts['projects']
+        open_todos += counts['open_todos']
+    
+    return {
+        'in_minicrm': True,
+        'contact_id': contacts[0].get('Id'),
+        'contact_name': contacts[0].get('Name'),
+        'business_ids': business_ids,
+        'projects': projects,
+        'open_todos': open_todos
+    }
+
+
+@app.route('/api/enrich_contacts', methods=['POST'])
+@requires_auth
+def enrich_contacts():
+    """Look the uploaded contact list up in MiniCRM - streams NDJSON events (start, row, progress, done)"""
+    if not MINICRM_ENABLED:
+        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+    
+    contacts = session.get('bulk_email_contacts', [])
+    if not contacts:
+        return jsonify({'error': 'No contacts loaded. Please upload an Excel file first.'}), 400
+    
+    # Optional subset (by email) - used to resume after a partial run
+    data = request.get_json(silent=True) or {}
+    only = {email.strip().lower() for email in data.get('emails') or []}
+    
+    # Each distinct email is looked up once; every row with it gets the result
+    rows_by_email = {}
+    for index, contact in enumerate(contacts):
+        email = contact['email'].strip().lower()
+        if not only or email in only:
+            rows_by_email.setdefault(email, []).append(index)
+    
+    deadline = current_deadline()
+    total_rows = sum(len(indexes) for indexes in rows_by_email.values())
+    
+    def event(payload):
+        return (json.dumps(payload, ensure_ascii=False) + '\n').encode('utf-8')
+    
+    def generate():
+        yield event({'type': 'start', 'rows': total_rows, 'emails': len(rows_by_email)})
+        executor = ThreadPoolExecutor(max_workers=ENRICH_CONCURRENCY, thread_name_prefix='enrich')
+        futures = {executor.submit(enrich_email, email, deadline, enrich_rate_limiter): email
+                   for email in rows_by_email}
+        done = 0
+        complete = True
+        try:
+            for future in as_completed(futures):
+                email = futures[future]
+                try:
+                    result = future.result()
+                except (DeadlineExceeded, CircuitOpenError):
+                    complete = False  # Not looked up - the client resumes with the remaining emails
+                    continue
+                except Exception as e:
+                    result = {'error': str(e)}
+                done += 1
+                for index in rows_by_email[email]:
+                    yield event(dict(result, type='row', index=index, email=contacts[index]['email']))
+                if done % 25 == 0:
+                    yield event({'type': 'progress', 'emails_done': done, 'emails': len(rows_by_email)})
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        
+        logger.info("enrich_contacts: %d/%d emails enriched (%d rows)%s", done, len(rows_by_email), total_rows,
+                    '' if complete else ' - partial')
+        yield event({
+            'type': 'done',
+            'complete': complete,
+            'emails_done': done,
+            'emails': len(rows_by_email),
+            'degraded': degraded_upstreams()
         })
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+# ============================================
+# AI-PERSONALIZED OPENERS (bulk emails)
+# ============================================
+
+class BulkStore:
+    """SQLite (WAL) store for bulk email work shared by all workers: personalization jobs, drafts,
+    send ledger, rendered campaign spools, schedules and the sender pool"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+    
+    def reset(self):
+        self.conn = None
+        self.lock = threading.Lock()
+    
+    def connection(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute("""CREATE TABLE IF NOT EXISTS personalize_jobs (
+                id TEXT PRIMARY KEY,
+                settings TEXT NOT NULL,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                heartbeat_at REAL NOT NULL,
+                run_started_at REAL,
+                active_seconds REAL NOT NULL DEFAULT 0,
+                error TEXT
+            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS personalize_drafts (
+                job_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                email TEXT NOT NULL,
+                person TEXT NOT NULL,
+                company TEXT NOT NULL,
+                status TEXT NOT NULL,
+                text TEXT,
+                error TEXT,
+                cached INTEGER NOT NULL DEFAULT 0,
+                edited INTEGER NOT NULL DEFAULT 0,
+                prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                completion_tokens INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (job_id, idx)
+            )""")
+            # Append-only: one row per email sent (recipient is normalized, see normalize_recipient)
+            conn.execute("""CREATE TABLE IF NOT EXISTS send_ledger (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recipient TEXT NOT NULL,
+                campaign TEXT NOT NULL,
+                sender TEXT NOT NULL,
+                message_id TEXT,
+                sent_at REAL NOT NULL
+            )""")
+            conn.execute('CREATE INDEX IF NOT EXISTS send_ledger_recipient ON send_ledger (recipient, sent_at)')
+            conn.execute('CREATE INDEX IF NOT EXISTS send_ledger_campaign ON send_ledger (campaign, recipient)')
+            conn.execute('CREATE INDEX IF NOT EXISTS send_ledger_sender ON send_ledger (sender, sent_at)')
+            conn.execute("""CREATE TABLE IF NOT EXISTS campaign_spools (
+                id TEXT PRIMARY KEY,
+                campaign TEXT NOT NULL,
+                settings TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                rendered INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER NOT NULL DEFAULT 0,
+                render_seconds REAL NOT NULL DEFAULT 0,
+                complete INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            )""")
+            conn.execute("""CREATE TABLE IF NOT EXISTS scheduled_campaigns (
+                id TEXT PRIMARY KEY,
+                spool_id TEXT NOT NULL,
+                campaign TEXT NOT NULL,
+                account TEXT NOT NULL,
+                gmail_token TEXT NOT NULL,
+                send_window TEXT NOT NULL,
+                per_hour INTEGER NOT NULL,
+                rules TEXT NOT NULL,
+                start_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                next_index INTEGER NOT NULL DEFAULT 0,
+                sent INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                skipped INTEGER NOT NULL DEFAULT 0,
+                last_sent_at REAL,
+                last_error TEXT,
+                created_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )""")
+            try:  # attempts: retries of the message at next_index (databases created before it was added)
+                conn.execute('ALTER TABLE scheduled_campaigns ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0')
+            except sqlite3.OperationalError:
+                pass
+            # gmail_token: see stored_gmail_token - rows from before it kept the whole session token
+            for schedule_id, token in conn.execute("SELECT id, gmail_token FROM scheduled_campaigns "
+                                                   "WHERE gmail_token LIKE '%client_secret%'").fetchall():
+                conn.execute('UPDATE scheduled_campaigns SET gmail_token = ? WHERE id = ?',
+                             (stored_gmail_token(json.loads(token)), schedule_id))
+            conn.execute("""CREATE TABLE IF NOT EXISTS scheduled_deliveries (
+                schedule_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                email TEXT NOT NULL,
+                status TEXT NOT NULL,
+                error TEXT,
+                at REAL NOT NULL,
+                PRIMARY KEY (schedule_id, idx)
+            )""")
+            # Drip throttle per Gmail account, shared by all of its scheduled campaigns
+            conn.execute("""CREATE TABLE IF NOT EXISTS send_accounts (
+                account TEXT PRIMARY KEY,
+                next_send_at REAL NOT NULL
+            )""")
+            # Gmail accounts registered for pooled bulk sending (gmail_token: see stored_gmail_token)
+            conn.execute("""CREATE TABLE IF NOT EXISTS sender_pool (
+                account TEXT PRIMARY KEY,
+                gmail_token TEXT NOT NULL,
+                daily_quota INTEGER NOT NULL,
+                per_minute INTEGER NOT NULL,
+                enabled INTEGER NOT NULL DEFAULT 1,
+                paused_until REAL,
+                failed INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                last_error_at REAL,
+                created_at REAL NOT NULL
+            )""")
+            for account, token in conn.execute("SELECT account, gmail_token FROM sender_pool "
+                                               "WHERE gmail_token LIKE '%client_secret%'").fetchall():
+                conn.execute('UPDATE sender_pool SET gmail_token = ? WHERE account = ?',
+                             (stored_gmail_token(json.loads(token)), account))
+            # AUTOINCREMENT ids are never reused, so (COUNT, MAX(id)) changes with every add/remove
+            conn.execute("""CREATE TABLE IF NOT EXISTS suppressions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                recipient TEXT NOT NULL UNIQUE,
+                reason TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )""")
+            self.conn = conn
+        return self.conn
+    
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.connection().execute(sql, params).fetchall()
+    
+    def iterate(self, sql, params=(), batch=1000):
+        """Yield the rows of a large query batch by batch from a private connection (WAL snapshot),
+        so exports neither hold every row in memory nor block the shared connection"""
+        self.connection()  # Tables exist
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        try:
+            cursor = conn.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(batch)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+    
+    def create_job(self, settings, contacts):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.lock:
+            conn = self.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute("INSERT INTO personalize_jobs (id, settings, status, created_at, heartbeat_at) "
+                             "VALUES (?, ?, 'pending', ?, ?)", (job_id, json.dumps(settings), now, now))
+                conn.executemany(
+                    "INSERT INTO personalize_drafts (job_id, idx, email, person, company, status) "
+                    "VALUES (?, ?, ?, ?, ?, 'pending')",
+                    [(job_id, index, c['email'], c['person'], c['company']) for index, c in enumerate(contacts)])
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return job_id
+    
+    def job(self, job_id):
+        rows = self.execute('SELECT * FROM personalize_jobs WHERE id = ?', (job_id,))
+        if not rows:
+            return None
+        job = dict(rows[0])
+        job['settings'] = json.loads(job['settings'])
+        return job
+    
+    def claim(self, job_id):
+        """Mark the job running in this worker unless another live runner has it; True if claimed"""
+        now = time.time()
+        with self.lock:
+            cursor = self.connection().execute(
+                "UPDATE personalize_jobs SET status = 'running', heartbeat_at = ?, run_started_at = ?, error = NULL "
+                "WHERE id = ? AND (status NOT IN ('running', 'cancelling') OR heartbeat_at < ?)",
+                (now, now, job_id, now - PERSONALIZE_STALE_SECONDS))
+            return cursor.rowcount == 1
+    
+    def heartbeat(self, job_id):
+        """Refresh the job's heartbeat; returns its status (the API sets 'cancelling' to stop the runner)"""
+        with self.lock:
+            conn = self.connection()
+            conn.execute('UPDATE personalize_jobs SET heartbeat_at = ? WHERE id = ?', (time.time(), job_id))
+            return conn.execute('SELECT status FROM personalize_jobs WHERE id = ?', (job_id,)).fetchone()[0]
+    
+    def finish(self, job_id, status, error=None):
+        now = time.time()
+        self.execute('UPDATE personalize_jobs SET status = ?, error = ?, heartbeat_at = ?, '
+                     'active_seconds = active_seconds + (? - COALESCE(run_started_at, ?)), run_started_at = NULL '
+                     'WHERE id = ?', (status, error, now, now, now, job_id))
+    
+    def pending_drafts(self, job_id):
+        return [dict(row) for row in self.execute(
+            "SELECT idx, email, person, company FROM personalize_drafts WHERE job_id = ? AND status = 'pending' "
+            "ORDER BY idx", (job_id,))]
+    
+    def retry_failed(self, job_id):
+        self.execute("UPDATE personalize_drafts SET status = 'pending', error = NULL "
+                     "WHERE job_id = ? AND status = 'failed'", (job_id,))
+    
+    def save_draft(self, job_id, index, result):
+        if 'error' in result:
+            self.execute("UPDATE personalize_drafts SET status = 'failed', error = ? WHERE job_id = ? AND idx = ?",
+                         (result['error'], job_id, index))
+        else:
+            self.execute("UPDATE personalize_drafts SET status = 'done', text = ?, error = NULL, cached = ?, "
+                         "prompt_tokens = ?, completion_tokens = ? WHERE job_id = ? AND idx = ?",
+                         (result['text'], int(result['cached']), result['prompt_tokens'],
+                          result['completion_tokens'], job_id, index))
+    
+    def edit_draft(self, job_id, index, text):
+        """Replace a draft with the reviewer's text; False if there is no such draft"""
+        with self.lock:
+            cursor = self.connection().execute(
+                "UPDATE personalize_drafts SET text = ?, status = 'done', error = NULL, edited = 1 "
+                "WHERE job_id = ? AND idx = ?", (text, job_id, index))
+            return cursor.rowcount == 1
+    
+    def drafts(self, job_id, offset, limit):
+        return [dict(row) for row in self.execute(
+            'SELECT idx AS "index", email, person, company, status, text, error, cached, edited '
+            'FROM personalize_drafts WHERE job_id = ? ORDER BY idx LIMIT ? OFFSET ?', (job_id, limit, offset))]
+    
+    def counts(self, job_id):
+        row = self.execute(
+            "SELECT COUNT(*), "
+            "COALESCE(SUM(status = 'done'), 0), COALESCE(SUM(status = 'failed'), 0), "
+            "COALESCE(SUM(status = 'done' AND cached = 1), 0), COALESCE(SUM(edited), 0), "
+            "COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(completion_tokens), 0) "
+            "FROM personalize_drafts WHERE job_id = ?", (job_id,))[0]
+        return dict(zip(('total', 'done', 'failed', 'cached', 'edited', 'prompt_tokens', 'completion_tokens'), row))
+    
+    def openers(self, job_id):
+        """email (lowercase) -> reviewed draft text, for drafts that are done"""
+        return {row['email'].strip().lower(): row['text'] for row in self.execute(
+            "SELECT email, text FROM personalize_drafts WHERE job_id = ? AND status = 'done'", (job_id,))}
+    
+    def create_spool(self, campaign, settings, total):
+        spool_id = uuid.uuid4().hex
+        self.execute('INSERT INTO campaign_spools (id, campaign, settings, total, created_at) VALUES (?, ?, ?, ?, ?)',
+                     (spool_id, campaign, json.dumps(settings), total, time.time()))
+        return spool_id
+    
+    def spool(self, spool_id):
+        rows = self.execute('SELECT * FROM campaign_spools WHERE id = ?', (spool_id,))
+        if not rows:
+            return None
+        spool = dict(rows[0])
+        spool['settings'] = json.loads(spool['settings'])
+        spool['complete'] = bool(spool['complete'])
+        return spool
+
+
+bulk_store = BulkStore(BULK_DB_PATH)
+
+
+def reset_bulk_store_after_fork():
+    """SQLite connections and locks must not be shared with the parent process"""
+    bulk_store.reset()
+
+
+os.register_at_fork(after_in_child=reset_bulk_store_after_fork)
+
+
+def assistant_instructions(client, assistant_name):
+    """Instructions configured on an OpenAI assistant (cached) - used as the system prompt for drafts"""
+    assistant_id = ASSISTANTS[assistant_name]['id']
+    
+    def fetch():
+        with upstream_call('openai'):
+            assistant = client.beta.assistants.retrieve(assistant_id)
+        return {'instructions': assistant.instructions or ''}
+    
+    return CACHES['openai'].get_or_fetch(('assistant', assistant_id), fetch)['instructions']
+
+
+def opener_messages(settings, contact):
+    """Chat messages asking for one contact's personalized opener"""
+    system = (settings['instructions'] + '\n\n' if settings['instructions'] else '') + (
+        'Write only the personalized opening paragraph (1-3 sentences) of a B2B email to the contact below. '
+        'No greeting line, no subject, no signature.')
+    user = (f"{settings['prompt']}\n\n"
+            f"Person: {contact['person']}\nCompany: {contact['company']}\nEmail: {contact['email']}")
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': user}]
+
+
+def openai_retry_delay(error, attempt):
+    """Seconds to wait before retrying a failed OpenAI call, or None if the error is not worth retrying"""
+    import openai
+    if isinstance(error, CircuitOpenError):
+        return error.retry_after
+    if not isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)):
+        return None
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    # Exponential backoff with jitter: ~1, 2, 4, 8 ... seconds (capped at 30)
+    return min(30.0, 2 ** attempt) * random.uniform(0.5, 1.5)
+
+
+def generate_opener(client, settings, contact):
+    """One contact's opener - reused from the cache when the same contact+prompt was generated before"""
+    messages = opener_messages(settings, contact)
+    digest = hashlib.sha256(json.dumps([settings['model'], messages], sort_keys=True).encode('utf-8')).hexdigest()
+    generated = []
+    
+    def fetch():
+        for attempt in range(PERSONALIZE_MAX_RETRIES + 1):
+            try:
+                with upstream_call('openai'):
+                    completion = client.chat.completions.create(
+                        model=settings['model'], messages=messages, max_tokens=300, temperature=0.7)
+                generated.append(True)
+                usage = completion.usage
+                return {
+                    'text': completion.choices[0].message.content.strip(),
+                    'prompt_tokens': usage.prompt_tokens if usage else 0,
+                    'completion_tokens': usage.completion_tokens if usage else 0
+                }
+            except Exception as e:
+                delay = openai_retry_delay(e, attempt)
+                if delay is None or attempt == PERSONALIZE_MAX_RETRIES:
+                    raise
+                logger.info("Personalize: retrying %s in %.1fs (attempt %d): %s",
+                            contact['email'], delay, attempt + 1, e)
+                time.sleep(delay)
+    
+    result = CACHES['openai'].get_or_fetch(('opener', digest), fetch, ttl=PERSONALIZE_CACHE_DAYS * 86400)
+    if generated:
+        OPENAI_TOKENS.labels('prompt').inc(result['prompt_tokens'])
+        OPENAI_TOKENS.labels('completion').inc(result['completion_tokens'])
+        return dict(result, cached=False)
+    # Served from the cache (or another request's identical call) - no tokens spent for this draft
+    return dict(result, cached=True, prompt_tokens=0, completion_tokens=0)
+
+
+def run_personalize_job(job_id):
+    """Generate the job's pending drafts in this worker (background thread); safe to re-run after a crash"""
+    job = bulk_store.job(job_id)
+    client = get_openai_client()
+    pending = bulk_store.pending_drafts(job_id)
+    logger.info("Personalize job %s: %d drafts to generate", job_id, len(pending))
+    
+    executor = ThreadPoolExecutor(max_workers=PERSONALIZE_CONCURRENCY, thread_name_prefix='personalize')
+    futures = {executor.submit(generate_opener, client, job['settings'], contact): contact for contact in pending}
+    status = 'done'
+    try:
+        remaining = set(futures)
+        while remaining:
+            finished, remaining = wait(remaining, timeout=10, return_when=FIRST_COMPLETED)
+            for future in finished:
+                contact = futures[future]
+                try:
+                    result = future.result()
+                    PERSONALIZED_DRAFTS.labels('cached' if result['cached'] else 'generated').inc()
+                except Exception as e:
+                    PERSONALIZED_DRAFTS.labels('failed').inc()
+                    logger.warning("Personalize job %s: draft for %s failed: %s", job_id, contact['email'], e)
+                    result = {'error': str(e)}
+                bulk_store.save_draft(job_id, contact['idx'], result)
+            if bulk_store.heartbeat(job_id) == 'cancelling':
+                status = 'cancelled'
+                break
+    except Exception as e:
+        logger.exception("Personalize job %s crashed: %s", job_id, e)
+        status = 'failed'
+        bulk_store.finish(job_id, status, str(e))
+        return
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    bulk_store.finish(job_id, status)
+    logger.info("Personalize job %s: %s", job_id, status)
+
+
+def start_personalize_job(job_id):
+    """Run the job in a background thread of this worker if no live runner has it"""
+    if not bulk_store.claim(job_id):
+        return False
+    threading.Thread(target=run_personalize_job, args=(job_id,), daemon=True, name=f'personalize-{job_id[:8]}').start()
+    return True
+
+
+def personalize_job_summary(job):
+    """Progress, throughput and cost of a job"""
+    counts = bulk_store.counts(job['id'])
+    active_seconds = job['active_seconds']
+    if job['run_started_at']:
+        active_seconds += time.time() - job['run_started_at']
+    stalled = job['status'] in ('running', 'cancelling') and time.time() - job['heartbeat_at'] > PERSONALIZE_STALE_SECONDS
+    price_prompt, price_completion = PERSONALIZE_PRICE_PER_1M
+    cost = (counts['prompt_tokens'] * price_prompt + counts['completion_tokens'] * price_completion) / 1e6
+    return dict(
+        counts,
+        job_id=job['id'],
+        status=job['status'],
+        stalled=stalled,
+        error=job['error'],
+        assistant=job['settings']['assistant'],
+        model=job['settings']['model'],
+        prompt=job['settings']['prompt'],
+        pending=counts['total'] - counts['done'] - counts['failed'],
+        elapsed_seconds=round(active_seconds, 1),
+        drafts_per_minute=round(counts['done'] / active_seconds * 60, 1) if active_seconds > 0 else None,
+        estimated_cost_usd=round(cost, 4)
+    )
+
+
+@app.route('/api/personalize/jobs', methods=['POST'])
+@requires_auth
+def create_personalize_job():
+    """Start generating AI-personalized openers for the uploaded contact list"""
+    try:
+        client = get_openai_client()
+        if not client:
+            return jsonify({'error': 'OpenAI API is not configured. Please set up your API key in the Settings.'}), 400
+        
+        contacts = session.get('bulk_email_contacts', [])
+        if not contacts:
+            return jsonify({'error': 'No contacts loaded. Please upload an Excel file first.'}), 400
+        
+        data = request.get_json(silent=True) or {}
+        prompt = data.get('prompt', '').strip()
+        assistant_name = data.get('assistant', 'Marketing Expert')
+        if not prompt:
+            return jsonify({'error': 'Prompt is required'}), 400
+        if assistant_name not in ASSISTANTS:
+            return jsonify({'error': f'Unknown assistant: {assistant_name}'}), 400
         
+        # Optional selection (same as send_bulk_emails) - duplicate emails get one draft
+        selected = data.get('emails')
+        selected = {email.strip().lower() for email in selected} if selected is not None else None
+        unique = {}
+        for contact in contacts:
+            email = contact['email'].strip().lower()
+            if selected is None or email in selected:
+                unique.setdefault(email, contact)
+        if not unique:
+            return jsonify({'error': 'No contacts selected'}), 400
+        
+        settings = {
+            'prompt': prompt,
+            'assistant': assistant_name,
+            'model': PERSONALIZE_MODEL,
+            'instructions': assistant_instructions(client, assistant_name)
+        }
+        job_id = bulk_store.create_job(settings, list(unique.values()))
+        start_personalize_job(job_id)
+        return jsonify(personalize_job_summary(bulk_store.job(job_id))), 202
+    
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except DeadlineExceeded:
+        return jsonify({'error': 'OpenAI is too slow to load the assistant - try again in a moment'}), 408
+    except Exception as e:
+        logger.exception("Error in create_personalize_job: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/personalize/jobs/<job_id>', methods=['GET'])
+@requires_auth
+def get_personalize_job(job_id):
+    """Job progress plus one page of drafts for review (?offset=0&limit=50)"""
+    try:
+        job = bulk_store.job(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(200, max(1, int(request.args.get('limit', 50))))
+        return jsonify(dict(personalize_job_summary(job), offset=offset, drafts=bulk_store.drafts(job_id, offset, limit)))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/personalize/jobs/<job_id>/resume', methods=['POST'])
+@requires_auth
+def resume_personalize_job(job_id):
+    """Continue a stopped, stalled or partly failed job - only drafts that aren't done are generated"""
+    try:
+        job = bulk_store.job(job_id)
+        if job is None:
+            return jsonify({'error': 'Job not found'}), 404
+        if not get_openai_client():
+            return jsonify({'error': 'OpenAI API is not configured. Please set up your API key in the Settings.'}), 400
+        bulk_store.retry_failed(job_id)
+        started = start_personalize_job(job_id)
+        return jsonify(dict(personalize_job_summary(bulk_store.job(job_id)), started=started))
     except Exception as e:
-        print(f"Error in load_emails: {str(e)}")  # Log to console
-        import traceback
-        traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
 
-def allowed_file(filename):
-    """Check if file extension is allowed"""
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+@app.route('/api/personalize/jobs/<job_id>/cancel', methods=['POST'])
+@requires_auth
+def cancel_personalize_job(job_id):
+    """Ask the job's runner to stop (drafts generated so far are kept)"""
+    try:
+        if bulk_store.job(job_id) is None:
+            return jsonify({'error': 'Job not found'}), 404
+        bulk_store.execute("UPDATE personalize_jobs SET status = 'cancelling' WHERE id = ? AND status = 'running'",
+                           (job_id,))
+        return jsonify(personalize_job_summary(bulk_store.job(job_id)))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/personalize/jobs/<job_id>/drafts/<int:index>', methods=['PUT'])
+@requires_auth
+def edit_personalize_draft(job_id, index):
+    """Save the reviewer's version of one draft"""
+    try:
+        text = (request.get_json(silent=True) or {}).get('text', '').strip()
+        if not text:
+            return jsonify({'error': 'Draft text is required'}), 400
+        if not bulk_store.edit_draft(job_id, index, text):
+            return jsonify({'error': 'Draft not found'}), 404
+        return jsonify({'success': True, 'index': index, 'text': text})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ============================================
+# SEND LEDGER (history, dedup, unsubscribes)
+# ============================================
+
+def normalize_recipient(email):
+    """Ledger/suppression key for an email address"""
+    return email.strip().lower()
+
+
+class SendLedger:
+    """Pre-send checks against the send ledger and suppression list in bulk_store
+
+    Each worker keeps recipient -> last sent time and the suppressed set in memory and only reads
+    ledger rows it hasn't seen yet (the ledger is append-only, ids only grow), so checking a
+    100k-row list is a dict/set lookup per row.
+    """
+    
+    def __init__(self, store):
+        self.store = store
+        self.reset()
+    
+    def reset(self):
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.last_sent = {}  # recipient -> latest sent_at
+        self.suppressed = set()
+        self.suppression_version = None
+    
+    def refresh(self):
+        """Pick up rows other workers (or earlier requests) added since the last refresh"""
+        with self.lock:
+            rows = self.store.execute('SELECT id, recipient, sent_at FROM send_ledger WHERE id > ? ORDER BY id',
+                                      (self.last_id,))
+            for ledger_id, recipient, sent_at in rows:
+                if sent_at > self.last_sent.get(recipient, 0):
+                    self.last_sent[recipient] = sent_at
+                self.last_id = ledger_id
+            
+            # Suppressions can be removed too - reload the (small) set whenever it changed
+            version = tuple(self.store.execute('SELECT COUNT(*), COALESCE(MAX(id), 0) FROM suppressions')[0])
+            if version != self.suppression_version:
+                self.suppressed = {row[0] for row in self.store.execute('SELECT recipient FROM suppressions')}
+                self.suppression_version = version
+    
+    def campaign_recipients(self, campaign):
+        """Everyone the campaign was already sent to"""
+        return {row[0] for row in self.store.execute(
+            'SELECT DISTINCT recipient FROM send_ledger WHERE campaign = ?', (campaign,))}
+    
+    def skip_reason(self, recipient, campaign_recipients=None, recent_cutoff=None):
+        """Why this recipient must not be emailed (None = send); call refresh() once before a batch"""
+        if recipient in self.suppressed:
+            return 'unsubscribed'
+        if campaign_recipients is not None and recipient in campaign_recipients:
+            return 'already_sent_campaign'
+        if recent_cutoff is not None and self.last_sent.get(recipient, 0) >= recent_cutoff:
+            return 'emailed_recently'
+        return None
+    
+    def record(self, recipient, campaign, sender, message_id):
+        """Append a sent email - a failed write is logged, never fails the send that already happened"""
+        now = time.time()
+        try:
+            self.store.execute('INSERT INTO send_ledger (recipient, campaign, sender, message_id, sent_at) '
+                               'VALUES (?, ?, ?, ?, ?)', (recipient, campaign, sender or '', message_id, now))
+        except sqlite3.Error as e:
+            logger.warning("Send ledger: could not record %s: %s", recipient, e)
+            return
+        with self.lock:
+            if now > self.last_sent.get(recipient, 0):
+                self.last_sent[recipient] = now
+
+
+send_ledger = SendLedger(bulk_store)
+
+
+def reset_send_ledger_after_fork():
+    """The lock may have been held by a parent thread at fork time; workers build their own index"""
+    send_ledger.reset()
+
+
+os.register_at_fork(after_in_child=reset_send_ledger_after_fork)
 
 
-@app.route('/api/upload_excel', methods=['POST'])
-def upload_excel():
-    """Upload and parse Excel file with contact list"""
+@app.route('/api/send_history/check', methods=['POST'])
+@requires_auth
+def check_send_history():
+    """Which uploaded contacts a send would skip (unsubscribed, already in the campaign, emailed recently)"""
     try:
-        # Check if file is present
-        if 'file' not in request.files:
-            return jsonify({'error': 'No file provided'}), 400
-        
-        file = request.files['file']
-        
-        if file.filename == '':
-            return jsonify({'error': 'No file selected'}), 400
-        
-        if not allowed_file(file.filename):
-            return jsonify({'error': 'Invalid file type. Please upload .xlsx, .xls, or .csv file'}), 400
-        
-        # Save file temporarily
-        filename = secure_filename(file.filename)
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Parse Excel/CSV file
-        try:
-            if filename.endswith('.csv'):
-                df = pd.read_csv(filepath)
-            else:
-                df = pd.read_excel(filepath)
-        except Exception as e:
-            os.remove(filepath)
-            return jsonify({'error': f'Failed to parse file: {str(e)}'}), 400
-        
-        # Validate columns - look for various common column names
-        required_cols = {'company', 'person', 'email'}
-        df_cols_lower = {col.lower().strip(): col for col in df.columns}
-        
-        # Try to map columns
-        column_mapping = {}
-        
-        # Map company column
-        for possible in ['company', 'company name', 'company_name', 'ceg', 'cégnév']:
-            if possible in df_cols_lower:
-                column_mapping['company'] = df_cols_lower[possible]
-                break
-        
-        # Map person column
-        for possible in ['person', 'person name', 'person_name', 'name', 'contact', 'nev', 'név', 'kapcsolattarto', 'kapcsolattartó']:
-            if possible in df_cols_lower:
-                column_mapping['person'] = df_cols_lower[possible]
-                break
-        
-        # Map email column
-        for possible in ['email', 'e-mail', 'email address', 'email_address', 'mail']:
-            if possible in df_cols_lower:
-                column_mapping['email'] = df_cols_lower[possible]
-                break
-        
-        # Check if all required columns are found
-        if len(column_mapping) != 3:
-            missing = required_cols - set(column_mapping.keys())
-            os.remove(filepath)
-            return jsonify({
-                'error': f'Missing required columns: {", ".join(missing)}. Found columns: {", ".join(df.columns)}'
-            }), 400
-        
-        # Extract and clean data
-        contacts = []
-        for idx, row in df.iterrows():
-            company = str(row[column_mapping['company']]).strip() if pd.notna(row[column_mapping['company']]) else ''
-            person = str(row[column_mapping['person']]).strip() if pd.notna(row[column_mapping['person']]) else ''
-            email = str(row[column_mapping['email']]).strip() if pd.notna(row[column_mapping['email']]) else ''
-            
-            # Basic email validation
-            if email and '@' in email and '.' in email:
-                contacts.append({
-                    'company': company,
-                    'person': person,
-                    'email': email
-                })
-        
-        # Clean up file
-        os.remove(filepath)
+        contacts = session.get('bulk_email_contacts', [])
+        if not contacts:
+            return jsonify({'error': 'No contacts loaded. Please upload an Excel file first.'}), 400
         
-        if len(contacts) == 0:
-            return jsonify({'error': 'No valid contacts found in file'}), 400
+        data = request.get_json(silent=True) or {}
+        selected = data.get('emails')
+        if selected is not None:
+            selected = {normalize_recipient(email) for email in selected}
+        campaign = (data.get('campaign') or data.get('subject') or '').strip()
+        skip_recent_days = data.get('skip_recent_days')
+        recent_cutoff = time.time() - float(skip_recent_days) * 86400 if skip_recent_days else None
         
-        # Store contacts in session for later use
-        session['bulk_email_contacts'] = contacts
+        with timed('ledger'):
+            send_ledger.refresh()
+            campaign_recipients = send_ledger.campaign_recipients(campaign) if campaign else None
+            skipped = []
+            counts = {'unsubscribed': 0, 'already_sent_campaign': 0, 'emailed_recently': 0}
+            checked = 0
+            for index, contact in enumerate(contacts):
+                recipient = normalize_recipient(contact['email'])
+                if selected is not None and recipient not in selected:
+                    continue
+                checked += 1
+                reason = send_ledger.skip_reason(recipient, campaign_recipients, recent_cutoff)
+                if reason:
+                    counts[reason] += 1
+                    last_sent = send_ledger.last_sent.get(recipient)
+                    skipped.append({
+                        'index': index,
+                        'email': contact['email'],
+                        'reason': reason,
+                        'last_sent_at': datetime.fromtimestamp(last_sent).isoformat(timespec='minutes') if last_sent else None
+                    })
         
         return jsonify({
-            'success': True,
-            'count': len(contacts),
-            'contacts': contacts[:10],  # Return first 10 for preview
-            'total_contacts': len(contacts)
+            'checked': checked,
+            'to_send': checked - len(skipped),
+            'skipped_counts': counts,
+            'skipped': skipped
         })
-        
+    except (TypeError, ValueError):
+        return jsonify({'error': 'skip_recent_days must be a number'}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/send_bulk_emails', methods=['POST'])
-def send_bulk_emails():
-    """Send bulk emails to contact list"""
+@app.route('/api/suppressions', methods=['GET', 'POST', 'DELETE'])
+@requires_auth
+def suppressions():
+    """Unsubscribe list: GET lists it, POST {emails, reason} adds, DELETE {emails} removes"""
     try:
-        # Check if user has authorized Gmail
-        gmail_token = session.get('gmail_token')
-        if not gmail_token:
+        if request.method == 'GET':
+            rows = bulk_store.execute('SELECT recipient, reason, created_at FROM suppressions ORDER BY created_at DESC')
             return jsonify({
-                'error': 'Gmail not authorized. Please connect your Gmail account first.',
-                'needs_auth': True
-            }), 401
-        
-        # Get contacts from session
-        contacts = session.get('bulk_email_contacts', [])
-        if not contacts:
-            return jsonify({'error': 'No contacts loaded. Please upload an Excel file first.'}), 400
+                'total': len(rows),
+                'suppressions': [{'email': recipient, 'reason': reason,
+                                  'created_at': datetime.fromtimestamp(created_at).isoformat(timespec='minutes')}
+                                 for recipient, reason, created_at in rows]
+            })
         
-        # Get email template from request
-        data = request.json
-        subject_template = data.get('subject', '').strip()
-        body_template = data.get('body', '').strip()
-        sender_name = data.get('sender_name', '').strip()
-        signature = data.get('signature', '').strip()
+        data = request.get_json(silent=True) or {}
+        emails = sorted({normalize_recipient(email) for email in data.get('emails') or [] if '@' in email})
+        if not emails:
+            return jsonify({'error': 'No valid email addresses given'}), 400
         
-        if not subject_template or not body_template:
-            return jsonify({'error': 'Email subject and body are required'}), 400
+        if request.method == 'POST':
+            reason = (data.get('reason') or 'unsubscribed').strip()
+            now = time.time()
+            with bulk_store.lock:
+                bulk_store.connection().executemany(
+                    'INSERT OR REPLACE INTO suppressions (recipient, reason, created_at) VALUES (?, ?, ?)',
+                    [(email, reason, now) for email in emails])
+            logger.info("Suppressions: added %d address(es) (%s)", len(emails), reason)
+        else:
+            with bulk_store.lock:
+                bulk_store.connection().executemany('DELETE FROM suppressions WHERE recipient = ?',
+                                                    [(email,) for email in emails])
+            logger.info("Suppressions: removed %d address(es)", len(emails))
         
-        # Import Gmail libraries
+        return jsonify({'success': True, 'count': len(emails)})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ============================================
+# CAMPAIGN SPOOL (pre-rendered bulk emails)
+# ============================================
+
+class CampaignSpool:
+    """Rendered messages of one campaign: append-only data file plus a fixed-width offset index
+
+    A record is the header JSON (email, person, company, subject, html or error) followed by the
+    Gmail-ready raw message; the index holds (offset, header length, raw length) per record, so a
+    page of records is two seeks away and is read back through mmap without parsing the rest.
+    """
+    
+    INDEX_ENTRY = struct.Struct('<QII')
+    
+    def __init__(self, spool_id):
+        base = os.path.join(SPOOL_DIR, spool_id)
+        self.data_path = base + '.spool'
+        self.index_path = base + '.idx'
+    
+    def count(self):
         try:
-            from google.auth.transport.requests import Request
-            from google.oauth2.credentials import Credentials
-            from googleapiclient.discovery import build
-        except ImportError as e:
-            return jsonify({'error': f'Gmail API libraries not installed: {str(e)}'}), 400
-        
-        # Create credentials from session
-        creds = Credentials(
-            token=gmail_token['token'],
-            refresh_token=gmail_token.get('refresh_token'),
-            token_uri=gmail_token['token_uri'],
-            client_id=gmail_token['client_id'],
-            client_secret=gmail_token['client_secret'],
-            scopes=gmail_token['scopes']
-        )
-        
-        # Refresh if expired
-        if creds.expired and creds.refresh_token:
-            try:
-                creds.refresh(Request())
-                session['gmail_token']['token'] = creds.token
-            except Exception as e:
-                return jsonify({
-                    'error': 'Gmail token expired. Please reconnect your Gmail account.',
-                    'needs_auth': True
-                }), 401
-        
-        # Build Gmail service
-        service = build('gmail', 'v1', credentials=creds)
-        
-        # Get user's email address for From header
+            return os.path.getsize(self.index_path) // self.INDEX_ENTRY.size
+        except OSError:
+            return 0
+    
+    def size(self):
         try:
-            profile = service.users().getProfile(userId='me').execute()
-            user_email = profile.get('emailAddress', '')
-        except:
-            user_email = session.get('gmail_user_email', '')
-        
-        # Send emails
-        results = {
-            'success': [],
-            'failed': []
-        }
-        
-        for contact in contacts:
+            return os.path.getsize(self.data_path)
+        except OSError:
+            return 0
+    
+    def append(self, records_from):
+        """Append the (header, raw bytes) records yielded by records_from(count); returns the new count
+
+        count is the number of complete records already in the spool - a render that was cut short
+        (deadline, crash) continues from there. The index file is locked while writing.
+        """
+        os.makedirs(SPOOL_DIR, exist_ok=True)
+        entry_size = self.INDEX_ENTRY.size
+        with open(self.index_path, 'a+b') as index_file, open(self.data_path, 'a+b') as data_file:
+            if fcntl is not None:
+                fcntl.flock(index_file, fcntl.LOCK_EX)
             try:
-                # Replace placeholders in subject and body
-                subject = subject_template.replace('{{company}}', contact['company'])
-                subject = subject.replace('{{person}}', contact['person'])
-                subject = subject.replace('{{email}}', contact['email'])
-                
-                body = body_template.replace('{{company}}', contact['company'])
-                body = body.replace('{{person}}', contact['person'])
-                body = body.replace('{{email}}', contact['email'])
-                
-                # Create message
-                message = MIMEMultipart('related')
-                message['To'] = contact['email']
-                message['Subject'] = subject
-                
-                # Set From header with display name if provided
-                if sender_name and user_email:
-                    message['From'] = f'{sender_name} <{user_email}>'
-                elif user_email:
-                    message['From'] = user_email
-                
-                # Convert body to HTML with line breaks
-                html_body = body.replace('\n', '<br>')
-                
-                # Build HTML signature with logo if signature provided
-                if signature:
-                    # Replace placeholders in signature
-                    sig = signature.replace('{{company}}', contact['company'])
-                    sig = sig.replace('{{person}}', contact['person'])
-                    sig = sig.replace('{{email}}', contact['email'])
-                    
-                    # HTML signature with embedded logo (logo on top)
-                    html_signature = f'''
-                    <div style="margin-top: 20px; border-top: 1px solid #e0e0e0; padding-top: 20px;">
-                        <table cellpadding="0" cellspacing="0" border="0">
-                            <tr>
-                                <td style="text-align: left;">
-                                    <img src="cid:prv_logo" alt="PRV Logo" width="120" style="display: block; margin-bottom: 15px;">
-                                    <div style="font-family: Arial, sans-serif; font-size: 14px; line-height: 1.6; color: #333;">
-                                        {sig.replace(chr(10), '<br>')}
-                                    </div>
-                                </td>
-                            </tr>
-                        </table>
-                    </div>
-                    '''
-                    full_html = f'<html><body><div style="font-family: Arial, sans-serif; font-size: 14px; color: #333;">{html_body}</div>{html_signature}</body></html>'
-                else:
-                    full_html = f'<html><body><div style="font-family: Arial, sans-serif; font-size: 14px; color: #333;">{html_body}</div></body></html>'
-                
-                # Add HTML body
-                message.attach(MIMEText(full_html, 'html'))
-                
-                # Embed logo image if signature is provided
-                if signature:
-                    try:
-                        logo_path = 'prv.png'
-                        if os.path.exists(logo_path):
-                            with open(logo_path, 'rb') as img:
-                                logo_img = MIMEImage(img.read())
-                                logo_img.add_header('Content-ID', '<prv_logo>')
-                                logo_img.add_header('Content-Disposition', 'inline', filename='prv.png')
-                                message.attach(logo_img)
-                    except Exception as e:
-                        print(f"Warning: Could not attach logo: {e}")
-                
-                # Encode message
-                raw_message = base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
-                
-                # Send via Gmail API
-                send_result = service.users().messages().send(
-                    userId='me',
-                    body={'raw': raw_message}
-                ).execute()
-                
-                results['success'].append({
-                    'email': contact['email'],
-                    'person': contact['person'],
-                    'company': contact['company']
-                })
-                
-                # Small delay to avoid rate limiting
-                time.sleep(0.5)
+                # Drop a torn tail: partial index entry, or entries pointing past the data written
+                count = os.path.getsize(self.index_path) // entry_size
+                data_size = os.path.getsize(self.data_path)
+                end = 0
+                while count:
+                    index_file.seek((count - 1) * entry_size)
+                    offset, header_length, raw_length = self.INDEX_ENTRY.unpack(index_file.read(entry_size))
+                    end = offset + header_length + raw_length
+                    if end <= data_size:
+                        break
+                    count -= 1
+                    end = 0
+                index_file.truncate(count * entry_size)
+                data_file.truncate(end)
                 
-            except Exception as e:
-                results['failed'].append({
-                    'email': contact['email'],
-                    'person': contact['person'],
-                    'company': contact['company'],
-                    'error': str(e)
-                })
-        
-        return jsonify({
-            'success': True,
-            'results': results,
-            'total_sent': len(results['success']),
-            'total_failed': len(results['failed'])
-        })
+                for header, raw in records_from(count):
+                    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+                    data_file.write(header_bytes)
+                    data_file.write(raw)
+                    index_file.write(self.INDEX_ENTRY.pack(end, len(header_bytes), len(raw)))
+                    end += len(header_bytes) + len(raw)
+                    count += 1
+                data_file.flush()  # Data before index, so a crash leaves no entry pointing at missing data
+                index_file.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(index_file, fcntl.LOCK_UN)
+        return count
+    
+    def read(self, start, stop, with_raw=False):
+        """Records [start, stop) as (header, raw message or None) - raw is only decoded when asked for"""
+        stop = min(stop, self.count())
+        if start >= stop:
+            return []
+        entry_size = self.INDEX_ENTRY.size
+        with open(self.index_path, 'rb') as index_file:
+            index_file.seek(start * entry_size)
+            entries = list(self.INDEX_ENTRY.iter_unpack(index_file.read((stop - start) * entry_size)))
         
-    except Exception as e:
-        print(f"Error in send_bulk_emails: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        records = []
+        with open(self.data_path, 'rb') as data_file, \
+                mmap.mmap(data_file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset, header_length, raw_length in entries:
+                header = json.loads(data[offset:offset + header_length])
+                raw = None
+                if with_raw and raw_length:
+                    raw = data[offset + header_length:offset + header_length + raw_length].decode('ascii')
+                records.append((header, raw))
+        return records
+    
+    def delete(self):
+        for path in (self.data_path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
 
-def open_browser():
-    """Open browser after a short delay (local development only)"""
-    time.sleep(1.5)
-    webbrowser.open('http://localhost:5000')
+def prune_spools():
+    """Delete spools (files and rows) older than SPOOL_MAX_AGE_DAYS"""
+    cutoff = time.time() - SPOOL_MAX_AGE_DAYS * 86400
+    # Spools of campaigns still being delivered on a schedule are kept until they finish
+    for (spool_id,) in bulk_store.execute(
+            "SELECT id FROM campaign_spools WHERE created_at < ? AND id NOT IN "
+            "(SELECT spool_id FROM scheduled_campaigns WHERE status IN ('scheduled', 'paused'))", (cutoff,)):
+        CampaignSpool(spool_id).delete()
+        bulk_store.execute('DELETE FROM campaign_spools WHERE id = ?', (spool_id,))
+        logger.info("Spool %s: deleted (older than %d days)", spool_id, SPOOL_MAX_AGE_DAYS)
 
 
-# ============================================
-# MINICRM API ENDPOINTS
-# ============================================
+def spool_summary(info):
+    return {
+        'spool_id': info['id'],
+        'campaign': info['campaign'],
+        'total': info['total'],
+        'rendered': info['rendered'],
+        'failed': info['failed'],
+        'bytes': info['bytes'],
+        'render_seconds': round(info['render_seconds'], 2),
+        'complete': info['complete']
+    }
 
-@app.route('/api/minicrm/status', methods=['GET'])
-@requires_auth
-def minicrm_status():
-    """Check if MiniCRM integration is enabled"""
-    return jsonify({
-        'enabled': MINICRM_ENABLED,
-        'system_id': MINICRM_SYSTEM_ID if MINICRM_ENABLED else None
-    })
 
+# Request fields a render keeps, so resuming it (by spool_id) renders the rest the same way
+SPOOL_SETTINGS = ('subject', 'body', 'sender_name', 'signature', 'personalize_job_id', 'emails', 'campaign')
 
-@app.route('/api/minicrm/find_contact', methods=['POST'])
+
+@app.route('/api/campaigns/render', methods=['POST'])
 @requires_auth
-def minicrm_find_contact():
-    """Find contact in MiniCRM by email address"""
-    # Debug logging
-    print(f"MiniCRM find_contact called")
-    print(f"MINICRM_ENABLED: {MINICRM_ENABLED}")
-    print(f"MINICRM_SYSTEM_ID: {MINICRM_SYSTEM_ID}")
-    print(f"MINICRM_API_KEY: {'[SET]' if MINICRM_API_KEY else '[NOT SET]'}")
-    
-    if not MINICRM_ENABLED:
-        return jsonify({'error': 'MiniCRM integration not configured'}), 400
-    
+def render_campaign():
+    """Render every selected contact's message into a spool (resume a partial render with its spool_id)"""
     try:
-        data = request.json
-        email = data.get('email', '').strip()
+        if not session.get('bulk_email_contacts'):
+            return jsonify({'error': 'No contacts loaded. Please upload an Excel file first.'}), 400
         
-        if not email:
-            return jsonify({'error': 'Email address required'}), 400
+        data = request.get_json(silent=True) or {}
+        spool_id = data.get('spool_id')
+        if spool_id:
+            info = bulk_store.spool(spool_id)
+            if info is None:
+                return jsonify({'error': 'Rendered campaign not found. Please render it again.'}), 404
+            settings = info['settings']
+        else:
+            settings = {key: data.get(key) for key in SPOOL_SETTINGS}
         
-        print(f"Searching for email: {email}")
+        contacts = select_bulk_contacts(settings)
+        if not contacts:
+            return jsonify({'error': 'No contacts selected'}), 400
+        try:
+            template = bulk_template(settings)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        # MiniCRM API call to search contacts
-        auth = (MINICRM_SYSTEM_ID, MINICRM_API_KEY)
-        url = f"https://r3.minicrm.hu/Api/R3/Contact"
+        if not spool_id:
+            prune_spools()
+            campaign = (settings.get('campaign') or template['subject']).strip()
+            spool_id = bulk_store.create_spool(campaign, settings, len(contacts))
+        elif len(contacts) != bulk_store.spool(spool_id)['total']:
+            return jsonify({'error': 'The contact list changed - please render the campaign again'}), 409
         
-        # Search by email
-        params = {'Email': email}
+        user_email = session.get('gmail_user_email', '')
+        deadline = current_deadline()
+        failed = 0
         
-        print(f"Making request to: {url}")
-        print(f"Auth: System ID={MINICRM_SYSTEM_ID}")
-        print(f"Params: {params}")
+        def records_from(start):
+            nonlocal failed
+            for contact in contacts[start:]:
+                if deadline.expired():
+                    return
+                header = {'email': contact['email'], 'person': contact['person'], 'company': contact['company']}
+                try:
+                    header['subject'], header['html'], raw = render_bulk_message(contact, template, user_email)
+                    yield header, raw.encode('ascii')
+                except Exception as e:
+                    failed += 1
+                    header['error'] = str(e)
+                    yield header, b''
         
-        response = requests.get(url, auth=auth, params=params, timeout=10)
+        spool = CampaignSpool(spool_id)
+        start = time.perf_counter()
+        with timed('render'):
+            rendered = spool.append(records_from)
+        elapsed = time.perf_counter() - start
+        
+        bulk_store.execute('UPDATE campaign_spools SET rendered = ?, failed = failed + ?, bytes = ?, '
+                           'render_seconds = render_seconds + ?, complete = ? WHERE id = ?',
+                           (rendered, failed, spool.size(), elapsed, int(rendered >= len(contacts)), spool_id))
+        info = bulk_store.spool(spool_id)
+        logger.info("Spool %s: rendered %d/%d messages (%d KB) in %.1fs", spool_id, rendered, len(contacts),
+                    info['bytes'] // 1024, elapsed)
+        return jsonify(dict(spool_summary(info), degraded=degraded_upstreams()))
+    
+    except Exception as e:
+        logger.exception("Error in render_campaign: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/campaigns/<spool_id>', methods=['GET', 'DELETE'])
+@requires_auth
+def campaign_preview(spool_id):
+    """Page through a rendered campaign (?offset=0&limit=20), or DELETE it to render again"""
+    try:
+        info = bulk_store.spool(spool_id)
+        if info is None:
+            return jsonify({'error': 'Rendered campaign not found'}), 404
         
-        print(f"Response status: {response.status_code}")
-        print(f"Response content: {response.text[:200]}")  # First 200 chars
+        if request.method == 'DELETE':
+            if bulk_store.execute("SELECT 1 FROM scheduled_campaigns WHERE spool_id = ? AND status IN ('scheduled', 'paused')",
+                                  (spool_id,)):
+                return jsonify({'error': 'This campaign is scheduled - cancel the schedule first'}), 409
+            CampaignSpool(spool_id).delete()
+            bulk_store.execute('DELETE FROM campaign_spools WHERE id = ?', (spool_id,))
+            return jsonify({'success': True})
         
-        if response.status_code == 200:
-            data = response.json()
-            print(f"Response data structure: {type(data)}")
-            
-            # MiniCRM API returns: {"Count": 1, "Results": {"28261": {...}}}
-            results = data.get('Results', {})
-            count = data.get('Count', 0)
-            
-            print(f"Found {count} contacts")
-            
-            if results and count > 0:
-                # IMPORTANT: Multiple contacts with same email may exist!
-                # Each contact may be linked to different Business/Projects
-                # We need to collect ALL BusinessIds to query all projects
-                
-                all_business_ids = []
-                primary_contact = None
-                
-                for contact_id, contact in results.items():
-                    print(f"Contact #{len(all_business_ids)+1}: {contact.get('Name')} (ID: {contact_id}, BusinessId: {contact.get('BusinessId')})")
-                    
-                    business_id = contact.get('BusinessId')
-                    if business_id:
-                        all_business_ids.append(business_id)
-                    
-                    # Use first contact as primary for display
-                    if not primary_contact:
-                        primary_contact = contact
-                
-                print(f"Collected {len(all_business_ids)} unique Business IDs: {all_business_ids}")
-                
-                if not primary_contact:
-                    return jsonify({'found': False, 'message': 'No valid contact found'})
-                
-                return jsonify({
-                    'found': True,
-                    'contact': {
-                        'id': primary_contact.get('Id'),
-                        'name': primary_contact.get('Name'),
-                        'email': primary_contact.get('Email'),
-                        'company': primary_contact.get('Company'),
-                        'phone': primary_contact.get('Phone'),
-                        'business_ids': all_business_ids,  # ← ALL BusinessIds (plural)!
-                        'business_id': all_business_ids[0] if all_business_ids else None  # ← Keep for backwards compat
-                    }
-                })
-            else:
-                print("No contacts found")
-                return jsonify({'found': False, 'message': 'No contact found with this email'})
-        else:
-            error_msg = f'MiniCRM API error: {response.status_code} - {response.text[:200]}'
-            print(error_msg)
-            return jsonify({'error': error_msg}), response.status_code
+        offset = max(0, int(request.args.get('offset', 0)))
+        limit = min(100, max(1, int(request.args.get('limit', 20))))
+        records = CampaignSpool(spool_id).read(offset, offset + limit)
+        return jsonify(dict(
+            spool_summary(info),
+            offset=offset,
+            messages=[dict(header, index=index) for index, (header, _) in enumerate(records, start=offset)]
+        ))
+    except ValueError:
+        return jsonify({'error': 'offset and limit must be integers'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ============================================
+# SCHEDULED DELIVERY (send window + drip throttle)
+# ============================================
+
+def parse_send_window(window):
+    """Validate a send window {'days': [0-6, Monday = 0], 'start': 'HH:MM', 'end': 'HH:MM'} (raises ValueError)"""
+    window = dict(SCHEDULE_DEFAULT_WINDOW, **(window or {}))
+    days = sorted({int(day) for day in window['days']})
+    if not days or any(day < 0 or day > 6 for day in days):
+        raise ValueError('Send window days must be 0 (Monday) to 6 (Sunday)')
+    start = datetime.strptime(window['start'], '%H:%M').time()
+    end = datetime.strptime(window['end'], '%H:%M').time()
+    if start >= end:
+        raise ValueError('Send window must end after it starts')
+    return {'days': days, 'start': window['start'], 'end': window['end']}
+
+
+def window_bounds(timestamp, window):
+    """(open, close) timestamps of the first send window that hasn't closed yet at `timestamp`"""
+    local = datetime.fromtimestamp(timestamp, SCHEDULE_TIMEZONE)
+    start = datetime.strptime(window['start'], '%H:%M').time()
+    end = datetime.strptime(window['end'], '%H:%M').time()
+    for day_offset in range(8):
+        day = local.date() + timedelta(days=day_offset)
+        if day.weekday() not in window['days']:
+            continue
+        opens = datetime.combine(day, start, tzinfo=SCHEDULE_TIMEZONE).timestamp()
+        closes = datetime.combine(day, end, tzinfo=SCHEDULE_TIMEZONE).timestamp()
+        if closes > timestamp:
+            return opens, closes
+    raise ValueError('Send window has no days')
+
+
+def next_send_time(schedule, account_next_send_at, now):
+    """Earliest time the campaign may send its next message (start time, window, account throttle)"""
+    earliest = max(now, schedule['start_at'], account_next_send_at)
+    opens, _ = window_bounds(earliest, schedule['send_window'])
+    return max(earliest, opens)
+
+
+def estimate_finish(schedule, account_next_send_at, now):
+    """When the remaining messages will have gone out at per_hour inside the window (assumes the account
+    isn't shared with another running campaign)"""
+    remaining = schedule['total'] - schedule['next_index']
+    if remaining <= 0:
+        return None
+    interval = 3600 / schedule['per_hour']
+    t = next_send_time(schedule, account_next_send_at, now)
+    while True:
+        opens, closes = window_bounds(t, schedule['send_window'])
+        t = max(t, opens)
+        fits = int((closes - t) // interval) + 1  # Sends at t, t + interval, ... before the window closes
+        if remaining <= fits:
+            return t + (remaining - 1) * interval
+        remaining -= fits
+        t = closes
+
+
+def load_schedule(row):
+    schedule = dict(row)
+    schedule['send_window'] = json.loads(schedule['send_window'])
+    schedule['rules'] = json.loads(schedule['rules'])
+    return schedule
+
+
+def account_next_send_at(account):
+    rows = bulk_store.execute('SELECT next_send_at FROM send_accounts WHERE account = ?', (account,))
+    return rows[0][0] if rows else 0
+
+
+def schedule_summary(schedule):
+    """Progress and ETA of a scheduled campaign (gmail_token left out)"""
+    now = time.time()
+    next_at = account_next_send_at(schedule['account'])
+    eta = next_send = None
+    if schedule['status'] == 'scheduled' and schedule['next_index'] < schedule['total']:
+        next_send = next_send_time(schedule, next_at, now)
+        eta = estimate_finish(schedule, next_at, now)
     
-    except requests.exceptions.Timeout:
-        print("MiniCRM API timeout")
-        return jsonify({'error': 'MiniCRM API timeout'}), 408
-    except Exception as e:
-        print(f"Error finding contact: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f'{type(e).__name__}: {str(e)}'}), 500
+    def local_time(timestamp):
+        return datetime.fromtimestamp(timestamp, SCHEDULE_TIMEZONE).isoformat(timespec='minutes') if timestamp else None
+    
+    return {
+        'schedule_id': schedule['id'],
+        'spool_id': schedule['spool_id'],
+        'campaign': schedule['campaign'],
+        'account': schedule['account'],
+        'status': schedule['status'],
+        'total': schedule['total'],
+        'processed': schedule['next_index'],
+        'sent': schedule['sent'],
+        'failed': schedule['failed'],
+        'skipped': schedule['skipped'],
+        'per_hour': schedule['per_hour'],
+        'send_window': schedule['send_window'],
+        'timezone': str(SCHEDULE_TIMEZONE),
+        'start_at': local_time(schedule['start_at']),
+        'next_send_at': local_time(next_send),
+        'eta': local_time(eta),
+        'last_sent_at': local_time(schedule['last_sent_at']),
+        'last_error': schedule['last_error']
+    }
 
 
-@app.route('/api/minicrm/get_todos', methods=['POST'])
-@requires_auth
-def minicrm_get_todos():
-    """Get todos (tasks) for a contact from MiniCRM"""
-    print(f"MiniCRM get_todos endpoint called")
+class DeliveryScheduler:
+    """Releases scheduled campaign messages to Gmail: inside the send window, one message per account
+    every 3600 / per_hour seconds
+
+    Every worker runs the thread, but only the one holding the scheduler lock file sends - when that
+    worker exits the OS drops its lock and another worker takes over. All progress is in bulk_store,
+    so a restart continues where the last message left off.
+    """
     
-    if not MINICRM_ENABLED:
-        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+    def __init__(self):
+        self.reset()
     
-    try:
-        data = request.json
-        business_id = data.get('business_id')
-        business_ids = data.get('business_ids', [])  # NEW: Accept multiple BusinessIds!
-        contact_name = data.get('contact_name', 'Unknown')
-        category_id = data.get('category_id')  # Optional: filter by Termék (Product/Category)
-        filter_user = data.get('filter_user')  # Optional: filter by assigned user
-        include_closed = data.get('include_closed', False)  # Optional: include closed/completed todos
+    def reset(self):
+        self.pid = None
+        self.lock_file = None
+        self.services = {}  # schedule id -> Gmail service (keeps the refreshed access token)
+        self.wake = threading.Event()
+    
+    def start(self):
+        """Start this process's scheduler thread (idempotent)"""
+        if self.pid == os.getpid():
+            return
+        self.reset()
+        self.pid = os.getpid()
+        threading.Thread(target=self.run, daemon=True, name='delivery-scheduler').start()
+    
+    def is_leader(self):
+        if fcntl is None:
+            return True
+        if self.lock_file is None:
+            path = os.path.join(os.path.dirname(os.path.abspath(BULK_DB_PATH)), 'scheduler.lock')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            lock_file = open(path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self.lock_file = lock_file  # Held (open) for the life of this worker
+            logger.info("Delivery scheduler: running in worker %d", os.getpid())
+        return True
+    
+    def run(self):
+        while True:
+            delay = SCHEDULE_POLL_SECONDS
+            try:
+                if self.is_leader():
+                    delay = self.tick()
+            except Exception as e:
+                logger.exception("Delivery scheduler error: %s", e)
+            self.wake.wait(delay)
+            self.wake.clear()
+    
+    def tick(self):
+        """Send whatever is due now; return seconds until something is due next"""
+        now = time.time()
+        next_due = now + SCHEDULE_POLL_SECONDS
+        rows = bulk_store.execute("SELECT * FROM scheduled_campaigns WHERE status = 'scheduled' ORDER BY created_at")
+        for row in rows:
+            schedule = load_schedule(row)
+            due = next_send_time(schedule, account_next_send_at(schedule['account']), now)
+            if due <= now:
+                self.send_next(schedule)
+                due = next_send_time(schedule, account_next_send_at(schedule['account']), time.time())
+            next_due = min(next_due, due)
+        return max(0.5, next_due - time.time())
+    
+    def service(self, schedule):
+        service = self.services.get(schedule['id'])
+        if service is None:
+            from googleapiclient.discovery import build
+            service = build_gmail_service(build, stored_gmail_credentials(schedule['gmail_token']))
+            self.services[schedule['id']] = service
+        return service
+    
+    def send_next(self, schedule):
+        """Send the campaign's next sendable message (skipped ones are passed over) and advance it"""
+        spool = CampaignSpool(schedule['spool_id'])
+        rules = schedule['rules']
+        send_ledger.refresh()
+        campaign_recipients = (send_ledger.campaign_recipients(schedule['campaign'])
+                               if rules.get('skip_sent_in_campaign', True) else None)
+        recent_cutoff = time.time() - float(rules['skip_recent_days']) * 86400 if rules.get('skip_recent_days') else None
         
-        # Support both single business_id and multiple business_ids
-        if not business_ids and business_id:
-            business_ids = [business_id]
+        index = schedule['next_index']
+        while index < schedule['total']:
+            header, raw_message = spool.read(index, index + 1, with_raw=True)[0]
+            recipient = normalize_recipient(header['email'])
+            reason = send_ledger.skip_reason(recipient, campaign_recipients, recent_cutoff)
+            if reason or header.get('error'):
+                status = 'skipped' if reason else 'failed'
+                self.advance(schedule['id'], index, header['email'], status, reason or header['error'])
+                index += 1
+                continue
+            
+            try:
+                send_result = gmail_execute(self.service(schedule).users().messages().send(
+                    userId='me',
+                    body={'raw': raw_message}
+                ))
+            except CircuitOpenError as e:
+                # Gmail is failing - hold this account back until the breaker may let calls through
+                self.throttle(schedule['account'], time.time() + e.retry_after)
+                return
+            except Exception as e:
+                status_code = getattr(getattr(e, 'resp', None), 'status', None)
+                if status_code in (401, 403) or type(e).__name__ == 'RefreshError':
+                    # Needs the user: reconnecting Gmail and resuming the schedule stores a fresh token
+                    bulk_store.execute("UPDATE scheduled_campaigns SET status = 'paused', last_error = ? WHERE id = ?",
+                                       (f'Gmail authorization failed - reconnect Gmail and resume ({e})', schedule['id']))
+                    self.services.pop(schedule['id'], None)
+                    logger.warning("Schedule %s: paused, Gmail authorization failed: %s", schedule['id'], e)
+                    return
+                attempts = schedule['attempts'] + 1
+                retryable = status_code == 429 or (status_code or 0) >= 500
+                if retryable and attempts < SCHEDULE_MAX_ATTEMPTS:
+                    # Quota/transient - retry the same message in the next slot
+                    bulk_store.execute('UPDATE scheduled_campaigns SET attempts = ?, last_error = ? WHERE id = ?',
+                                       (attempts, f'{header["email"]}: attempt {attempts} failed ({e})', schedule['id']))
+                    self.throttle(schedule['account'], time.time() + 3600 / schedule['per_hour'])
+                    return
+                error = f'Gave up after {attempts} attempts: {e}' if retryable else str(e)
+                bulk_store.execute('UPDATE scheduled_campaigns SET last_error = ? WHERE id = ?',
+                                   (f'{header["email"]}: {error}', schedule['id']))
+                BULK_EMAILS.labels('failed').inc()
+                self.advance(schedule['id'], index, header['email'], 'failed', error)
+                self.throttle(schedule['account'], time.time() + 3600 / schedule['per_hour'])
+                return
+            
+            BULK_EMAILS.labels('sent').inc()
+            send_ledger.record(recipient, schedule['campaign'], schedule['account'], send_result.get('id'))
+            self.advance(schedule['id'], index, header['email'], 'sent')
+            self.throttle(schedule['account'], time.time() + 3600 / schedule['per_hour'])
+            return
         
-        if not business_ids:
-            return jsonify({'error': 'Business ID(s) required to find projects and todos'}), 400
+        bulk_store.execute("UPDATE scheduled_campaigns SET status = 'done' WHERE id = ? AND status = 'scheduled'",
+                           (schedule['id'],))
+        self.services.pop(schedule['id'], None)
+        logger.info("Schedule %s: all %d messages processed", schedule['id'], schedule['total'])
+    
+    def advance(self, schedule_id, index, email, status, error=None):
+        """Record one processed message and move the campaign past it"""
+        now = time.time()
+        with bulk_store.lock:
+            conn = bulk_store.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('INSERT OR REPLACE INTO scheduled_deliveries VALUES (?, ?, ?, ?, ?, ?)',
+                             (schedule_id, index, email, status, error, now))
+                counter = {'sent': 'sent', 'failed': 'failed', 'skipped': 'skipped'}[status]
+                conn.execute(f'UPDATE scheduled_campaigns SET next_index = ?, {counter} = {counter} + 1, attempts = 0, '
+                             'last_sent_at = CASE WHEN ? THEN ? ELSE last_sent_at END WHERE id = ?',
+                             (index + 1, status == 'sent', now, schedule_id))
+                conn.execute("UPDATE scheduled_campaigns SET status = 'done' "
+                             "WHERE id = ? AND next_index >= total AND status = 'scheduled'", (schedule_id,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    
+    def throttle(self, account, next_send_at):
+        bulk_store.execute('INSERT OR REPLACE INTO send_accounts (account, next_send_at) VALUES (?, ?)',
+                           (account, next_send_at))
+
+
+delivery_scheduler = DeliveryScheduler()
+
+
+@app.before_request
+def ensure_delivery_scheduler():
+    """Start the scheduler thread in this process (the dev server; gunicorn workers start it in post_worker_init)"""
+    delivery_scheduler.start()
+
+
+@app.route('/api/campaigns/<spool_id>/schedule', methods=['POST'])
+@requires_auth
+def schedule_campaign(spool_id):
+    """Deliver a rendered campaign on a schedule: {start_at, send_window, per_hour, skip rules}"""
+    try:
+        gmail_token = session.get('gmail_token')
+        account = session.get('gmail_user_email')
+        if not gmail_token or not account:
+            return jsonify({
+                'error': 'Gmail not authorized. Please connect your Gmail account first.',
+                'needs_auth': True
+            }), 401
         
-        print(f"Getting todos for {len(business_ids)} Business ID(s): {business_ids} (Contact: {contact_name}, Category: {category_id or 'All'}, Filter User: {filter_user or 'All'}, Include Closed: {include_closed})")
+        info = bulk_store.spool(spool_id)
+        if info is None:
+            return jsonify({'error': 'Rendered campaign not found. Please render it again.'}), 404
+        if not info['complete']:
+            return jsonify({'error': 'The campaign is still being rendered'}), 409
         
-        auth = (MINICRM_SYSTEM_ID, MINICRM_API_KEY)
+        data = request.get_json(silent=True) or {}
+        try:
+            send_window = parse_send_window(data.get('send_window'))
+            per_hour = int(data.get('per_hour') or SCHEDULE_DEFAULT_PER_HOUR)
+            if not 1 <= per_hour <= 3600:
+                raise ValueError('per_hour must be between 1 and 3600')
+            start_at = time.time()
+            if data.get('start_at'):
+                # Naive times are local to SCHEDULE_TIMEZONE (e.g. '2026-03-02T09:00' from a datetime-local input)
+                start = datetime.fromisoformat(data['start_at'])
+                if start.tzinfo is None:
+                    start = start.replace(tzinfo=SCHEDULE_TIMEZONE)
+                start_at = max(start_at, start.timestamp())
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
         
-        # Step 1: Get all Projects for ALL Business IDs
-        # MiniCRM structure: Contact → Business → Projects → ToDoList
-        # Multiple contacts with same email = multiple BusinessIds to check!
-        projects_url = f"https://r3.minicrm.hu/Api/R3/Project"
+        rules = {
+            'skip_sent_in_campaign': data.get('skip_sent_in_campaign', True),
+            'skip_recent_days': data.get('skip_recent_days')
+        }
+        schedule_id = uuid.uuid4().hex
+        bulk_store.execute(
+            'INSERT INTO scheduled_campaigns (id, spool_id, campaign, account, gmail_token, send_window, per_hour, '
+            "rules, start_at, status, total, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'scheduled', ?, ?)",
+            (schedule_id, spool_id, (data.get('campaign') or info['campaign']).strip(), account,
+             stored_gmail_token(gmail_token), json.dumps(send_window), per_hour, json.dumps(rules), start_at,
+             CampaignSpool(spool_id).count(), time.time()))
+        delivery_scheduler.wake.set()
         
-        all_projects_results = {}
+        schedule = load_schedule(bulk_store.execute('SELECT * FROM scheduled_campaigns WHERE id = ?', (schedule_id,))[0])
+        logger.info("Schedule %s: %d messages from %s, %d/hour", schedule_id, schedule['total'], account, per_hour)
+        return jsonify(schedule_summary(schedule)), 201
+    except Exception as e:
+        logger.exception("Error in schedule_campaign: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/schedules', methods=['GET'])
+@requires_auth
+def list_schedules():
+    """Scheduled campaigns with progress and ETA (newest first)"""
+    try:
+        rows = bulk_store.execute('SELECT * FROM scheduled_campaigns ORDER BY created_at DESC LIMIT 50')
+        return jsonify({'schedules': [schedule_summary(load_schedule(row)) for row in rows]})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/schedules/<schedule_id>', methods=['GET'])
+@requires_auth
+def get_schedule(schedule_id):
+    """One scheduled campaign, with its failed and skipped messages"""
+    try:
+        rows = bulk_store.execute('SELECT * FROM scheduled_campaigns WHERE id = ?', (schedule_id,))
+        if not rows:
+            return jsonify({'error': 'Schedule not found'}), 404
+        problems = bulk_store.execute(
+            "SELECT idx, email, status, error FROM scheduled_deliveries WHERE schedule_id = ? AND status != 'sent' "
+            "ORDER BY idx LIMIT 500", (schedule_id,))
+        return jsonify(dict(schedule_summary(load_schedule(rows[0])),
+                            problems=[{'index': idx, 'email': email, 'status': status, 'error': error}
+                                      for idx, email, status, error in problems]))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/schedules/<schedule_id>/<action>', methods=['POST'])
+@requires_auth
+def update_schedule(schedule_id, action):
+    """pause, resume (also stores the current Gmail token) or cancel a scheduled campaign"""
+    try:
+        rows = bulk_store.execute('SELECT * FROM scheduled_campaigns WHERE id = ?', (schedule_id,))
+        if not rows:
+            return jsonify({'error': 'Schedule not found'}), 404
         
-        for business_id in business_ids:
-            projects_params = {'MainContactId': business_id}
-            
-            # Add CategoryId filter if specified (to get only ACS or PCS projects)
-            if category_id:
-                projects_params['CategoryId'] = category_id
-                print(f"Getting projects for business {business_id}: {projects_url}?MainContactId={business_id}&CategoryId={category_id}")
-            else:
-                print(f"Getting projects for business {business_id}: {projects_url}?MainContactId={business_id} (all categories)")
-            
+        if action == 'pause':
+            bulk_store.execute("UPDATE scheduled_campaigns SET status = 'paused' WHERE id = ? AND status = 'scheduled'",
+                               (schedule_id,))
+        elif action == 'cancel':
+            bulk_store.execute("UPDATE scheduled_campaigns SET status = 'cancelled' "
+                               "WHERE id = ? AND status IN ('scheduled', 'paused')", (schedule_id,))
+        elif action == 'resume':
+            gmail_token = session.get('gmail_token')
+            if gmail_token and session.get('gmail_user_email') == rows[0]['account']:
+                bulk_store.execute('UPDATE scheduled_campaigns SET gmail_token = ? WHERE id = ?',
+                                   (stored_gmail_token(gmail_token), schedule_id))
+            bulk_store.execute("UPDATE scheduled_campaigns SET status = 'scheduled', last_error = NULL "
+                               "WHERE id = ? AND status = 'paused'", (schedule_id,))
+        else:
+            return jsonify({'error': f'Unknown action: {action}'}), 400
+        
+        delivery_scheduler.wake.set()
+        rows = bulk_store.execute('SELECT * FROM scheduled_campaigns WHERE id = ?', (schedule_id,))
+        return jsonify(schedule_summary(load_schedule(rows[0])))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ============================================
+# GMAIL SENDER POOL (multi-account bulk sending)
+# ============================================
+
+SENDER_POOL_STRATEGIES = ('round_robin', 'quota')
+
+
+def switch_from_header(raw_message, sender_name, account):
+    """A pre-rendered raw message with its From header set to the pool account that sends it"""
+    from email import message_from_bytes
+    message = message_from_bytes(base64.urlsafe_b64decode(raw_message))
+    del message['From']
+    message['From'] = f'{sender_name} <{account}>' if sender_name else account
+    return base64.urlsafe_b64encode(message.as_bytes()).decode('utf-8')
+
+
+class SenderPool:
+    """Gmail accounts registered for pooled bulk sending (bulk_store.sender_pool)
+
+    Quota use is counted from the send ledger over a rolling 24 hours (as Gmail counts it), so all
+    workers see the same numbers. Each worker keeps one Gmail client and rate limiter per account.
+    """
+    
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.lock = threading.Lock()
+        self.clients = {}  # account -> ((token JSON, per_minute), service, rate limiter, client lock)
+    
+    def accounts(self):
+        """Registered accounts with their send stats"""
+        now = time.time()
+        accounts = []
+        for row in bulk_store.execute('SELECT * FROM sender_pool ORDER BY created_at'):
+            account = dict(row)
+            sent_24h = bulk_store.execute('SELECT COUNT(*) FROM send_ledger WHERE sender = ? AND sent_at >= ?',
+                                          (account['account'], now - 86400))[0][0]
+            sent_total, last_sent_at = bulk_store.execute(
+                'SELECT COUNT(*), MAX(sent_at) FROM send_ledger WHERE sender = ?', (account['account'],))[0]
+            account.update({
+                'enabled': bool(account['enabled']),
+                'sent_24h': sent_24h,
+                'remaining': max(0, account['daily_quota'] - sent_24h),
+                'sent_total': sent_total,
+                'last_sent_at': last_sent_at
+            })
+            account['available'] = (account['enabled'] and account['remaining'] > 0
+                                    and (account['paused_until'] or 0) <= now)
+            accounts.append(account)
+        return accounts
+    
+    def client(self, account):
+        """(Gmail service, rate limiter, lock) for an account - rebuilt only when its token or rate changes"""
+        key = (account['gmail_token'], account['per_minute'])
+        with self.lock:
+            cached = self.clients.get(account['account'])
+            if cached is None or cached[0] != key:
+                from googleapiclient.discovery import build
+                service = build_gmail_service(build, stored_gmail_credentials(account['gmail_token']))
+                cached = (key, service, RateLimiter(account['per_minute'] / 60, burst=1), threading.Lock())
+                self.clients[account['account']] = cached
+            return cached[1:]
+    
+    @staticmethod
+    def allocate(accounts, slots, strategy):
+        """Which account sends each of the next `slots` messages (smooth weighted round robin)
+
+        'round_robin' gives every account an equal share, 'quota' shares in proportion to the
+        remaining daily quota; no account gets more than its remaining quota.
+        """
+        remaining = {a['account']: a['remaining'] for a in accounts}
+        current = dict.fromkeys(remaining, 0)
+        plan = []
+        for _ in range(slots):
+            weights = {account: (left if strategy == 'quota' else 1) for account, left in remaining.items() if left > 0}
+            if not weights:
+                break
+            for account, weight in weights.items():
+                current[account] += weight
+            chosen = max(weights, key=current.get)
+            current[chosen] -= sum(weights.values())
+            remaining[chosen] -= 1
+            plan.append(chosen)
+        return plan
+    
+    def send_batch(self, account, items, prepare):
+        """Send one account's share of a round, in order, at the account's rate
+
+        Returns (index, status, detail) per message: 'sent' (Gmail message id), 'failed' (error) or
+        'unsent' ('circuit' = Gmail is failing, 'account' = this account can't send right now).
+        """
+        service, limiter, lock = self.client(account)
+        outcomes = []
+        for position, (index, contact, raw_message) in enumerate(items):
             try:
-                projects_response = requests.get(projects_url, auth=auth, params=projects_params, timeout=10)
-                
-                print(f"Projects response status for Business {business_id}: {projects_response.status_code}")
-                
-                if projects_response.status_code == 200:
-                    projects_data = projects_response.json()
-                    projects_results = projects_data.get('Results', {})
-                    projects_count = projects_data.get('Count', 0)
-                    
-                    print(f"Found {projects_count} projects for business {business_id}")
-                    print(f"FULL Projects response for Business {business_id}: {projects_response.text}")
-                    
-                    # Handle both dict and list response formats
-                    if isinstance(projects_results, dict):
-                        # Dict format: {"12651": {...}, "12690": {...}}
-                        # WARNING: Search results may not include CategoryId!
-                        # Need to fetch full project details if CategoryId missing
-                        
-                        for project_id_str, project_info in projects_results.items():
-                            project_id = project_info.get('Id')
-                            project_category = project_info.get('CategoryId')
-                            
-                            print(f"  Project search result: {project_info.get('Name')} (ID: {project_id}, CategoryId: {project_category or 'NOT IN SEARCH RESULT'})")
-                            
-                            # If CategoryId not in search result and we have a filter, fetch full details
-                            if not project_category and category_id:
-                                project_url = project_info.get('Url')
-                                if project_url:
-                                    try:
-                                        print(f"    Fetching full project details from: {project_url}")
-                                        full_project_response = requests.get(project_url, auth=auth, timeout=10)
-                                        if full_project_response.status_code == 200:
-                                            full_project_info = full_project_response.json()
-                                            project_category = full_project_info.get('CategoryId')
-                                            print(f"    Full project CategoryId: {project_category}")
-                                            
-                                            # Update project_info with full data
-                                            project_info = full_project_info
-                                    except Exception as e:
-                                        print(f"    Error fetching full project: {str(e)}")
-                            
-                            # Only add if CategoryId matches filter (or no filter)
-                            if not category_id or str(project_category) == str(category_id):
-                                all_projects_results[project_id_str] = project_info
-                                print(f"    ✅ Added to results (CategoryId match or no filter)")
-                            else:
-                                print(f"    ❌ Skipped (CategoryId {project_category} != filter {category_id})")
-                    
-                    elif isinstance(projects_results, list):
-                        # List format: [{...}, {...}]
-                        print(f"  Projects returned as list (count: {len(projects_results)})")
-                        for project_info in projects_results:
-                            project_id = project_info.get('Id')
-                            if project_id:
-                                all_projects_results[str(project_id)] = project_info
-                                print(f"  Project: {project_info.get('Name')} (ID: {project_id}, CategoryId: {project_info.get('CategoryId', 'N/A')}, BusinessId: {business_id})")
-                    else:
-                        print(f"  Warning: Unexpected projects_results type: {type(projects_results)}")
-                else:
-                    print(f"Failed to get projects for business {business_id}: {projects_response.status_code}")
+                raw_message = prepare(contact, raw_message, account['account'])
+                limiter.acquire()
+                with lock:  # The client's HTTP connection is not thread-safe
+                    send_result = gmail_execute(service.users().messages().send(
+                        userId='me',
+                        body={'raw': raw_message}
+                    ))
+                outcomes.append((index, 'sent', send_result.get('id')))
+            except CircuitOpenError:
+                outcomes.extend((i, 'unsent', 'circuit') for i, _, _ in items[position:])
+                break
             except Exception as e:
-                print(f"Error getting projects for business {business_id}: {str(e)}")
-                continue
-        
-        total_projects = len(all_projects_results)
-        print(f"Total projects found across {len(business_ids)} Business ID(s): {total_projects}")
-        
-        if total_projects == 0:
-            print("No projects found for any business")
-            return jsonify({'success': True, 'todos': [], 'message': 'No projects found'})
-        
-        # Step 2: Get todos from all projects
-        all_todos = []
-        
-        for project_id_str, project_info in all_projects_results.items():
-            project_id = project_info.get('Id')
-            project_name = project_info.get('Name')
-            
-            print(f"Getting todos for project: {project_name} (ID: {project_id})")
+                status_code = getattr(getattr(e, 'resp', None), 'status', None)
+                if status_code in (401, 403) or type(e).__name__ == 'RefreshError':
+                    # Needs the user: connecting the account again and re-adding it stores a fresh token
+                    self.set_error(account['account'], f'Gmail authorization failed - reconnect and add again ({e})',
+                                   disable=True)
+                elif status_code == 429:
+                    # Gmail's own limit for this account was hit - rest it for an hour
+                    self.set_error(account['account'], f'Gmail rate limit reached ({e})', pause_seconds=3600)
+                else:
+                    outcomes.append((index, 'failed', str(e)))
+                    continue
+                outcomes.extend((i, 'unsent', 'account') for i, _, _ in items[position:])
+                break
+        return outcomes
+    
+    def set_error(self, account, error, disable=False, pause_seconds=0):
+        now = time.time()
+        bulk_store.execute('UPDATE sender_pool SET failed = failed + 1, last_error = ?, last_error_at = ?, '
+                           'enabled = CASE WHEN ? THEN 0 ELSE enabled END, paused_until = ? WHERE account = ?',
+                           (error, now, disable, now + pause_seconds if pause_seconds else None, account))
+        logger.warning("Sender pool: %s: %s", account, error)
+
+
+sender_pool = SenderPool()
+
+
+def reset_sender_pool_after_fork():
+    """Gmail clients (and their connections) are not shared with the parent process"""
+    sender_pool.reset()
+
+
+os.register_at_fork(after_in_child=reset_sender_pool_after_fork)
+
+
+def send_with_sender_pool(messages, prepare, strategy, campaign, campaign_recipients, recent_cutoff, results):
+    """Send bulk messages over the available pool accounts in parallel rounds
+
+    messages yields (index, (contact, raw message or None)); prepare(contact, raw_message, account)
+    returns what that account sends. Each round gives every account up to SENDER_POOL_ROUND messages
+    and waits for all of them, and the deadline is checked between rounds, so everything before the
+    returned next_index has been processed. Messages an account could not send (rate limit, revoked
+    authorization) move to the next round on the other accounts.
+
+    Returns (next_index, per-account counts, pool_exhausted).
+    """
+    accounts = {a['account']: a for a in sender_pool.accounts() if a['available']}
+    stats = {account: {'sent': 0, 'failed': 0} for account in accounts}
+    deadline = current_deadline()
+    pending = iter(messages)
+    carried = []  # Heap of (index, (contact, raw message)) taken from `pending` but not processed yet
+    
+    def take():
+        return heapq.heappop(carried) if carried else next(pending, None)
+    
+    def result_row(contact, **extra):
+        return dict({'email': contact['email'], 'person': contact['person'], 'company': contact['company']}, **extra)
+    
+    # First guess for a round's duration: the slowest account sending its full share
+    round_seconds = (SENDER_POOL_ROUND * 60 / min(a['per_minute'] for a in accounts.values())) if accounts else 0
+    executor = ThreadPoolExecutor(max_workers=max(1, len(accounts)), thread_name_prefix='sender-pool')
+    try:
+        while True:
+            item = take()
+            if item is None:
+                return None, stats, False
+            heapq.heappush(carried, item)
+            if deadline.remaining() < round_seconds:
+                return item[0], stats, False
+            plan = SenderPool.allocate(accounts.values(), SENDER_POOL_ROUND * len(accounts), strategy)
+            if not plan:
+                return item[0], stats, True  # Every account is out of quota (or paused)
             
-            # MiniCRM API call to get todos for this project
-            # Correct endpoint: /Api/R3/ToDoList/{project_id}
-            # Status parameter: Open (only active todos), Closed (completed), or All (default)
-            url = f"https://r3.minicrm.hu/Api/R3/ToDoList/{project_id}"
-            todo_params = {}
+            # Fill the round's slots in list order; skipped rows don't use one
+            batches = {}
+            for account in plan:
+                while True:
+                    item = take()
+                    if item is None:
+                        break
+                    index, (contact, raw_message) = item
+                    recipient = normalize_recipient(contact['email'])
+                    reason = send_ledger.skip_reason(recipient, campaign_recipients, recent_cutoff)
+                    if reason:
+                        BULK_EMAILS.labels('skipped').inc()
+                        results['skipped'].append(result_row(contact, reason=reason))
+                        continue
+                    if contact.get('error'):  # Could not be rendered
+                        BULK_EMAILS.labels('failed').inc()
+                        results['failed'].append(result_row(contact, error=contact['error']))
+                        continue
+                    if campaign_recipients is not None:
+                        campaign_recipients.add(recipient)  # Duplicate rows later in the list are skipped
+                    batches.setdefault(account, []).append((index, contact, raw_message))
+                    break
+                if item is None:
+                    break
             
-            # Determine which todos to fetch based on include_closed flag
-            if include_closed:
-                # Fetch ALL todos (Open + Closed) - don't specify Status param
-                print(f"Making TODO request to: {url} (All - Open + Closed)")
-            else:
-                # Fetch only Open/active todos
-                todo_params['Status'] = 'Open'
-                print(f"Making TODO request to: {url}?Status=Open (Active only)")
+            started = time.monotonic()
+            futures = [executor.submit(sender_pool.send_batch, accounts[account], batch, prepare)
+                       for account, batch in batches.items()]
+            outcomes = {}
+            for (account, batch), future in zip(batches.items(), futures):
+                for (index, contact, raw_message), (_, status, detail) in zip(batch, future.result()):
+                    outcomes[index] = (account, contact, raw_message, status, detail)
+            round_seconds = max(round_seconds, time.monotonic() - started)
             
-            try:
-                response = requests.get(url, auth=auth, params=todo_params, timeout=10)
-                
-                print(f"TODO Response status: {response.status_code}")
-                print(f"TODO Response content: {response.text[:500]}")
-                
-                if response.status_code == 200:
-                    todo_data = response.json()
-                    print(f"Todos response type: {type(todo_data)}")
-                    
-                    # MiniCRM API returns: {"Count": N, "Results": [{...}, {...}]} or {"Count": N, "Results": {"id1": {...}}}
-                    results = todo_data.get('Results', {})
-                    count = todo_data.get('Count', 0)
-                    
-                    print(f"Found {count} todos for project {project_name}")
-                    
-                    # Handle both dict and list response formats
-                    if isinstance(results, dict):
-                        todo_items = results.values()
-                    else:
-                        todo_items = results
-                    
-                    # Collect unique UserIds for debugging
-                    unique_user_ids = set()
-                    for todo in todo_items:
-                        user_id = todo.get('UserId')
-                        if user_id:
-                            unique_user_ids.add(user_id)
-                    
-                    print(f"Unique UserIds in project {project_name}: {unique_user_ids}")
-                    
-                    # Format todos for frontend
-                    for todo in todo_items:
-                        # Filter by user if specified
-                        todo_user_id = todo.get('UserId', '')
-                        
-                        # If filter_user is set, only include todos assigned to that user
-                        if filter_user and todo_user_id:
-                            # UserId in MiniCRM is typically a NUMERIC ID
-                            # User may enter either:
-                            # 1. Numeric ID (e.g., "120420")
-                            # 2. User name (will NOT match numeric UserId!)
-                            
-                            is_match = False
-                            
-                            # Try numeric comparison first
-                            try:
-                                if str(todo_user_id) == str(filter_user):
-                                    is_match = True
-                            except:
-                                pass
-                            
-                            # If still no match and both are strings, try case-insensitive
-                            if not is_match and isinstance(todo_user_id, str) and isinstance(filter_user, str):
-                                if todo_user_id.strip().lower() == filter_user.strip().lower():
-                                    is_match = True
-                            
-                            if not is_match:
-                                print(f"Filtered out todo {todo.get('Id')}: UserId {todo_user_id} != filter {filter_user}")
-                                continue  # Skip this todo
-                        
-                        formatted_todo = {
-                            'id': todo.get('Id'),
-                            'title': todo.get('Comment') or todo.get('Title') or todo.get('Name', 'Névtelen teendő'),
-                            'description': todo.get('Description', ''),
-                            'deadline': todo.get('Deadline') or todo.get('DueDate'),
-                            'status': todo.get('Status', 'Active'),
-                            'completed': todo.get('Status') == 'Closed',
-                            'project_name': project_name,
-                            'project_id': project_id,
-                            'assigned_to': todo_user_id  # Include assigned user for debugging
-                        }
-                        all_todos.append(formatted_todo)
-                    
+            circuit_open = False
+            for index in sorted(outcomes):
+                account, contact, raw_message, status, detail = outcomes[index]
+                recipient = normalize_recipient(contact['email'])
+                if status == 'sent':
+                    BULK_EMAILS.labels('sent').inc()
+                    send_ledger.record(recipient, campaign, account, detail)
+                    stats[account]['sent'] += 1
+                    accounts[account]['remaining'] -= 1
+                    results['success'].append(result_row(contact, sender=account))
+                    continue
+                if campaign_recipients is not None:
+                    campaign_recipients.discard(recipient)
+                if status == 'failed':
+                    BULK_EMAILS.labels('failed').inc()
+                    stats[account]['failed'] += 1
+                    results['failed'].append(result_row(contact, sender=account, error=detail))
                 else:
-                    print(f"Failed to get todos for project {project_id}: {response.status_code}")
-                    
-            except Exception as e:
-                print(f"Error getting todos for project {project_id}: {str(e)}")
-                continue
+                    heapq.heappush(carried, (index, (contact, raw_message)))
+                    circuit_open = circuit_open or detail == 'circuit'
+                    if detail == 'account':
+                        accounts[account]['remaining'] = 0  # Out of the pool for the rest of this request
+            if circuit_open:
+                return carried[0][0], stats, False
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@app.route('/api/sender_pool', methods=['GET', 'POST'])
+@requires_auth
+def sender_pool_accounts():
+    """List the pool accounts with send stats, or add (update) the connected Gmail account"""
+    try:
+        if request.method == 'POST':
+            gmail_token = session.get('gmail_token')
+            account = session.get('gmail_user_email')
+            if not gmail_token or not account:
+                return jsonify({
+                    'error': 'Gmail not authorized. Please connect your Gmail account first.',
+                    'needs_auth': True
+                }), 401
+            data = request.get_json(silent=True) or {}
+            daily_quota = int(data.get('daily_quota') or SENDER_POOL_DAILY_QUOTA)
+            per_minute = int(data.get('per_minute') or SENDER_POOL_PER_MINUTE)
+            if daily_quota < 1 or per_minute < 1:
+                return jsonify({'error': 'daily_quota and per_minute must be positive'}), 400
+            bulk_store.execute(
+                'INSERT INTO sender_pool (account, gmail_token, daily_quota, per_minute, created_at) '
+                'VALUES (?, ?, ?, ?, ?) ON CONFLICT (account) DO UPDATE SET gmail_token = excluded.gmail_token, '
+                'daily_quota = excluded.daily_quota, per_minute = excluded.per_minute, enabled = 1, '
+                'last_error = NULL, paused_until = NULL',
+                (account, stored_gmail_token(gmail_token), daily_quota, per_minute, time.time()))
         
-        print(f"Total todos found across all projects: {len(all_todos)}")
+        accounts = sender_pool.accounts()
+        for account in accounts:
+            del account['gmail_token']
+        return jsonify({
+            'accounts': accounts,
+            'available': sum(a['available'] for a in accounts),
+            'remaining': sum(a['remaining'] for a in accounts if a['available'])
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/api/sender_pool/<path:account>', methods=['DELETE'])
+@requires_auth
+def remove_sender_pool_account(account):
+    """Remove an account (and its stored token) from the pool; its send history stays in the ledger"""
+    try:
+        bulk_store.execute('DELETE FROM sender_pool WHERE account = ?', (account,))
+        return jsonify({'success': True})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+# ============================================
+# CHAT TRANSCRIPTS (local conversation history)
+# ============================================
+
+class TranscriptStore:
+    """Chat conversations (session -> OpenAI thread) and their messages, in SQLite (WAL) shared by all workers
+
+    Messages are stored as they are seen - the user's when it is posted, the assistant's by listing
+    only the thread messages after the newest stored one - so reloading a conversation never calls OpenAI.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self.reset()
+    
+    def reset(self):
+        self.conn = None
+        self.lock = threading.Lock()
+        self.pruned_at = 0
+    
+    def connection(self):
+        if self.conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            # last_message_id: newest OpenAI message stored - the `after` cursor for the next fetch
+            # owner: the Basic auth user who started it ('' when auth is off), see chat_owner
+            conn.execute("""CREATE TABLE IF NOT EXISTS conversations (
+                session_id TEXT PRIMARY KEY,
+                thread_id TEXT NOT NULL,
+                assistant TEXT,
+                last_message_id TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                owner TEXT NOT NULL DEFAULT ''
+            )""")
+            try:
+                conn.execute("ALTER TABLE conversations ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            except sqlite3.OperationalError:
+                pass  # Created with the column (or already migrated)
+            conn.execute('CREATE INDEX IF NOT EXISTS conversations_updated ON conversations (updated_at)')
+            conn.execute("""CREATE TABLE IF NOT EXISTS transcript_messages (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                message_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                run_id TEXT,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (session_id, seq),
+                UNIQUE (session_id, message_id)
+            )""")
+            self.conn = conn
+        return self.conn
+    
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.connection().execute(sql, params).fetchall()
+    
+    def conversation(self, session_id):
+        rows = self.execute('SELECT * FROM conversations WHERE session_id = ?', (session_id,))
+        return dict(rows[0]) if rows else None
+    
+    def start(self, session_id, thread_id, assistant, owner):
+        now = time.time()
+        self.execute('INSERT OR REPLACE INTO conversations (session_id, thread_id, assistant, created_at, updated_at, owner) '
+                     'VALUES (?, ?, ?, ?, ?, ?)', (session_id, thread_id, assistant, now, now, owner))
+        self.prune()
+    
+    def append(self, session_id, messages, assistant=None):
+        """Store thread messages (oldest first; already stored ones are ignored), keeping the newest
+        CONVERSATION_MAX_MESSAGES"""
+        if not messages:
+            return
+        with self.lock:
+            conn = self.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM transcript_messages WHERE session_id = ?',
+                                   (session_id,)).fetchone()[0]
+                for message in messages:
+                    # Only stored rows take a seq - gaps would make the trim below keep too few
+                    seq += conn.execute('INSERT OR IGNORE INTO transcript_messages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                        (session_id, seq + 1, message['id'], message['role'], message['content'],
+                                         message['run_id'], message['created_at'])).rowcount
+                conn.execute('DELETE FROM transcript_messages WHERE session_id = ? AND seq <= ?',
+                             (session_id, seq - CONVERSATION_MAX_MESSAGES))
+                conn.execute('UPDATE conversations SET last_message_id = ?, updated_at = ?, '
+                             'assistant = COALESCE(?, assistant) WHERE session_id = ?',
+                             (messages[-1]['id'], time.time(), assistant, session_id))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    
+    def run_reply(self, session_id, run_id):
+        """The newest assistant message a run added (None if it isn't stored)"""
+        rows = self.execute("SELECT content FROM transcript_messages WHERE session_id = ? AND run_id = ? "
+                            "AND role = 'assistant' ORDER BY seq DESC LIMIT 1", (session_id, run_id))
+        return rows[0]['content'] if rows else None
+    
+    def messages(self, session_id, limit, order='asc', after=None):
+        """One page of a transcript, like the OpenAI list API: (messages, has_more); `after` is a message id"""
+        op, direction = ('>', 'ASC') if order == 'asc' else ('<', 'DESC')
+        sql = 'SELECT * FROM transcript_messages WHERE session_id = ?'
+        params = [session_id]
+        if after:
+            sql += f' AND seq {op} (SELECT seq FROM transcript_messages WHERE session_id = ? AND message_id = ?)'
+            params += [session_id, after]
+        rows = self.execute(f'{sql} ORDER BY seq {direction} LIMIT ?', params + [limit + 1])
+        return [dict(row) for row in rows[:limit]], len(rows) > limit
+    
+    def delete(self, session_id):
+        with self.lock:
+            conn = self.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM transcript_messages WHERE session_id = ?', (session_id,))
+                conn.execute('DELETE FROM conversations WHERE session_id = ?', (session_id,))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+    
+    def prune(self):
+        """Delete conversations idle for CONVERSATION_RETENTION_DAYS (at most once an hour per worker)"""
+        now = time.time()
+        if now - self.pruned_at < 3600:
+            return
+        self.pruned_at = now
+        cutoff = now - CONVERSATION_RETENTION_DAYS * 86400
+        with self.lock:
+            conn = self.connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM transcript_messages WHERE session_id IN '
+                             '(SELECT session_id FROM conversations WHERE updated_at < ?)', (cutoff,))
+                deleted = conn.execute('DELETE FROM conversations WHERE updated_at < ?', (cutoff,)).rowcount
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        if deleted:
+            logger.info("Transcripts: pruned %d idle conversation(s)", deleted)
+
+
+transcripts = TranscriptStore(CONVERSATION_DB_PATH)
+
+
+def reset_transcripts_after_fork():
+    """SQLite connections must not cross fork() - each worker opens its own"""
+    transcripts.reset()
+
+
+os.register_at_fork(after_in_child=reset_transcripts_after_fork)
+
+
+def chat_owner():
+    """Who a conversation belongs to: the Basic auth user ('' when auth is off)"""
+    return request.authorization.username if BASIC_AUTH_USERS and request.authorization else ''
+
+
+def owned_conversation(session_id):
+    """(conversation or None, error response or None) - someone else's session looks like a missing one"""
+    if not session_id:
+        return None, (jsonify({'error': 'session_id is required'}), 400)
+    conversation = transcripts.conversation(session_id)
+    if conversation is not None and conversation['owner'] != chat_owner():
+        return None, (jsonify({'error': 'Conversation not found'}), 404)
+    return conversation, None
+
+
+def transcript_entry(message):
+    """Stored form of an OpenAI thread message (its text parts)"""
+    return {
+        'id': message.id,
+        'role': message.role,
+        'content': '\n'.join(part.text.value for part in message.content if part.type == 'text'),
+        'run_id': message.run_id,
+        'created_at': message.created_at
+    }
+
+
+def thread_messages_after(client, thread_id, after, page_size=100):
+    """Thread messages newer than message `after` (None = all), oldest first"""
+    messages = []
+    while True:
+        cursor = {'after': after} if after else {}
+        with upstream_call('openai'):
+            page = client.beta.threads.messages.list(thread_id=thread_id, order='asc', limit=page_size, **cursor)
+        messages.extend(page.data)
+        if len(page.data) < page_size:
+            return messages
+        after = page.data[-1].id
+
+
+@app.route('/api/conversation/<session_id>', methods=['GET'])
+@requires_auth
+def get_conversation(session_id):
+    """Stored chat history of a session (?limit=50&order=asc|desc&after=<message id>)"""
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+        order = request.args.get('order', 'asc')
+        if order not in ('asc', 'desc'):
+            return jsonify({'error': 'order must be asc or desc'}), 400
         
+        conversation, error = owned_conversation(session_id)
+        if error:
+            return error
+        if conversation is None:
+            return jsonify({'error': 'Conversation not found'}), 404
+        messages, has_more = transcripts.messages(session_id, limit, order, request.args.get('after'))
         return jsonify({
-            'success': True,
-            'todos': all_todos,
-            'count': len(all_todos)
+            'session_id': session_id,
+            'assistant': conversation['assistant'],
+            'messages': [{
+                'id': m['message_id'],
+                'role': m['role'],
+                'content': m['content'],
+                'created_at': m['created_at']
+            } for m in messages],
+            'first_id': messages[0]['message_id'] if messages else None,
+            'last_id': messages[-1]['message_id'] if messages else None,
+            'has_more': has_more
         })
-    
-    except requests.exceptions.Timeout:
-        return jsonify({'error': 'MiniCRM API timeout'}), 408
     except Exception as e:
-        print(f"Error getting todos: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/minicrm/update_todo', methods=['POST'])
-@requires_auth
-def minicrm_update_todo():
-    """Update todo comment and/or deadline in MiniCRM"""
-    if not MINICRM_ENABLED:
-        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+# ============================================
+# PRE-CREATED CHAT THREADS (first-message latency)
+# ============================================
+
+class PrewarmedThreads:
+    """A few empty OpenAI threads per worker, created in the background and handed to new chat
+    sessions - their first message skips the threads.create() round-trip
+
+    Threads older than OPENAI_THREAD_POOL_TTL are not handed out; they are deleted and replaced.
+    """
     
-    try:
-        data = request.json
-        todo_id = data.get('todo_id')
-        comment = data.get('comment')
-        deadline = data.get('deadline')
-        
-        if not todo_id:
-            return jsonify({'error': 'Todo ID required'}), 400
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.reset()
+    
+    def reset(self):
+        self.pid = None
+        self.lock = threading.Lock()
+        self.threads = deque()  # (thread id, created at), oldest first
+        self.expired = []  # Thread ids to delete
+        self.wake = threading.Event()
+    
+    def start(self):
+        """Start this process's refill thread (idempotent; no-op without OpenAI or with size 0)"""
+        if self.pid == os.getpid() or self.size <= 0 or not HAS_OPENAI:
+            return
+        self.reset()
+        self.pid = os.getpid()
+        threading.Thread(target=self.run, daemon=True, name='openai-thread-pool').start()
+    
+    def take(self):
+        """A fresh thread id for a new session, or None if the pool is empty (the caller creates one)"""
+        with self.lock:
+            self.drop_expired()
+            thread_id = self.threads.popleft()[0] if self.threads else None
+        OPENAI_THREAD_POOL.labels('hit' if thread_id else 'miss').inc()
+        self.wake.set()  # Top the pool up again
+        return thread_id
+    
+    def drop_expired(self):
+        now = time.time()
+        while self.threads and now - self.threads[0][1] >= self.ttl:
+            self.expired.append(self.threads.popleft()[0])
+    
+    def run(self):
+        while True:
+            delay = 60
+            try:
+                delay = self.refill()
+            except CircuitOpenError as e:
+                delay = e.retry_after
+            except Exception as e:
+                logger.warning("OpenAI thread pool: refill failed: %s", e)
+                delay = 30
+            self.wake.wait(delay)
+            self.wake.clear()
+    
+    def refill(self):
+        """Replace expired threads and top the pool up; return seconds until the oldest one expires"""
+        client = get_openai_client()
+        if client is None:
+            return 300
+        with self.lock:
+            self.drop_expired()
+            expired, self.expired = self.expired, []
+        for thread_id in expired:
+            try:
+                with upstream_call('openai'):
+                    client.beta.threads.delete(thread_id)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                logger.info("OpenAI thread pool: could not delete expired thread %s: %s", thread_id, e)
         
-        if not comment and not deadline:
-            return jsonify({'error': 'At least comment or deadline must be provided'}), 400
+        while len(self.threads) < self.size:
+            with upstream_call('openai'):
+                thread = client.beta.threads.create()
+            with self.lock:
+                self.threads.append((thread.id, time.time()))
         
-        # MiniCRM API call to update todo
-        # Correct endpoint: /Api/R3/ToDo/{todo_id} (capital D!)
-        auth = (MINICRM_SYSTEM_ID, MINICRM_API_KEY)
-        url = f"https://r3.minicrm.hu/Api/R3/ToDo/{todo_id}"
+        with self.lock:
+            oldest = self.threads[0][1] if self.threads else time.time()
+        return max(1, oldest + self.ttl - time.time())
+
+
+prewarmed_threads = PrewarmedThreads(OPENAI_THREAD_POOL_SIZE, OPENAI_THREAD_POOL_TTL)
+
+
+def reset_prewarmed_threads_after_fork():
+    """Threads are per worker - a child starts with an empty pool (and its own refill thread)"""
+    prewarmed_threads.reset()
+
+
+os.register_at_fork(after_in_child=reset_prewarmed_threads_after_fork)
+
+
+@app.before_request
+def ensure_prewarmed_threads():
+    """Fill the pool in this process from its first request on, before anyone sends a chat message"""
+    prewarmed_threads.start()
+
+
+# ============================================
+# EMAIL HISTORY SUMMARIES (chat context)
+# ============================================
+
+SUMMARY_INSTRUCTIONS = (
+    'You summarize the email history between PRV (a corporate publication company; messages marked KÜLDTEM '
+    'were sent by PRV, KAPTAM were received) and one business contact, for a sales assistant who will write '
+    'the next reply. Cover: who the contact is, what was offered or asked, commitments and prices, open '
+    'questions, the latest status and the tone of the conversation. At most 200 words, in the language of '
+    'the emails. Only facts from the emails.')
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) - for savings reports, not billing"""
+    return len(text) // 4
+
+
+def email_history_text(emails):
+    """Emails as load_emails returns them (newest first) as prompt text, oldest first"""
+    parts = []
+    for email in reversed(emails):
+        body = email['body'] or ''
+        if len(body) > EMAIL_SUMMARY_MAX_BODY:
+            body = body[:EMAIL_SUMMARY_MAX_BODY] + '...'
+        parts.append(f"{email['direction']} | {email['date']} | {email['subject']}\nFrom: {email['from']}\n\n{body}")
+    return '\n\n---\n\n'.join(parts)
+
+
+def summarize_email_history(client, emails, previous_summary=None):
+    """OpenAI summary of emails; with previous_summary only these (new) emails are sent to update it"""
+    if previous_summary:
+        user = (f'Current summary:\n{previous_summary}\n\nNew emails since then:\n\n{email_history_text(emails)}\n\n'
+                'Return the updated summary.')
+    else:
+        user = f'Email history:\n\n{email_history_text(emails)}'
+    with upstream_call('openai'):
+        completion = client.chat.completions.create(
+            model=EMAIL_SUMMARY_MODEL,
+            messages=[{'role': 'system', 'content': SUMMARY_INSTRUCTIONS}, {'role': 'user', 'content': user}],
+            max_tokens=500,
+            temperature=0.2
+        )
+    usage = completion.usage
+    return {
+        'summary': completion.choices[0].message.content.strip(),
+        'prompt_tokens': usage.prompt_tokens if usage else 0,
+        'completion_tokens': usage.completion_tokens if usage else 0
+    }
+
+
+@app.route('/api/email_summary', methods=['POST'])
+@requires_auth
+def email_summary():
+    """Compact summary of a contact's loaded email history (load_emails message ids) for chat context
+
+    Cached per set of messages; when new messages arrive, the contact's last summary is updated with
+    only those instead of summarizing the whole history again.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        contact = (data.get('email') or '').strip().lower()
+        message_ids = [str(message_id) for message_id in data.get('message_ids') or []]
+        if not contact or not message_ids:
+            return jsonify({'error': 'email and message_ids are required'}), 400
         
-        # Build update payload with only provided fields
-        update_data = {}
-        if comment:
-            update_data['Comment'] = comment
-        if deadline:
-            update_data['Deadline'] = deadline
+        client = get_openai_client()
+        if not client:
+            return jsonify({'error': 'OpenAI API is not configured. Please set up your API key in the Settings.'}), 400
+        mailbox = session.get('gmail_user_email')
+        if not mailbox:
+            return jsonify({
+                'error': 'Gmail not authorized. Please connect your Gmail account first.',
+                'needs_auth': True
+            }), 401
         
-        print(f"Updating MiniCRM todo {todo_id}: {update_data}")
+        # load_emails cached every message it returned (parsed) - the summary never calls Gmail
+        emails = [CACHES['gmail'].get(('message', mailbox, message_id)) for message_id in message_ids]
+        if any(email is None for email in emails):
+            return jsonify({'error': 'Some emails are no longer cached - please load the email history again'}), 409
         
-        response = requests.put(url, auth=auth, json=update_data, timeout=10)
+        cache = CACHES['openai']
+        ttl = EMAIL_SUMMARY_CACHE_DAYS * 86400
+        digest = hashlib.sha256('\n'.join(sorted(message_ids)).encode('utf-8')).hexdigest()
+        latest_key = ('email_summary_latest', mailbox, contact)
+        fetched = []
+        generated = []
         
-        if response.status_code == 200:
-            changes = []
-            if comment:
-                changes.append('text')
-            if deadline:
-                changes.append('deadline')
+        def fetch():
+            fetched.append(True)
+            previous = cache.get(latest_key)
+            new_emails = [e for e in emails if not previous or e['id'] not in previous['message_ids']]
+            if previous and not new_emails:
+                # Everything here is already covered by the contact's latest summary
+                return {'summary': previous['summary'], 'mode': 'covered'}
             
-            return jsonify({
-                'success': True,
-                'message': f'Todo updated successfully ({", ".join(changes)})!',
-                'todo_id': todo_id
-            })
-        else:
-            print(f"MiniCRM update error: {response.status_code} - {response.text}")
-            return jsonify({'error': f'MiniCRM API error: {response.status_code}'}), response.status_code
+            incremental = previous is not None and len(new_emails) < len(emails)
+            result = summarize_email_history(client, new_emails, previous['summary'] if incremental else None)
+            covered = sorted(set(previous['message_ids']) | set(message_ids)) if incremental else sorted(message_ids)
+            cache.set(latest_key, {'summary': result['summary'], 'message_ids': covered}, ttl)
+            generated.append(result)
+            return {'summary': result['summary'], 'mode': 'incremental' if incremental else 'full',
+                    'new_messages': len(new_emails)}
+        
+        result = cache.get_or_fetch(('email_summary', mailbox, contact, digest), fetch, ttl=ttl)
+        usage = generated[0] if generated else {'prompt_tokens': 0, 'completion_tokens': 0}
+        mode = result['mode'] if fetched else 'cached'
+        EMAIL_SUMMARIES.labels(mode).inc()
+        OPENAI_TOKENS.labels('prompt').inc(usage['prompt_tokens'])
+        OPENAI_TOKENS.labels('completion').inc(usage['completion_tokens'])
+        
+        # What pasting the emails themselves would cost vs the summary
+        context_tokens = estimate_tokens(email_history_text(emails))
+        summary_tokens = estimate_tokens(result['summary'])
+        return jsonify({
+            'email': contact,
+            'summary': result['summary'],
+            'mode': mode,
+            'messages': len(emails),
+            'new_messages': result.get('new_messages', 0) if fetched else 0,
+            'context_tokens': context_tokens,
+            'summary_tokens': summary_tokens,
+            'saved_tokens': max(0, context_tokens - summary_tokens),
+            'openai_tokens': {'prompt': usage['prompt_tokens'], 'completion': usage['completion_tokens']}
+        })
     
-    except requests.exceptions.Timeout:
-        return jsonify({'error': 'MiniCRM API timeout'}), 408
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except DeadlineExceeded:
+        # Waited for the same summary being generated by another request - it is cached once done
+        return jsonify({'error': 'The summary is still being generated - try again in a moment'}), 408
     except Exception as e:
-        print(f"Error updating todo: {str(e)}")
+        logger.exception("Error in email_summary: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/minicrm/update_todo_deadline', methods=['POST'])
+# ============================================
+# SPREADSHEET EXPORTS (streamed CSV / XLSX)
+# ============================================
+
+EXPORT_CHUNK_BYTES = 64 * 1024
+EXPORT_MIMETYPES = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+}
+# Spreadsheet apps evaluate CSV cells starting with these as formulas
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def csv_chunks(header, rows):
+    """Rows as UTF-8 CSV (with BOM, so Excel reads the accents) in ~EXPORT_CHUNK_BYTES pieces"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write('\ufeff')
+    writer.writerow(header)
+    for row in rows:
+        writer.writerow(["'" + value if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES) else value
+                         for value in row])
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def xlsx_chunks(header, rows, title):
+    """Rows as an XLSX workbook in EXPORT_CHUNK_BYTES pieces
+    
+    openpyxl's write-only mode streams rows into a temporary sheet file (inline strings, no
+    shared-string table), so memory stays flat; a zip can't be produced incrementally, so the
+    finished workbook is saved to a temporary file and streamed from there."""
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+    
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title)
+    sheet.append(header)
+    
+    def cell(value):
+        if not isinstance(value, str):
+            return value
+        value = ILLEGAL_CHARACTERS_RE.sub('', value)
+        if not value.startswith('='):
+            return value
+        text = WriteOnlyCell(sheet, value)
+        text.data_type = 's'  # Keep '=...' text from becoming a formula
+        return text
+    
+    for row in rows:
+        sheet.append([cell(value) for value in row])
+    
+    with tempfile.TemporaryFile() as f:
+        workbook.save(f)
+        f.seek(0)
+        for chunk in iter(lambda: f.read(EXPORT_CHUNK_BYTES), b''):
+            yield chunk
+
+
+def export_response(export_format, filename, header, rows, title):
+    """Streamed download of rows (any iterable) - nothing is built in memory up front"""
+    if export_format == 'xlsx':
+        chunks = xlsx_chunks(header, rows, title)
+    else:
+        chunks = csv_chunks(header, rows)
+    name = secure_filename(filename) or 'export'
+    response = Response(chunks, mimetype=EXPORT_MIMETYPES[export_format])
+    response.headers['Content-Disposition'] = f'attachment; filename="{name}.{export_format}"'
+    return response
+
+
+def export_format_arg(value):
+    """Validated format= parameter (default csv)"""
+    export_format = (value or 'csv').lower()
+    if export_format not in EXPORT_MIMETYPES:
+        raise ValueError(f"format must be one of: {', '.join(EXPORT_MIMETYPES)}")
+    return export_format
+
+
+def parse_minicrm_time(value):
+    """MiniCRM 'YYYY-MM-DD HH:MM:SS' as a datetime (a real date cell in XLSX), else unchanged"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return value
+
+
+def local_datetime(timestamp):
+    """Unix time as a naive datetime in SCHEDULE_TIMEZONE (XLSX cells can't hold a timezone)"""
+    return datetime.fromtimestamp(timestamp, SCHEDULE_TIMEZONE).replace(tzinfo=None, microsecond=0) if timestamp else None
+
+
+@app.route('/api/export/daily_todos', methods=['POST'])
 @requires_auth
-def minicrm_update_todo_deadline():
-    """Update deadline of a todo in MiniCRM (legacy endpoint, redirects to update_todo)"""
-    if not MINICRM_ENABLED:
-        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+def export_daily_todos():
+    """The daily todo list the user loaded (body: {todos, format}) as CSV or XLSX
     
+    The client already has the full list (loading it takes several resumed scans), so the
+    export reuses it instead of scanning MiniCRM again."""
     try:
-        data = request.json
-        todo_id = data.get('todo_id')
-        new_deadline = data.get('deadline')
+        data = request.get_json(silent=True) or {}
+        try:
+            export_format = export_format_arg(data.get('format'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        todos = data.get('todos')
+        # Rows are written after the 200 is sent - reject bad input while an error can still be returned
+        if not isinstance(todos, list) or not all(isinstance(todo, dict) for todo in todos):
+            return jsonify({'error': 'todos must be a list of todo objects'}), 400
         
-        if not todo_id or not new_deadline:
-            return jsonify({'error': 'Todo ID and deadline required'}), 400
+        today_str = datetime.now().strftime('%Y-%m-%d')
         
-        # Redirect to new update_todo endpoint
-        data['comment'] = None  # Only update deadline
-        return minicrm_update_todo()
-    
+        def rows():
+            for todo in todos:
+                deadline = str(todo.get('Deadline') or '')
+                status = ('overdue' if deadline[:10] < today_str else 'today') if deadline else ''
+                yield (parse_minicrm_time(deadline), status,
+                       todo.get('project_name'), todo.get('project_id'), todo.get('Id'), todo.get('UserId'),
+                       todo.get('Comment'))
+        
+        return export_response(export_format, f"daily-todos-{today_str}",
+                               ['Deadline', 'Status', 'Project', 'Project ID', 'Todo ID', 'User ID', 'Comment'],
+                               rows(), 'Daily todos')
     except Exception as e:
-        print(f"Error updating todo deadline: {str(e)}")
+        logger.exception("Error in export_daily_todos: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/api/minicrm/daily_todos', methods=['POST'])
+@app.route('/api/export/send_results', methods=['GET'])
 @requires_auth
-def minicrm_daily_todos():
-    """Get all overdue and today's todos from selected category"""
-    if not MINICRM_ENABLED:
-        return jsonify({'error': 'MiniCRM integration not configured'}), 400
+def export_send_results():
+    """Bulk-send results as CSV or XLSX, streamed from the bulk store
     
+    ?campaign=... - every email sent in the campaign (send ledger);
+    ?schedule_id=... - every delivery of a scheduled campaign, including failed and skipped ones."""
     try:
-        data = request.json
-        category_id = data.get('category_id')  # ACS: 23, PCS: 41
-        filter_user_id = data.get('filter_user')
-        lookback_days = data.get('lookback_days', 30)  # Default: only fetch projects updated in last 30 days
-        
-        print(f"MiniCRM daily_todos called")
-        print(f"Category: {category_id}, Filter User: {filter_user_id}, Lookback Days: {lookback_days}")
-        
-        auth = (MINICRM_SYSTEM_ID, MINICRM_API_KEY)
-        
-        # Step 1: Calculate UpdatedSince date (optimization: only fetch recently updated projects)
-        from datetime import datetime, date, timedelta
-        updated_since_date = datetime.now() - timedelta(days=lookback_days)
-        updated_since_str = updated_since_date.strftime('%Y-%m-%d %H:%M:%S')
-        
-        # Step 2: Get ALL projects in the category that were updated recently (with pagination)
-        projects_url = f"https://r3.minicrm.hu/Api/R3/Project"
-        projects_params = {
-            'UpdatedSince': updated_since_str  # Only fetch recently updated projects
-        }
-        if category_id:
-            projects_params['CategoryId'] = category_id
-        
-        print(f"Fetching projects updated since {updated_since_str}: {projects_url}")
-        print(f"Params: {projects_params}")
-        
-        # Fetch all pages (API returns max 100 per page)
-        all_projects = {}
-        page = 0
-        
-        while True:
-            projects_params['Page'] = page
-            print(f"Fetching page {page}...")
-            
-            try:
-                projects_response = requests.get(projects_url, auth=auth, params=projects_params, timeout=45)
-                
-                if projects_response.status_code != 200:
-                    print(f"❌ Error fetching projects page {page}: {projects_response.status_code} - {projects_response.text}")
-                    break
-                
-                projects_data = projects_response.json()
-                projects_results = projects_data.get('Results', {})
-                
-                if not projects_results:
-                    # No more results
-                    print(f"✓ Page {page}: No more results (end of pagination)")
-                    break
-                
-                print(f"✓ Page {page}: Found {len(projects_results)} projects")
-                all_projects.update(projects_results)
-                
-                # If we got less than 100, this is the last page
-                if len(projects_results) < 100:
-                    print(f"✓ Last page reached (page {page} had {len(projects_results)} < 100 projects)")
-                    break
-                
-                page += 1
-                
-                # Safety limit: max 10 pages (1000 projects)
-                if page >= 10:
-                    print("⚠️ Warning: Reached 10 pages (1000 projects). Stopping pagination.")
-                    break
-                    
-            except requests.exceptions.Timeout:
-                print(f"⏱️ Timeout fetching page {page} - continuing with {len(all_projects)} projects fetched so far")
-                break
-            except Exception as e:
-                print(f"❌ Error on page {page}: {str(e)} - continuing with {len(all_projects)} projects")
-                break
-        
-        projects_results = all_projects
-        print(f"Total projects found across all pages: {len(projects_results)} (updated in last {lookback_days} days)")
-        
-        # Step 3: Get today's date for filtering
-        today = date.today()
-        today_str = today.strftime('%Y-%m-%d')
-        
-        print(f"Today's date: {today_str}")
-        
-        all_todos = []
-        
-        print(f"\n{'='*60}")
-        print(f"Starting todo fetch from {len(projects_results)} projects...")
-        print(f"{'='*60}\n")
-        
-        # Step 4: For each project, fetch todos
-        project_count = 0
-        for project_id, project_info in projects_results.items():
-            project_count += 1
-            project_name = project_info.get('Name', 'Unknown')
-            
-            if project_count <= 5 or project_count % 50 == 0:  # Log first 5 and every 50th
-                print(f"[{project_count}/{len(projects_results)}] Checking project: {project_name} (ID: {project_id})")
-            
-            # Fetch todos for this project (only Open status)
-            todos_url = f"https://r3.minicrm.hu/Api/R3/ToDoList/{project_id}"
-            todos_params = {'Status': 'Open'}
-            
-            try:
-                todos_response = requests.get(todos_url, auth=auth, params=todos_params, timeout=10)
-                
-                if todos_response.status_code == 200:
-                    todos_data = todos_response.json()
-                    
-                    # Handle both dict and list responses
-                    if isinstance(todos_data, dict):
-                        todos_list = todos_data.get('Results', [])
-                    else:
-                        todos_list = todos_data
-                    
-                    if project_count <= 5:  # Log details for first 5 projects
-                        print(f"  → Found {len(todos_list) if isinstance(todos_list, list) else 'N/A'} todos")
-                    
-                    # Process each todo
-                    todos_found_in_project = 0
-                    todos_filtered_by_user = 0
-                    todos_filtered_by_date = 0
-                    
-                    for todo in todos_list:
-                        todo_deadline = todo.get('Deadline', '')
-                        todo_user_id = todo.get('UserId')
-                        
-                        # Filter by user if specified
-                        if filter_user_id and str(todo_user_id) != str(filter_user_id):
-                            todos_filtered_by_user += 1
-                            continue
-                        
-                        # Filter by deadline (overdue or today only)
-                        if todo_deadline:
-                            try:
-                                deadline_date_str = todo_deadline.split(' ')[0]  # Get YYYY-MM-DD part
-                                deadline_date = datetime.strptime(deadline_date_str, '%Y-%m-%d').date()
-                                
-                                # Only include if overdue or today
-                                if deadline_date <= today:
-                                    todo['project_name'] = project_name
-                                    todo['project_id'] = project_id
-                                    all_todos.append(todo)
-                                    todos_found_in_project += 1
-                                else:
-                                    todos_filtered_by_date += 1
-                            except ValueError:
-                                # Skip if date parsing fails
-                                continue
-                    
-                    if project_count <= 10 and (todos_filtered_by_user > 0 or todos_filtered_by_date > 0 or todos_found_in_project > 0):
-                        print(f"  → Kept {todos_found_in_project}, filtered: {todos_filtered_by_user} by user, {todos_filtered_by_date} by date")
-                        # Show first todo's deadline for debugging
-                        if len(todos_list) > 0 and isinstance(todos_list, list):
-                            first_todo = todos_list[0]
-                            deadline_str = first_todo.get('Deadline', 'N/A')
-                            user_id = first_todo.get('UserId', 'N/A')
-                            print(f"     First todo: deadline={deadline_str}, userId={user_id} (filter_user={filter_user_id}, today={today_str})")
-            
-            except requests.exceptions.Timeout:
-                print(f"Timeout fetching todos for project {project_id}")
-                continue
-            except Exception as e:
-                print(f"Error fetching todos for project {project_id}: {str(e)}")
-                continue
-        
-        # Step 5: Sort todos by deadline (oldest first)
-        all_todos.sort(key=lambda x: x.get('Deadline', ''))
-        
-        # Step 6: Count overdue vs today
-        overdue_count = 0
-        today_count = 0
-        
-        for todo in all_todos:
-            deadline_str = todo.get('Deadline', '').split(' ')[0]
-            if deadline_str < today_str:
-                overdue_count += 1
-            elif deadline_str == today_str:
-                today_count += 1
+        try:
+            export_format = export_format_arg(request.args.get('format'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        print(f"Total todos: {len(all_todos)} (Overdue: {overdue_count}, Today: {today_count})")
+        schedule_id = request.args.get('schedule_id')
+        campaign = (request.args.get('campaign') or '').strip()
+        if schedule_id:
+            schedules = bulk_store.execute('SELECT campaign FROM scheduled_campaigns WHERE id = ?', (schedule_id,))
+            if not schedules:
+                return jsonify({'error': 'Schedule not found'}), 404
+            rows = ((idx + 1, email, status, local_datetime(at), error)
+                    for idx, email, status, error, at in bulk_store.iterate(
+                        'SELECT idx, email, status, error, at FROM scheduled_deliveries WHERE schedule_id = ? ORDER BY idx',
+                        (schedule_id,)))
+            return export_response(export_format, f"{schedules[0]['campaign']}-deliveries",
+                                   ['#', 'Recipient', 'Status', 'Time', 'Error'], rows, 'Deliveries')
+        if not campaign:
+            return jsonify({'error': 'campaign or schedule_id required'}), 400
         
-        return jsonify({
-            'success': True,
-            'todos': all_todos,
-            'total': len(all_todos),
-            'overdue': overdue_count,
-            'today': today_count
-        })
-    
-    except requests.exceptions.Timeout:
-        return jsonify({'error': 'MiniCRM API timeout'}), 408
+        rows = ((recipient, sender, local_datetime(sent_at), message_id)
+                for recipient, sender, sent_at, message_id in bulk_store.iterate(
+                    'SELECT recipient, sender, sent_at, message_id FROM send_ledger WHERE campaign = ? ORDER BY id',
+                    (campaign,)))
+        return export_response(export_format, f"{campaign}-sent", ['Recipient', 'Sender', 'Sent at', 'Gmail message ID'],
+                               rows, 'Sent')
     except Exception as e:
-        print(f"Error fetching daily todos: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.exception("Error in export_send_results: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -0,0 +1,120 @@
+"""
+Benchmark: JSON response compression
+Builds realistic /api/load_emails and /api/minicrm/daily_todos payloads, runs them through
+the app's compression hook with different Accept-Encoding headers and levels, and reports
+bytes on the wire and CPU time per request.
+
+Usage:
+    python benchmarks/bench_compression.py [--iterations 50]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app as prv  # noqa: E402
+from flask import jsonify  # noqa: E402
+
+
+def load_emails_payload():
+    """20 full email bodies, like /api/load_emails returns"""
+    random.seed(1)
+    words = ('ajánlat határidő szállítás köszönöm megrendelés számla projekt egyeztetés '
+             'quote delivery invoice meeting regards please attached').split()
+    emails = []
+    for i in range(20):
+        body = ' '.join(random.choice(words) for _ in range(random.randint(150, 1200)))
+        emails.append({
+            'id': f'18c{i:013x}',
+            'subject': f'Re: Ajánlat #{1000 + i}',
+            'from': 'Kovács Péter <peter.kovacs@example.hu>',
+            'date': f'2024-03-{i % 28 + 1:02d} 10:{i:02d}',
+            'body': body,
+            'direction': 'KAPTAM' if i % 2 else 'KÜLDTEM (Czechner Ince)'
+        })
+    return {'success': True, 'email': 'peter.kovacs@example.hu', 'count': len(emails), 'emails': emails}
+
+
+def daily_todos_payload(count=500):
+    """Raw MiniCRM todo dicts, like /api/minicrm/daily_todos returns"""
+    todos = []
+    for i in range(count):
+        todos.append({
+            'Id': 300000 + i,
+            'ProjectId': 12000 + i // 3,
+            'UserId': 120420 + i % 4,
+            'Type': 'Telefonhívás',
+            'Status': 'Open',
+            'Comment': f'Visszahívni az ajánlat ügyében, {i}. egyeztetés',
+            'Deadline': f'2024-03-{i % 28 + 1:02d} 09:00:00',
+            'Duration': 15,
+            'Reminder': 0,
+            'Mode': 'Manual',
+            'Url': f'https://r3.minicrm.hu/Api/R3/ToDo/{300000 + i}',
+            'project_name': f'Ügyfél {i // 3} Kft. - ACS',
+            'project_id': str(12000 + i // 3)
+        })
+    return {'success': True, 'todos': todos, 'total': count, 'overdue': count - 40, 'today': 40}
+
+
+SCENARIOS = [
+    ('identity', '', {}),
+    ('gzip-1', 'gzip', {'COMPRESSION_GZIP_LEVEL': 1}),
+    ('gzip-6', 'gzip', {'COMPRESSION_GZIP_LEVEL': 6}),
+    ('gzip-9', 'gzip', {'COMPRESSION_GZIP_LEVEL': 9}),
+    ('br-4', 'br, gzip', {'COMPRESSION_BROTLI_QUALITY': 4}),
+    ('br-6', 'br, gzip', {'COMPRESSION_BROTLI_QUALITY': 6}),
+    ('br-11', 'br, gzip', {'COMPRESSION_BROTLI_QUALITY': 11}),
+]
+
+
+def run(payload, accept_encoding, iterations):
+    """Return (wire bytes, CPU ms per request, encoding used)"""
+    headers = {'Accept-Encoding': accept_encoding} if accept_encoding else {}
+    size = 0
+    encoding = None
+    start = time.process_time()
+    for _ in range(iterations):
+        with prv.app.test_request_context('/', headers=headers):
+            response = prv.compress_response(jsonify(payload))
+            size = len(response.get_data())
+            encoding = response.headers.get('Content-Encoding')
+    cpu_ms = (time.process_time() - start) / iterations * 1000
+    return size, cpu_ms, encoding or 'identity'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark JSON response compression')
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    if prv.brotli is None:
+        print("⚠️  Brotli not installed - br scenarios will fall back to gzip")
+
+    payloads = [('load_emails (20 bodies)', load_emails_payload()),
+                ('daily_todos (500 todos)', daily_todos_payload())]
+
+    for title, payload in payloads:
+        print(f"\n{title}")
+        print(f"{'scenario':<12}{'encoding':>10}{'bytes':>12}{'ratio':>8}{'cpu ms/req':>12}")
+        print('-' * 54)
+        baseline = None
+        for name, accept, overrides in SCENARIOS:
+            saved = {key: getattr(prv, key) for key in overrides}
+            for key, value in overrides.items():
+                setattr(prv, key, value)
+            try:
+                size, cpu_ms, encoding = run(payload, accept, args.iterations)
+            finally:
+                for key, value in saved.items():
+                    setattr(prv, key, value)
+            baseline = baseline or size
+            print(f"{name:<12}{encoding:>10}{size:>12}{size / baseline:>8.2f}{cpu_ms:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
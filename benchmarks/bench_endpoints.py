@@ -0,0 +1,241 @@
+"""
+Benchmark: API endpoints against fake upstreams (fully offline)
+Boots app.py against local MiniCRM/Gmail/OpenAI stand-ins (fake_upstreams.py), replays each
+endpoint scenario, and reports latency percentiles plus upstream calls per request. Results
+are written as JSON so runs can be compared - e.g. before/after a change:
+
+    python benchmarks/bench_endpoints.py --output before.json
+    python benchmarks/bench_endpoints.py --compare before.json
+
+Caches are cleared before each scenario; warmup requests (not measured) then fill them the
+way the first user of the day would.
+
+Usage:
+    python benchmarks/bench_endpoints.py [--requests 20] [--minicrm-latency-ms 40] [--error-rate 0]
+                                         [--only daily_todos,find_contact] [--output FILE] [--compare FILE]
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCH_DIR, '..')
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fake_upstreams import UpstreamConfig, app_environment, start_fake_upstreams  # noqa: E402
+
+AUTH_HEADERS = {'Authorization': 'Basic YmVuY2g6YmVuY2g='}  # bench:bench
+
+GMAIL_TOKEN = {
+    'token': 'bench-access-token',
+    'refresh_token': 'bench-refresh-token',
+    'token_uri': 'https://oauth2.googleapis.com/token',
+    'client_id': 'bench-client',
+    'client_secret': 'bench-secret',
+    'scopes': ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.send']
+}
+
+BULK_CONTACTS = [
+    {'email': f'ugyfel{i}@example.hu', 'person': f'Ügyfél {i}', 'company': f'Példa {i} Kft.'} for i in range(3)
+]
+
+# name -> (method, path, json body, max requests per run (None = --requests))
+SCENARIOS = {
+    'find_contact': ('POST', '/api/minicrm/find_contact', {'email': 'peter.kovacs@example.hu'}, None),
+    'get_todos': ('POST', '/api/minicrm/get_todos', {'business_ids': [5001, 5002], 'contact_name': 'Kovács Péter'}, None),
+    'daily_todos': ('POST', '/api/minicrm/daily_todos', {'category_id': None, 'filter_user': '120420', 'lookback_days': 30}, None),
+    'update_todo': ('POST', '/api/minicrm/update_todo', {'todo_id': 101, 'comment': 'Visszahívtam'}, None),
+    'load_emails': ('POST', '/api/load_emails', {'email': 'peter.kovacs@example.hu'}, None),
+    'send_message': ('POST', '/api/send_message', {'message': 'Írj egy rövid ajánlatot', 'session_id': 'bench',
+                                                   'assistant': 'Marketing Expert'}, 5),
+    'send_bulk_emails': ('POST', '/api/send_bulk_emails', {'sender_name': 'Bench', 'subject': 'Ajánlat',
+                                                           'body': 'Kedves {person}!', 'signature': ''}, 3),
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=APP_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run_scenario(prv, fakes, name, requests_count, warmup):
+    """Replay one scenario; return its result dict"""
+    method, path, body, limit = SCENARIOS[name]
+    count = min(requests_count, limit) if limit else requests_count
+
+    for cache in prv.CACHES.values():
+        cache.clear()
+
+    client = prv.app.test_client()
+    with client.session_transaction() as sess:
+        sess['gmail_token'] = dict(GMAIL_TOKEN)
+        sess['gmail_user_email'] = 'bench@prv.hu'
+        sess['bulk_email_contacts'] = BULK_CONTACTS
+
+    def call():
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body, headers=AUTH_HEADERS)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        response.get_data()
+        return elapsed_ms, response.status_code
+
+    for _ in range(warmup):
+        call()
+
+    for fake in fakes.values():
+        fake.reset_counts()
+
+    latencies = []
+    errors = 0
+    for _ in range(count):
+        elapsed_ms, status = call()
+        latencies.append(elapsed_ms)
+        errors += status >= 400
+
+    latencies.sort()
+    upstream_calls = {upstream: round(fake.total_calls() / count, 2) for upstream, fake in fakes.items()}
+    return {
+        'requests': count,
+        'errors': errors,
+        'mean_ms': round(sum(latencies) / count, 2),
+        'p50_ms': round(percentile(latencies, 50), 2),
+        'p90_ms': round(percentile(latencies, 90), 2),
+        'p99_ms': round(percentile(latencies, 99), 2),
+        'max_ms': round(latencies[-1], 2),
+        'upstream_calls_per_request': {k: v for k, v in upstream_calls.items() if v}
+    }
+
+
+def print_results(results):
+    print(f"\n{'endpoint':<18}{'reqs':>6}{'errors':>8}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}  upstream calls/req")
+    print('-' * 90)
+    for name, result in results.items():
+        calls = ', '.join(f'{k} {v:g}' for k, v in result['upstream_calls_per_request'].items()) or '-'
+        print(f"{name:<18}{result['requests']:>6}{result['errors']:>8}{result['p50_ms']:>10.1f}"
+              f"{result['p90_ms']:>10.1f}{result['p99_ms']:>10.1f}  {calls}")
+
+
+def compare(results, baseline_path, max_regression):
+    """Print deltas against a baseline file; return True if any endpoint regressed beyond the threshold"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\nCompared to {baseline_path} ({baseline['meta'].get('git_revision') or 'unknown revision'}, "
+          f"{baseline['meta'].get('timestamp')})")
+    print(f"{'endpoint':<18}{'p50 ms':>18}{'p90 ms':>18}{'upstream calls/req':>24}")
+    print('-' * 78)
+    regressed = False
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print(f"{name:<18}{'(new)':>18}")
+            continue
+        parts = []
+        for key in ('p50_ms', 'p90_ms'):
+            change = (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            parts.append(f"{before[key]:.0f}->{result[key]:.0f} {change:+.0f}%")
+        calls_before = sum(before['upstream_calls_per_request'].values())
+        calls_after = sum(result['upstream_calls_per_request'].values())
+        # A regression must beat both the relative threshold and a small absolute noise floor
+        p50_change = result['p50_ms'] - before['p50_ms']
+        flag = ''
+        if before['p50_ms'] and p50_change / before['p50_ms'] * 100 > max_regression and p50_change > 5:
+            regressed = True
+            flag = '  ❌ regression'
+        print(f"{name:<18}{parts[0]:>18}{parts[1]:>18}{f'{calls_before:g}->{calls_after:g}':>24}{flag}")
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark API endpoints against fake upstreams')
+    parser.add_argument('--requests', type=int, default=20, help='measured requests per scenario')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--only', help='comma-separated scenario names (default: all)')
+    parser.add_argument('--minicrm-latency-ms', type=float, default=40)
+    parser.add_argument('--gmail-latency-ms', type=float, default=60)
+    parser.add_argument('--openai-latency-ms', type=float, default=150)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='injected failure rate for every upstream')
+    parser.add_argument('--projects', type=int, default=230, help='MiniCRM projects returned by the fake')
+    parser.add_argument('--run-seconds', type=float, default=1.0, help='fake assistant run duration')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/endpoints-<timestamp>.json)')
+    parser.add_argument('--compare', help='baseline result file to compare against')
+    parser.add_argument('--max-regression', type=float, default=20.0, help='allowed p50 slowdown in %% (--compare)')
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        sys.exit(f"Unknown scenario(s): {', '.join(unknown)} - choose from {', '.join(SCENARIOS)}")
+
+    configs = {
+        'minicrm': UpstreamConfig(args.minicrm_latency_ms, error_rate=args.error_rate),
+        'gmail': UpstreamConfig(args.gmail_latency_ms, error_rate=args.error_rate),
+        'openai': UpstreamConfig(args.openai_latency_ms, error_rate=args.error_rate),
+    }
+    fakes = start_fake_upstreams(**configs, projects=args.projects, run_seconds=args.run_seconds)
+
+    # The app reads its configuration at import time - point it at the fakes and a throwaway cache first
+    scratch = tempfile.mkdtemp(prefix='prv_bench_')
+    os.environ.update(app_environment(fakes))
+    os.environ.update({
+        'BASIC_AUTH_USERS': 'bench:bench',
+        'CACHE_DB_PATH': os.path.join(scratch, 'cache.sqlite3'),
+        'BULK_DB_PATH': os.path.join(scratch, 'bulk.sqlite3'),
+        'CONVERSATION_DB_PATH': os.path.join(scratch, 'conversations.sqlite3'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(scratch, 'metrics'),
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+    })
+    import app as prv
+
+    results = {}
+    try:
+        for name in names:
+            results[name] = run_scenario(prv, fakes, name, args.requests, args.warmup)
+    finally:
+        for fake in fakes.values():
+            fake.stop()
+
+    print_results(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, f"endpoints-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'git_revision': git_revision(),
+                'python': platform.python_version(),
+                'requests': args.requests,
+                'upstream_latency_ms': {name: config.latency_ms for name, config in configs.items()},
+                'error_rate': args.error_rate,
+                'projects': args.projects,
+            },
+            'results': results
+        }, f, indent=2, ensure_ascii=False)
+    print(f"\nResults written to {output}")
+
+    if args.compare and compare(results, args.compare, args.max_regression):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
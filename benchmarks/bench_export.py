@@ -0,0 +1,115 @@
+"""
+Benchmark: streamed CSV/XLSX export of bulk-send results
+Fills a throwaway send ledger (BULK_DB_PATH in a temp dir) with one campaign of N sent emails,
+then downloads it through /api/export/send_results in both formats, reading the body chunk by
+chunk the way a browser does. Reports time, output size and peak Python memory (tracemalloc)
+for the full row count and for a tenth of it - streaming should keep the peak flat as rows grow.
+The in-memory alternative (pandas DataFrame -> to_excel / to_csv) is measured for comparison.
+
+Usage:
+    python benchmarks/bench_export.py [--rows 100000] [--budget-mb 20] [--no-baseline]
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+
+AUTH_HEADERS = {'Authorization': 'Basic YmVuY2g6YmVuY2g='}  # bench:bench
+
+
+def measure(fn):
+    """Run fn twice: untraced for wall time, then under tracemalloc for peak memory"""
+    start = time.perf_counter()
+    size = fn()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, size, peak / 1024 / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark streamed spreadsheet exports')
+    parser.add_argument('--rows', type=int, default=100000, help='sent emails in the exported campaign')
+    parser.add_argument('--budget-mb', type=float, default=20, help='fail (exit 1) if a streamed export peaks higher')
+    parser.add_argument('--no-baseline', action='store_true', help='skip the pandas in-memory comparison')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='prv_export_bench_')
+    os.environ.update({
+        'BASIC_AUTH_USERS': 'bench:bench',
+        'BULK_DB_PATH': os.path.join(scratch, 'bulk.sqlite3'),
+        'CACHE_DB_PATH': os.path.join(scratch, 'cache.sqlite3'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(scratch, 'metrics'),
+        'LOG_LEVEL': 'WARNING',
+        'SLOW_REQUEST_MS': '600000',  # Large exports are slow by design - keep the output readable
+    })
+    import app as prv
+
+    small = max(1, args.rows // 10)
+    now = time.time()
+    conn = prv.bulk_store.connection()
+    conn.execute('BEGIN')
+    for campaign, count in (('bench', args.rows), ('bench small', small)):
+        conn.executemany(
+            'INSERT INTO send_ledger (recipient, campaign, sender, message_id, sent_at) VALUES (?, ?, ?, ?, ?)',
+            ((f'ugyfel{i}@example.hu', campaign, 'bench@prv.hu', f'18c{i:013x}', now - i) for i in range(count)))
+    conn.execute('COMMIT')
+
+    client = prv.app.test_client()
+
+    def download(campaign, export_format):
+        def run():
+            response = client.get('/api/export/send_results', query_string={'campaign': campaign, 'format': export_format},
+                                  headers=AUTH_HEADERS, buffered=False)
+            assert response.status_code == 200, response.status_code
+            size = sum(len(chunk) for chunk in response.response)
+            response.close()
+            return size
+        return run
+
+    def in_memory(export_format):
+        def run():
+            import pandas as pd
+            rows = prv.bulk_store.execute(
+                'SELECT recipient, sender, sent_at, message_id FROM send_ledger WHERE campaign = ? ORDER BY id', ('bench',))
+            df = pd.DataFrame([tuple(row) for row in rows], columns=['Recipient', 'Sender', 'Sent at', 'Gmail message ID'])
+            buffer = io.BytesIO()
+            if export_format == 'xlsx':
+                df.to_excel(buffer, index=False)
+            else:
+                buffer.write(df.to_csv(index=False).encode('utf-8'))
+            return buffer.tell()
+        return run
+
+    cases = []
+    for export_format in ('csv', 'xlsx'):
+        cases.append((f'streamed {export_format} ({small} rows)', download('bench small', export_format), False))
+        cases.append((f'streamed {export_format} ({args.rows} rows)', download('bench', export_format), True))
+        if not args.no_baseline:
+            cases.append((f'pandas {export_format} ({args.rows} rows)', in_memory(export_format), False))
+
+    print(f"\n{'export':<32}{'seconds':>10}{'MB out':>10}{'peak MB':>10}")
+    print('-' * 62)
+    worst_peak = 0
+    for name, fn, budgeted in cases:
+        elapsed, size, peak = measure(fn)
+        print(f"{name:<32}{elapsed:>10.2f}{size / 1024 / 1024:>10.1f}{peak:>10.1f}")
+        if budgeted:
+            worst_peak = max(worst_peak, peak)
+
+    status = '❌' if worst_peak > args.budget_mb else '✅'
+    print(f"\n{status} streamed export of {args.rows} rows peaked at {worst_peak:.1f} MB (budget {args.budget_mb:.0f} MB)")
+    sys.exit(1 if worst_peak > args.budget_mb else 0)
+
+
+if __name__ == '__main__':
+    main()
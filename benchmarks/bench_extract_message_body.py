@@ -0,0 +1,171 @@
+"""
+Benchmark: Gmail message body extraction
+Runs extract_message_body over a corpus of real-world-shaped Gmail API payloads,
+checks the extracted text for correctness and reports throughput in MB/s.
+
+Usage:
+    python benchmarks/bench_extract_message_body.py [--iterations 200]
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import extract_message_body  # noqa: E402
+
+
+def b64(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode('ascii')
+
+
+def leaf(mime_type, text, charset='utf-8'):
+    return {
+        'mimeType': mime_type,
+        'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}],
+        'body': {'size': len(text), 'data': b64(text, charset)}
+    }
+
+
+def attachment(filename, size):
+    return {
+        'mimeType': 'application/pdf',
+        'filename': filename,
+        'headers': [{'name': 'Content-Type', 'value': f'application/pdf; name="{filename}"'}],
+        'body': {'size': size, 'attachmentId': 'ANGjdJ' + 'x' * 40}
+    }
+
+
+def multipart(mime_type, *parts):
+    return {'mimeType': mime_type, 'headers': [], 'body': {'size': 0}, 'parts': list(parts)}
+
+
+NEWSLETTER_HTML = '''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Newsletter</title>
+<style type="text/css">body { font-family: Arial; } .btn { color: #fff; }</style>
+<script>window.dataLayer = window.dataLayer || [];</script></head>
+<body><!-- preheader -->
+<table width="100%"><tr><td><h1>Őszi ajánlat &ndash; PRV&nbsp;Kft.</h1>
+<p>Kedves Partnerünk, ár&amp;érték &gt; minden &#8211; &#x201E;legjobb&#x201D; ajánlatunk.</p>
+''' + '<tr><td><p>Termék sor &euro; 1&nbsp;200 &ndash; részletek &raquo;</p></td></tr>\n' * 300 + '''
+</td></tr></table></body></html>'''
+
+REPLY_THREAD_TEXT = (
+    'Szia Ince,\n\nköszönöm az ajánlatot, átnéztük.\n\n'
+    + ''.join(f'> {i}. sor az előző levélből, árak és határidők egyeztetése.\n' for i in range(800))
+)
+
+HUNGARIAN_LATIN2 = 'Tisztelt Kovács Úr!\n\nÁrvíztűrő tükörfúrógép szállítása jövő héten.\n' * 50
+
+
+# Each case: (name, payload, strings that must appear, strings that must not appear)
+CORPUS = [
+    (
+        'plain_single_part',
+        leaf('text/plain', 'Hello,\n\nSee you on Monday.\n\nBest regards'),
+        ['See you on Monday.'],
+        []
+    ),
+    (
+        'alternative_html_before_plain',
+        multipart(
+            'multipart/alternative',
+            leaf('text/html', '<html><body><p>HTML version</p></body></html>'),
+            leaf('text/plain', 'Plain version of the message')
+        ),
+        ['Plain version of the message'],
+        ['HTML version']
+    ),
+    (
+        'mixed_nested_with_attachment',
+        multipart(
+            'multipart/mixed',
+            multipart(
+                'multipart/related',
+                multipart(
+                    'multipart/alternative',
+                    leaf('text/plain', REPLY_THREAD_TEXT),
+                    leaf('text/html', '<html><body>' + REPLY_THREAD_TEXT.replace('\n', '<br>') + '</body></html>')
+                )
+            ),
+            attachment('ajanlat.pdf', 245000)
+        ),
+        ['köszönöm az ajánlatot', '799. sor'],
+        ['<br>']
+    ),
+    (
+        'html_only_newsletter',
+        multipart('multipart/mixed', leaf('text/html', NEWSLETTER_HTML), attachment('logo.pdf', 1000)),
+        ['Őszi ajánlat – PRV Kft.', 'ár&érték > minden – „legjobb” ajánlatunk.', '€ 1 200 – részletek »'],
+        ['font-family', 'dataLayer', 'preheader', '&nbsp;', '&euro;', 'Newsletter']
+    ),
+    (
+        'html_fragment_without_doctype',
+        leaf('text/html', '<div dir="ltr">Rövid <b>válasz</b>&nbsp;&#233;s k&ouml;sz&ouml;n&ouml;m<br></div>'),
+        ['Rövid válasz és köszönöm'],
+        ['<div', '<b>']
+    ),
+    (
+        'latin2_charset_from_headers',
+        leaf('text/plain', HUNGARIAN_LATIN2, charset='iso-8859-2'),
+        ['Árvíztűrő tükörfúrógép'],
+        ['�']
+    ),
+]
+
+
+def payload_size(payload):
+    """Total number of decoded body bytes in a payload"""
+    size = 0
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        stack.extend(part.get('parts', []))
+        data = part.get('body', {}).get('data')
+        if data:
+            size += len(base64.urlsafe_b64decode(data))
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark extract_message_body')
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    failures = 0
+    print(f"{'case':<34}{'bytes':>10}{'MB/s':>10}  result")
+    print('-' * 64)
+
+    total_bytes = 0
+    total_seconds = 0.0
+    for name, payload, must_contain, must_not_contain in CORPUS:
+        body = extract_message_body(payload)
+        problems = [f'missing {s!r}' for s in must_contain if s not in body]
+        problems += [f'unexpected {s!r}' for s in must_not_contain if s in body]
+        failures += bool(problems)
+
+        size = payload_size(payload)
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            extract_message_body(payload)
+        elapsed = time.perf_counter() - start
+
+        total_bytes += size * args.iterations
+        total_seconds += elapsed
+        mb_per_s = size * args.iterations / elapsed / 1e6
+        print(f"{name:<34}{size:>10}{mb_per_s:>10.1f}  {'OK' if not problems else 'FAIL: ' + '; '.join(problems)}")
+
+    print('-' * 64)
+    print(f"{'overall':<34}{total_bytes // args.iterations:>10}{total_bytes / total_seconds / 1e6:>10.1f}")
+
+    if failures:
+        print(f"\n❌ {failures} correctness failure(s)")
+        sys.exit(1)
+    print("\n✅ All cases extracted correctly")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Benchmark: send-ledger pre-send check on large contact lists
+Fills a throwaway ledger (BULK_DB_PATH in a temp dir) with send history and unsubscribes,
+then times the checks send_bulk_emails and /api/send_history/check run for a whole list:
+the first refresh of a worker's in-memory index (cold), an incremental refresh (warm),
+the campaign lookup and the per-row rule check.
+
+Usage:
+    python benchmarks/bench_send_ledger.py [--history 500000] [--list 100000] [--suppressed 5000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark send-ledger checks')
+    parser.add_argument('--history', type=int, default=500000, help='ledger rows (emails sent before)')
+    parser.add_argument('--recipients', type=int, default=200000, help='distinct recipients in the history')
+    parser.add_argument('--campaigns', type=int, default=50)
+    parser.add_argument('--list', type=int, default=100000, help='rows in the list being checked')
+    parser.add_argument('--suppressed', type=int, default=5000, help='unsubscribed addresses')
+    parser.add_argument('--budget-ms', type=float, default=1000, help='fail (exit 1) if a warm check is slower')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='prv_ledger_bench_')
+    os.environ.update({
+        'BULK_DB_PATH': os.path.join(scratch, 'bulk.sqlite3'),
+        'CACHE_DB_PATH': os.path.join(scratch, 'cache.sqlite3'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(scratch, 'metrics'),
+        'LOG_LEVEL': 'WARNING',
+    })
+    import app as prv
+
+    rng = random.Random(1)
+    now = time.time()
+    start = time.perf_counter()
+    conn = prv.bulk_store.connection()
+    conn.execute('BEGIN')
+    conn.executemany(
+        'INSERT INTO send_ledger (recipient, campaign, sender, message_id, sent_at) VALUES (?, ?, ?, ?, ?)',
+        ((f'user{rng.randrange(args.recipients)}@example.hu', f'campaign {rng.randrange(args.campaigns)}',
+          'bench@prv.hu', None, now - rng.uniform(0, 365 * 86400)) for _ in range(args.history)))
+    conn.executemany(
+        'INSERT OR IGNORE INTO suppressions (recipient, reason, created_at) VALUES (?, ?, ?)',
+        ((f'user{rng.randrange(args.recipients)}@example.hu', 'unsubscribed', now) for _ in range(args.suppressed)))
+    conn.execute('COMMIT')
+    print(f"Filled ledger: {args.history} sends, {args.suppressed} unsubscribes "
+          f"({(time.perf_counter() - start):.1f}s)")
+
+    # Half of the list overlaps the history, half are new addresses
+    emails = [f'user{rng.randrange(args.recipients * 2)}@example.hu' for _ in range(args.list)]
+
+    def timed_ms(fn):
+        start = time.perf_counter()
+        result = fn()
+        return (time.perf_counter() - start) * 1000, result
+
+    cold_ms, _ = timed_ms(prv.send_ledger.refresh)
+    for i in range(100):
+        prv.send_ledger.record(f'new{i}@example.hu', 'campaign 0', 'bench@prv.hu', None)
+    warm_ms, _ = timed_ms(prv.send_ledger.refresh)
+    campaign_ms, campaign_recipients = timed_ms(lambda: prv.send_ledger.campaign_recipients('campaign 0'))
+
+    cutoff = now - 30 * 86400
+
+    def check():
+        reasons = {}
+        for email in emails:
+            reason = prv.send_ledger.skip_reason(prv.normalize_recipient(email), campaign_recipients, cutoff)
+            if reason:
+                reasons[reason] = reasons.get(reason, 0) + 1
+        return reasons
+
+    check_ms, reasons = timed_ms(check)
+    total_ms = warm_ms + campaign_ms + check_ms
+
+    print(f"\n{'step':<36}{'ms':>10}")
+    print('-' * 46)
+    print(f"{'refresh (cold, first use in worker)':<36}{cold_ms:>10.1f}")
+    print(f"{'refresh (warm, 100 new rows)':<36}{warm_ms:>10.1f}")
+    print(f"{'campaign recipients':<36}{campaign_ms:>10.1f}")
+    print(f"{f'rule check ({args.list} rows)':<36}{check_ms:>10.1f}")
+    print(f"{'warm total':<36}{total_ms:>10.1f}")
+    print(f"\nSkipped: {', '.join(f'{k} {v}' for k, v in sorted(reasons.items())) or 'none'}")
+
+    status = '❌' if total_ms > args.budget_ms else '✅'
+    print(f"{status} warm check of {args.list} rows: {total_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    sys.exit(1 if total_ms > args.budget_ms else 0)
+
+
+if __name__ == '__main__':
+    main()
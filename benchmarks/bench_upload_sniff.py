@@ -0,0 +1,115 @@
+"""
+Benchmark: contact-list upload on a large multi-sheet workbook
+Writes a throwaway workbook with a large notes sheet first and the contacts on the second sheet
+(the case the one-shot pd.read_excel parser rejected), then times:
+  - the old first step: pd.read_excel of the whole first sheet, just to look at its columns,
+  - /api/upload_excel/sniff: sheet names, header and proposed columns from the first rows,
+  - /api/upload_excel with the confirmed sheet and columns (full parse of that sheet only).
+
+Usage:
+    python benchmarks/bench_upload_sniff.py [--rows 50000] [--columns 12] [--budget-ms 1000]
+"""
+
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, APP_DIR)
+
+AUTH_HEADERS = {'Authorization': 'Basic YmVuY2g6YmVuY2g='}  # bench:bench
+
+
+def build_workbook(path, rows, columns):
+    """Written in openpyxl's normal mode, like Excel: shared strings and a <dimension> up front"""
+    from openpyxl import Workbook
+    workbook = Workbook()
+    notes = workbook.active
+    notes.title = 'Jegyzetek'
+    notes.append([f'Megjegyzés {c}' for c in range(columns)])
+    for i in range(rows):
+        notes.append([f'sor {i} oszlop {c}' for c in range(columns)])
+    contacts = workbook.create_sheet('Kontaktok')
+    contacts.append(['Kampány lista 2026'])
+    contacts.append([])
+    contacts.append(['Cégnév', 'Név', 'Telefon', 'Város', 'E-mail'] + [f'Egyéb {c}' for c in range(columns - 5)])
+    for i in range(rows):
+        contacts.append([f'Példa {i} Kft.', f'Ügyfél {i}', f'+36 1 {i:07d}', 'Budapest', f'ugyfel{i}@example.hu']
+                        + [f'adat {c}' for c in range(columns - 5)])
+    workbook.save(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark contact-list sheet sniffing')
+    parser.add_argument('--rows', type=int, default=50000, help='rows on each sheet')
+    parser.add_argument('--columns', type=int, default=12)
+    parser.add_argument('--budget-ms', type=float, default=1000, help='fail (exit 1) if the sniff is slower')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='prv_upload_bench_')
+    os.environ.update({
+        'BASIC_AUTH_USERS': 'bench:bench',
+        'BULK_DB_PATH': os.path.join(scratch, 'bulk.sqlite3'),
+        'CACHE_DB_PATH': os.path.join(scratch, 'cache.sqlite3'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(scratch, 'metrics'),
+        'LOG_LEVEL': 'WARNING',
+        'SLOW_REQUEST_MS': '600000',
+    })
+    import app as prv
+    import pandas as pd
+    prv.app.config['UPLOAD_FOLDER'] = scratch
+
+    path = os.path.join(scratch, 'contacts.xlsx')
+    build_workbook(path, args.rows, args.columns)
+    with open(path, 'rb') as f:
+        data = f.read()
+    print(f"Workbook: 2 sheets x {args.rows} rows x {args.columns} columns, {len(data) / 1024 / 1024:.1f} MB")
+
+    client = prv.app.test_client()
+
+    def timed_ms(fn):
+        start = time.perf_counter()
+        result = fn()
+        return (time.perf_counter() - start) * 1000, result
+
+    old_ms, _ = timed_ms(lambda: pd.read_excel(path))
+
+    def sniff():
+        response = client.post('/api/upload_excel/sniff', data={'file': (io.BytesIO(data), 'contacts.xlsx')},
+                               headers=AUTH_HEADERS, content_type='multipart/form-data')
+        assert response.status_code == 200, response.get_json()
+        return response.get_json()
+
+    sniff_ms, sniffed = timed_ms(sniff)
+    sheet = sniffed['sheets'][sniffed['suggested_sheet']]
+
+    def confirm():
+        response = client.post('/api/upload_excel', headers=AUTH_HEADERS, json={
+            'upload_id': sniffed['upload_id'], 'sheet': sheet['name'],
+            'header_row': sheet['header_row'], 'mapping': sheet['mapping']})
+        assert response.status_code == 200, response.get_json()
+        return response.get_json()
+
+    parse_ms, parsed = timed_ms(confirm)
+    full_ms, _ = timed_ms(lambda: pd.read_excel(path, sheet_name=sheet['name'], header=sheet['header_row']))
+
+    columns = ', '.join(f"{field}={sheet['columns'][column]}" for field, column in sheet['mapping'].items())
+    print(f"Proposed: sheet {sheet['name']}, header row {sheet['header_row'] + 1}, {columns}")
+    print(f"\n{'step':<48}{'ms':>10}")
+    print('-' * 58)
+    print(f"{'old: pd.read_excel (first sheet, all columns)':<48}{old_ms:>10.0f}")
+    print(f"{'sniff: sheets + headers + preview':<48}{sniff_ms:>10.0f}")
+    parse_step = f"parse chosen sheet and columns ({parsed['total_contacts']} contacts)"
+    print(f"{parse_step:<48}{parse_ms:>10.0f}")
+    print(f"{'pd.read_excel of the chosen sheet (for reference)':<48}{full_ms:>10.0f}")
+
+    status = '❌' if sniff_ms > args.budget_ms else '✅'
+    print(f"\n{status} time to preview: {sniff_ms:.0f} ms vs {old_ms:.0f} ms (budget {args.budget_ms:.0f} ms)")
+    sys.exit(1 if sniff_ms > args.budget_ms else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Import-time budget check
+Imports app.py in a fresh interpreter with `python -X importtime` and fails (exit code 1)
+if the total import time exceeds the budget or if a dependency that must stay lazy
+(loaded on first use, not at worker boot) shows up in the import graph.
+
+Usage:
+    python benchmarks/check_import_time.py [--budget-ms 400] [--runs 3]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Heavy dependencies that must only be imported inside the routes that need them
+LAZY_MODULES = ['pandas', 'openai', 'openpyxl', 'googleapiclient', 'google_auth_oauthlib', 'email.mime']
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure():
+    """Import app once; return (cumulative microseconds for app, set of imported modules)"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import app'],
+        cwd=APP_DIR, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(f"❌ Importing app failed (exit code {result.returncode})")
+
+    app_us = None
+    modules = set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if not match:
+            continue
+        modules.add(match.group(4))
+        if match.group(4) == 'app':
+            app_us = int(match.group(2))
+    return app_us, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check app.py import time against a budget')
+    parser.add_argument('--budget-ms', type=float, default=float(os.getenv('IMPORT_TIME_BUDGET_MS', 400)))
+    parser.add_argument('--runs', type=int, default=3, help='best of N runs (reduces noise)')
+    args = parser.parse_args()
+
+    timings = []
+    modules = set()
+    for _ in range(args.runs):
+        app_us, modules = measure()
+        timings.append(app_us / 1000)
+    best_ms = min(timings)
+
+    failed = False
+    eager = sorted(m for m in modules
+                   if any(m == lazy or m.startswith(lazy + '.') for lazy in LAZY_MODULES))
+    if eager:
+        roots = sorted({m.split('.')[0] if not m.startswith('email.mime') else 'email.mime' for m in eager})
+        print(f"❌ Imported at startup but should be lazy: {', '.join(roots)}")
+        failed = True
+
+    status = '❌' if best_ms > args.budget_ms else '✅'
+    print(f"{status} import app: {best_ms:.0f} ms (best of {args.runs}, budget {args.budget_ms:.0f} ms)")
+    failed = failed or best_ms > args.budget_ms
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,412 @@
+"""
+Local stand-in servers for the upstream APIs the app talks to
+MiniCRM R3 (Contact, Project paging, ToDoList, ToDo PUT), Gmail (profile, messages
+list/get/send) and the OpenAI Assistants endpoints used by /api/send_message.
+Each server has configurable latency and error injection and counts the calls it serves.
+
+Used by bench_endpoints.py; can also be run on its own to point a dev server at it:
+    python benchmarks/fake_upstreams.py [--minicrm-latency-ms 80]
+"""
+
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class UpstreamConfig:
+    """Latency/error injection for one fake upstream"""
+
+    def __init__(self, latency_ms=0.0, jitter=0.25, error_rate=0.0, error_status=500):
+        self.latency_ms = latency_ms
+        self.jitter = jitter  # +/- share of latency_ms, uniformly distributed
+        self.error_rate = error_rate
+        self.error_status = error_status
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    """Routes a request to the owning FakeUpstream; latency/errors are injected before routing"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output clean
+
+    def handle_any(self, method):
+        upstream = self.server.upstream
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, payload = upstream.handle(method, url.path, parse_qs(url.query), body)
+        data = json.dumps(payload).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The app gave up on this call (timeout/deadline) - not an error of the fake
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_PUT(self):
+        self.handle_any('PUT')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+
+class FakeUpstream:
+    """Base class: HTTP server on 127.0.0.1, route table of (method, regex, handler)"""
+
+    name = 'upstream'
+    prefix = ''
+
+    def __init__(self, config=None, seed=1):
+        self.config = config or UpstreamConfig()
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+        self.routes = []
+
+    def route(self, method, pattern, handler, label):
+        self.routes.append((method, re.compile(pattern + '$'), handler, label))
+
+    def handle(self, method, path, query, body):
+        with self.lock:
+            delay = self.config.latency_ms * (1 + self.random.uniform(-self.config.jitter, self.config.jitter))
+            fail = self.random.random() < self.config.error_rate
+        for route_method, pattern, handler, label in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                with self.lock:
+                    self.calls[f'{method} {label}'] += 1
+                time.sleep(max(0.0, delay) / 1000)
+                if fail:
+                    return self.config.error_status, {'error': 'injected failure'}
+                return handler(query, json.loads(body) if body else None, *match.groups())
+        with self.lock:
+            self.calls[f'{method} unmatched'] += 1
+        return 404, {'error': f'No fake route for {method} {path}'}
+
+    def start(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeHandler)
+        self.server.daemon_threads = True
+        self.server.upstream = self
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}{self.prefix}'
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls.clear()
+
+
+class FakeMiniCRM(FakeUpstream):
+    """MiniCRM R3: deterministic projects with overdue/today/future todos spread over a few users"""
+
+    name = 'minicrm'
+    prefix = '/Api/R3'
+    USER_IDS = [120420, 120421, 120422, 120423]
+
+    def __init__(self, config=None, seed=1, projects=230, todos_per_project=3):
+        super().__init__(config, seed)
+        self.project_count = projects
+        self.todos_per_project = todos_per_project
+        self.route('GET', r'/Api/R3/Contact', self.contact, '/Contact')
+        self.route('GET', r'/Api/R3/Project', self.project_search, '/Project')
+        self.route('GET', r'/Api/R3/Project/(\d+)', self.project, '/Project/{id}')
+        self.route('GET', r'/Api/R3/ToDoList/(\d+)', self.todo_list, '/ToDoList/{id}')
+        self.route('PUT', r'/Api/R3/ToDo/(\d+)', self.update_todo, '/ToDo/{id}')
+
+    def project_info(self, project_id):
+        return {
+            'Id': project_id,
+            'Name': f'Ügyfél {project_id} Kft. - ACS',
+            'CategoryId': 23 if project_id % 2 else 41,
+            'MainContactId': 5000 + project_id % 50,
+            'Url': f'{self.url}/Project/{project_id}'
+        }
+
+    def contact(self, query, body):
+        email = query.get('Email', [''])[0]
+        business_id = 5000 + sum(map(ord, email)) % 50
+        return 200, {'Count': 1, 'Results': {'28261': {
+            'Id': 28261, 'Name': 'Kovács Péter', 'Email': email, 'Company': 'Példa Kft.',
+            'Phone': '+36 1 234 5678', 'BusinessId': business_id
+        }}}
+
+    def project_search(self, query, body):
+        if 'MainContactId' in query:
+            business_id = int(query['MainContactId'][0])
+            ids = [pid for pid in range(1, self.project_count + 1) if 5000 + pid % 50 == business_id]
+            return 200, {'Count': len(ids), 'Results': {str(pid): self.project_info(pid) for pid in ids}}
+        page = int(query.get('Page', ['0'])[0])
+        ids = list(range(1, self.project_count + 1))[page * 100:(page + 1) * 100]
+        return 200, {'Count': self.project_count, 'Results': {str(pid): self.project_info(pid) for pid in ids}}
+
+    def project(self, query, body, project_id):
+        return 200, self.project_info(int(project_id))
+
+    def todo_list(self, query, body, project_id):
+        project_id = int(project_id)
+        today = date.today()
+        todos = []
+        for k in range(self.todos_per_project):
+            todo_id = project_id * 10 + k
+            due = today + timedelta(days=(todo_id % 7) - 4)  # Mostly overdue, some today/future
+            todos.append({
+                'Id': todo_id,
+                'ProjectId': project_id,
+                'UserId': self.USER_IDS[todo_id % len(self.USER_IDS)],
+                'Type': 'Telefonhívás',
+                'Status': 'Open',
+                'Comment': f'Visszahívni az ajánlat ügyében ({todo_id})',
+                'Deadline': f'{due.isoformat()} 09:00:00'
+            })
+        return 200, {'Count': len(todos), 'Results': todos}
+
+    def update_todo(self, query, body, todo_id):
+        return 200, {'Id': int(todo_id)}
+
+
+class FakeGmail(FakeUpstream):
+    """Gmail API v1 (paths as built by googleapiclient with a custom api_endpoint)"""
+
+    name = 'gmail'
+    MAILBOX = 'bench@prv.hu'
+
+    def __init__(self, config=None, seed=1, messages=20, body_words=600):
+        super().__init__(config, seed)
+        self.message_count = messages
+        self.body_words = body_words
+        base = r'/gmail/v1/users/me'
+        self.route('GET', base + r'/profile', self.profile, '/profile')
+        self.route('GET', base + r'/messages', self.list_messages, '/messages')
+        self.route('GET', base + r'/messages/([\w-]+)', self.get_message, '/messages/{id}')
+        self.route('POST', base + r'/messages/send', self.send_message, '/messages/send')
+
+    def profile(self, query, body):
+        return 200, {'emailAddress': self.MAILBOX, 'messagesTotal': 1234, 'threadsTotal': 456}
+
+    def list_messages(self, query, body):
+        limit = min(int(query.get('maxResults', ['100'])[0]), self.message_count)
+        return 200, {'messages': [{'id': f'18c{i:013x}', 'threadId': f'18c{i // 3:013x}'} for i in range(limit)],
+                     'resultSizeEstimate': limit}
+
+    def get_message(self, query, body, message_id):
+        index = int(message_id[3:], 16) if message_id.startswith('18c') else 0
+        rng = random.Random(index)
+        words = ('ajánlat határidő szállítás köszönöm megrendelés számla projekt egyeztetés '
+                 'quote delivery invoice meeting regards').split()
+        text = ' '.join(rng.choice(words) for _ in range(self.body_words))
+        html = '<html><body><p>' + text.replace('. ', '.</p><p>') + '</p></body></html>'
+
+        def part(mime_type, content):
+            return {'mimeType': mime_type,
+                    'headers': [{'name': 'Content-Type', 'value': f'{mime_type}; charset="UTF-8"'}],
+                    'body': {'size': len(content),
+                             'data': base64.urlsafe_b64encode(content.encode('utf-8')).decode('ascii')}}
+
+        sender = self.MAILBOX if index % 2 else 'Kovács Péter <peter.kovacs@example.hu>'
+        return 200, {
+            'id': message_id,
+            'threadId': f'18c{index // 3:013x}',
+            'payload': {
+                'mimeType': 'multipart/alternative',
+                'headers': [
+                    {'name': 'Subject', 'value': f'Re: Ajánlat #{1000 + index}'},
+                    {'name': 'From', 'value': sender},
+                    {'name': 'Date', 'value': 'Tue, 12 Mar 2024 10:%02d:00 +0100' % (index % 60)},
+                ],
+                'body': {'size': 0},
+                'parts': [part('text/plain', text), part('text/html', html)]
+            }
+        }
+
+    def send_message(self, query, body):
+        return 200, {'id': uuid.uuid4().hex[:16], 'threadId': uuid.uuid4().hex[:16], 'labelIds': ['SENT']}
+
+
+class FakeOpenAI(FakeUpstream):
+    """OpenAI Assistants API (assistants, threads, messages, runs) and chat completions
+
+    Runs complete run_seconds after creation; completions answer after the injected latency.
+    """
+
+    name = 'openai'
+    prefix = '/v1'
+
+    def __init__(self, config=None, seed=1, run_seconds=1.0):
+        super().__init__(config, seed)
+        self.run_seconds = run_seconds
+        self.runs = {}
+        self.threads = {}
+        self.route('POST', r'/v1/threads', self.create_thread, '/threads')
+        self.route('DELETE', r'/v1/threads/(\w+)', self.delete_thread, '/threads/{id}')
+        self.route('POST', r'/v1/threads/(\w+)/messages', self.create_message, '/threads/{id}/messages')
+        self.route('GET', r'/v1/threads/(\w+)/messages', self.list_messages, '/threads/{id}/messages')
+        self.route('POST', r'/v1/threads/(\w+)/runs', self.create_run, '/threads/{id}/runs')
+        self.route('GET', r'/v1/threads/(\w+)/runs/(\w+)', self.get_run, '/threads/{id}/runs/{id}')
+        self.route('GET', r'/v1/assistants/(\w+)', self.get_assistant, '/assistants/{id}')
+        self.route('POST', r'/v1/chat/completions', self.chat_completion, '/chat/completions')
+
+    @staticmethod
+    def message(thread_id, role, text, run_id=None):
+        return {
+            'id': 'msg_' + uuid.uuid4().hex[:24], 'object': 'thread.message', 'created_at': int(time.time()),
+            'thread_id': thread_id, 'role': role, 'file_ids': [], 'assistant_id': None, 'run_id': run_id,
+            'metadata': {}, 'content': [{'type': 'text', 'text': {'value': text, 'annotations': []}}]
+        }
+
+    def run_payload(self, run_id):
+        run = self.runs[run_id]
+        done = time.monotonic() - run['started'] >= self.run_seconds
+        if done and not run['answered']:
+            run['answered'] = True
+            self.threads[run['thread_id']].append(
+                self.message(run['thread_id'], 'assistant', 'Kedves Partnerünk, köszönjük a megkeresést!', run_id))
+        return {
+            'id': run_id, 'object': 'thread.run', 'created_at': run['created_at'], 'thread_id': run['thread_id'],
+            'assistant_id': run['assistant_id'], 'status': 'completed' if done else 'in_progress',
+            'required_action': None, 'last_error': None, 'expires_at': None, 'started_at': run['created_at'],
+            'cancelled_at': None, 'failed_at': None, 'completed_at': int(time.time()) if done else None,
+            'model': 'gpt-4', 'instructions': '', 'tools': [], 'file_ids': [], 'metadata': {}
+        }
+
+    def get_assistant(self, query, body, assistant_id):
+        return 200, {
+            'id': assistant_id, 'object': 'assistant', 'created_at': int(time.time()), 'name': 'Marketing Expert',
+            'description': None, 'model': 'gpt-4', 'instructions': 'Te a PRV értékesítési asszisztense vagy.',
+            'tools': [], 'file_ids': [], 'metadata': {}
+        }
+
+    def chat_completion(self, query, body):
+        prompt = ' '.join(m['content'] for m in body['messages'])
+        person = re.search(r'Person: (.*)', prompt)
+        text = f"Örömmel olvastam a {person.group(1) if person else 'cég'} legutóbbi híreit."
+        return 200, {
+            'id': 'chatcmpl-' + uuid.uuid4().hex[:24], 'object': 'chat.completion', 'created': int(time.time()),
+            'model': body.get('model', 'gpt-4o-mini'),
+            'choices': [{'index': 0, 'finish_reason': 'stop', 'message': {'role': 'assistant', 'content': text}}],
+            'usage': {'prompt_tokens': len(prompt) // 4, 'completion_tokens': len(text) // 4,
+                      'total_tokens': len(prompt) // 4 + len(text) // 4}
+        }
+
+    def create_thread(self, query, body):
+        thread_id = 'thread_' + uuid.uuid4().hex[:24]
+        with self.lock:
+            self.threads[thread_id] = []
+        return 200, {'id': thread_id, 'object': 'thread', 'created_at': int(time.time()), 'metadata': {}}
+
+    def delete_thread(self, query, body, thread_id):
+        with self.lock:
+            self.threads.pop(thread_id, None)
+        return 200, {'id': thread_id, 'object': 'thread.deleted', 'deleted': True}
+
+    def create_message(self, query, body, thread_id):
+        message = self.message(thread_id, 'user', (body or {}).get('content', ''))
+        with self.lock:
+            self.threads.setdefault(thread_id, []).append(message)
+        return 200, message
+
+    def list_messages(self, query, body, thread_id):
+        # order (default desc = newest first), limit (default 20) and an `after` cursor, like the real API
+        with self.lock:
+            data = list(self.threads.get(thread_id, []))
+        if query.get('order', ['desc'])[0] == 'desc':
+            data.reverse()
+        after = query.get('after', [None])[0]
+        if after:
+            ids = [m['id'] for m in data]
+            data = data[ids.index(after) + 1:] if after in ids else []
+        limit = int(query.get('limit', [20])[0])
+        page = data[:limit]
+        return 200, {'object': 'list', 'data': page, 'first_id': page[0]['id'] if page else None,
+                     'last_id': page[-1]['id'] if page else None, 'has_more': len(data) > limit}
+
+    def create_run(self, query, body, thread_id):
+        run_id = 'run_' + uuid.uuid4().hex[:24]
+        with self.lock:
+            self.runs[run_id] = {'thread_id': thread_id, 'assistant_id': (body or {}).get('assistant_id'),
+                                 'created_at': int(time.time()), 'started': time.monotonic(), 'answered': False}
+            return 200, self.run_payload(run_id)
+
+    def get_run(self, query, body, thread_id, run_id):
+        with self.lock:
+            if run_id not in self.runs:
+                return 404, {'error': {'message': f'No run found with id {run_id}'}}
+            return 200, self.run_payload(run_id)
+
+
+def start_fake_upstreams(minicrm=None, gmail=None, openai=None, **options):
+    """Start all three fakes; returns {'minicrm': FakeMiniCRM, 'gmail': FakeGmail, 'openai': FakeOpenAI}"""
+    return {
+        'minicrm': FakeMiniCRM(minicrm, projects=options.get('projects', 230)).start(),
+        'gmail': FakeGmail(gmail, messages=options.get('messages', 20)).start(),
+        'openai': FakeOpenAI(openai, run_seconds=options.get('run_seconds', 1.0)).start(),
+    }
+
+
+def app_environment(fakes):
+    """Environment variables that point app.py at the fakes (set before importing app)"""
+    return {
+        'MINICRM_SYSTEM_ID': '12345',
+        'MINICRM_API_KEY': 'bench-key',
+        'MINICRM_API_URL': fakes['minicrm'].url,
+        'GMAIL_API_URL': fakes['gmail'].url + '/',
+        'OPENAI_API_KEY': 'sk-bench',
+        'OPENAI_BASE_URL': fakes['openai'].url,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run fake MiniCRM/Gmail/OpenAI servers')
+    for name in ('minicrm', 'gmail', 'openai'):
+        parser.add_argument(f'--{name}-latency-ms', type=float, default=0)
+        parser.add_argument(f'--{name}-error-rate', type=float, default=0)
+    args = parser.parse_args()
+
+    fakes = start_fake_upstreams(**{
+        name: UpstreamConfig(getattr(args, f'{name}_latency_ms'), error_rate=getattr(args, f'{name}_error_rate'))
+        for name in ('minicrm', 'gmail', 'openai')
+    })
+    print("Fake upstreams running - start the app with:")
+    for key, value in app_environment(fakes).items():
+        print(f"  export {key}={value}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for fake in fakes.values():
+            fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,346 @@
+"""
+Load test: concurrent salespeople replaying realistic sessions
+Boots the production command from the Procfile (gunicorn, 2 workers, --preload) against the fake
+upstreams in fake_upstreams.py, then ramps up virtual users. Each user repeatedly picks a journey:
+
+    contact  - load_emails -> find_contact -> get_todos -> send_message   (most common)
+    morning  - daily_todos (resuming partial results via cursor)
+    bulk     - upload_excel (CSV) -> send_bulk_emails (resuming via next_index)
+
+and waits a random think time between steps. For every concurrency stage the report shows
+throughput, p50/p95/p99 and error rate per route, and the stage at which each route first
+breaks its error or latency budget ("onset"). Results are also written as JSON.
+
+Usage:
+    python benchmarks/load_test.py [--stages 1,2,4,8,16] [--stage-seconds 30] [--think-seconds 2]
+                                   [--url http://127.0.0.1:5000]   # test an already running app
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from urllib.parse import urlparse
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.abspath(os.path.join(BENCH_DIR, '..'))
+RESULTS_DIR = os.path.join(BENCH_DIR, 'results')
+sys.path.insert(0, BENCH_DIR)
+
+from fake_upstreams import FakeGmail, UpstreamConfig, app_environment, start_fake_upstreams  # noqa: E402
+
+SECRET_KEY = 'load-test-secret'
+AUTH = ('loadtest', 'loadtest')
+JOURNEYS = {'contact': 0.7, 'morning': 0.2, 'bulk': 0.1}
+
+GMAIL_TOKEN = {
+    'token': 'load-test-access-token',
+    'refresh_token': 'load-test-refresh-token',
+    'token_uri': 'https://oauth2.googleapis.com/token',
+    'client_id': 'load-test-client',
+    'client_secret': 'load-test-secret',
+    'scopes': ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.send']
+}
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def session_cookie(data):
+    """A Flask session cookie the app accepts (same secret key) - stands in for the Gmail OAuth flow"""
+    from flask import Flask
+    from flask.sessions import SecureCookieSessionInterface
+    signer = Flask('load_test')
+    signer.secret_key = SECRET_KEY
+    return SecureCookieSessionInterface().get_signing_serializer(signer).dumps(data)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def procfile_command(port):
+    """The web command from the Procfile, bound to a local port"""
+    with open(os.path.join(APP_DIR, 'Procfile'), 'r') as f:
+        line = next(line for line in f if line.startswith('web:'))
+    command = line.split(':', 1)[1].strip().replace('0.0.0.0:$PORT', f'127.0.0.1:{port}')
+    return shlex.split(command)
+
+
+def start_app(fakes, scratch):
+    """Start gunicorn like production does; return (process, base URL)"""
+    port = free_port()
+    env = dict(os.environ)
+    env.update(app_environment(fakes))
+    env.update({
+        'FLASK_SECRET_KEY': SECRET_KEY,
+        'BASIC_AUTH_USERS': f'{AUTH[0]}:{AUTH[1]}',
+        'CACHE_DB_PATH': os.path.join(scratch, 'cache.sqlite3'),
+        'BULK_DB_PATH': os.path.join(scratch, 'bulk.sqlite3'),
+        'CONVERSATION_DB_PATH': os.path.join(scratch, 'conversations.sqlite3'),
+        'PROMETHEUS_MULTIPROC_DIR': os.path.join(scratch, 'metrics'),
+        'LOG_LEVEL': os.getenv('LOG_LEVEL', 'WARNING'),
+    })
+    env.pop('FLASK_ENV', None)  # Plain-HTTP session cookies
+    process = subprocess.Popen(procfile_command(port), cwd=APP_DIR, env=env)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.get(url + '/api/check_config', auth=AUTH, timeout=1)
+            return process, url
+        except requests.ConnectionError:
+            if process.poll() is not None:
+                sys.exit("❌ gunicorn exited during startup")
+            time.sleep(0.2)
+    process.terminate()
+    sys.exit("❌ gunicorn did not start within 20s")
+
+
+class Recorder:
+    """Thread-safe store of (stage, route, latency ms, ok) samples"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = []
+
+    def add(self, stage, route, elapsed_ms, ok):
+        with self.lock:
+            self.samples.append((stage, route, elapsed_ms, ok))
+
+
+class VirtualUser:
+    """One salesperson: own HTTP session (cookies), picks journeys until stopped"""
+
+    def __init__(self, user_id, url, recorder, think_seconds, bulk_contacts):
+        self.user_id = user_id
+        self.url = url
+        self.recorder = recorder
+        self.think_seconds = think_seconds
+        self.bulk_contacts = bulk_contacts
+        self.random = random.Random(user_id)
+        self.http = requests.Session()
+        self.http.auth = AUTH
+        # Same domain the server's Set-Cookie will use, so updates replace this cookie instead of shadowing it
+        self.http.cookies.set('session', session_cookie({
+            'gmail_token': GMAIL_TOKEN, 'gmail_user_email': FakeGmail.MAILBOX
+        }), domain=urlparse(url).hostname, path='/')
+        self.stage = None
+
+    def call(self, route, **kwargs):
+        """POST/GET a route and record it; returns parsed JSON (or None on failure)"""
+        method = 'GET' if 'json' not in kwargs and 'files' not in kwargs else 'POST'
+        start = time.perf_counter()
+        try:
+            response = self.http.request(method, self.url + route, timeout=130, **kwargs)
+            ok = response.status_code < 400
+            data = response.json() if response.headers.get('Content-Type', '').startswith('application/json') else None
+        except requests.RequestException:
+            ok, data = False, None
+        self.recorder.add(self.stage, route, (time.perf_counter() - start) * 1000, ok)
+        return data if ok else None
+
+    def think(self, stop):
+        stop.wait(self.random.expovariate(1 / self.think_seconds) if self.think_seconds else 0)
+
+    def contact_journey(self, stop):
+        email = f'ugyfel{self.random.randint(1, 40)}@example.hu'  # Shared customers overlap between users
+        self.call('/api/load_emails', json={'email': email})
+        self.think(stop)
+        contact = self.call('/api/minicrm/find_contact', json={'email': email})
+        if contact and contact.get('found'):
+            self.call('/api/minicrm/get_todos', json={
+                'business_ids': contact['contact']['business_ids'], 'contact_name': contact['contact']['name']
+            })
+        self.think(stop)
+        body = {'message': f'Írj választ {email} levelére', 'assistant': 'Marketing Expert',
+                'session_id': f'load-{self.user_id}'}
+        data = self.call('/api/send_message', json=body)
+        while data and data.get('complete') is False and not stop.is_set():
+            data = self.call('/api/send_message', json=dict(body, message=None, run_id=data['run_id']))
+
+    def morning_journey(self, stop):
+        body = {'category_id': self.random.choice([23, 41]), 'filter_user': str(120420 + self.user_id % 4),
+                'lookback_days': 30}
+        data = self.call('/api/minicrm/daily_todos', json=body)
+        while data and data.get('complete') is False and data.get('cursor') and not stop.is_set():
+            data = self.call('/api/minicrm/daily_todos', json=dict(body, cursor=data['cursor']))
+
+    def bulk_journey(self, stop):
+        upload = self.call('/api/upload_excel', files={'file': ('contacts.csv', self.bulk_contacts, 'text/csv')})
+        if not upload:
+            return
+        self.think(stop)
+        body = {'sender_name': 'Load Test', 'subject': 'Ajánlat', 'body': 'Kedves {person}!', 'signature': ''}
+        data = self.call('/api/send_bulk_emails', json=body)
+        while data and data.get('complete') is False and not stop.is_set():
+            data = self.call('/api/send_bulk_emails', json=dict(body, start_index=data['next_index']))
+
+    def run(self, stage, stop):
+        self.stage = stage
+        journeys = {'contact': self.contact_journey, 'morning': self.morning_journey, 'bulk': self.bulk_journey}
+        while not stop.is_set():
+            name = self.random.choices(list(JOURNEYS), weights=list(JOURNEYS.values()))[0]
+            journeys[name](stop)
+            self.think(stop)
+
+
+def summarize(samples, stage_seconds):
+    """{stage: {route: stats}} from recorded samples"""
+    grouped = defaultdict(list)
+    for stage, route, elapsed_ms, ok in samples:
+        grouped[(stage, route)].append((elapsed_ms, ok))
+    summary = defaultdict(dict)
+    for (stage, route), values in sorted(grouped.items()):
+        latencies = sorted(v[0] for v in values)
+        errors = sum(1 for v in values if not v[1])
+        summary[stage][route] = {
+            'requests': len(values),
+            'throughput_rps': round(len(values) / stage_seconds, 2),
+            'error_rate': round(errors / len(values), 4),
+            'p50_ms': round(percentile(latencies, 50), 1),
+            'p95_ms': round(percentile(latencies, 95), 1),
+            'p99_ms': round(percentile(latencies, 99), 1),
+        }
+    return summary
+
+
+def error_onset(summary, max_error_rate, slo_ms):
+    """First stage (concurrency) at which each route breaks its error or p95 budget"""
+    onset = {}
+    for stage in sorted(summary):
+        for route, stats in summary[stage].items():
+            if route in onset:
+                continue
+            if stats['error_rate'] > max_error_rate:
+                onset[route] = {'users': stage, 'reason': f"error rate {stats['error_rate']:.1%}"}
+            elif stats['p95_ms'] > slo_ms.get(route, slo_ms['default']):
+                onset[route] = {'users': stage, 'reason': f"p95 {stats['p95_ms']:.0f} ms"}
+    return onset
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ramp concurrent virtual salespeople against the app')
+    parser.add_argument('--stages', default='1,2,4,8,16', help='concurrent users per stage')
+    parser.add_argument('--stage-seconds', type=float, default=30)
+    parser.add_argument('--think-seconds', type=float, default=2.0, help='mean think time between steps')
+    parser.add_argument('--url', help='target an already running app instead of starting gunicorn')
+    parser.add_argument('--minicrm-latency-ms', type=float, default=40)
+    parser.add_argument('--gmail-latency-ms', type=float, default=60)
+    parser.add_argument('--openai-latency-ms', type=float, default=150)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='injected upstream failure rate')
+    parser.add_argument('--projects', type=int, default=230)
+    parser.add_argument('--bulk-size', type=int, default=5, help='contacts per bulk upload')
+    parser.add_argument('--max-error-rate', type=float, default=0.01)
+    parser.add_argument('--slo-ms', type=float, default=5000, help='p95 budget for interactive routes')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/load-<timestamp>.json)')
+    args = parser.parse_args()
+    stages = [int(s) for s in args.stages.split(',')]
+
+    fakes = start_fake_upstreams(
+        minicrm=UpstreamConfig(args.minicrm_latency_ms, error_rate=args.error_rate),
+        gmail=UpstreamConfig(args.gmail_latency_ms, error_rate=args.error_rate),
+        openai=UpstreamConfig(args.openai_latency_ms, error_rate=args.error_rate),
+        projects=args.projects
+    )
+    scratch = tempfile.mkdtemp(prefix='prv_load_')
+    process = None
+    if args.url:
+        url = args.url.rstrip('/')
+        print("⚠️  --url: the target app must already be configured with the fake upstream URLs and secret key")
+    else:
+        process, url = start_app(fakes, scratch)
+        print(f"✅ gunicorn started ({' '.join(procfile_command(0)[1:])}) at {url}")
+
+    csv_buffer = io.StringIO()
+    writer = csv.writer(csv_buffer)
+    writer.writerow(['company', 'person', 'email'])
+    for i in range(args.bulk_size):
+        writer.writerow([f'Példa {i} Kft.', f'Ügyfél {i}', f'ugyfel{i}@example.hu'])
+    bulk_contacts = csv_buffer.getvalue().encode('utf-8')
+
+    recorder = Recorder()
+    try:
+        for users in stages:
+            print(f"▶ {users} concurrent user(s) for {args.stage_seconds:.0f}s...")
+            stop = threading.Event()
+            threads = []
+            for user_id in range(users):
+                user = VirtualUser(user_id, url, recorder, args.think_seconds, bulk_contacts)
+                thread = threading.Thread(target=user.run, args=(users, stop), daemon=True)
+                thread.start()
+                threads.append(thread)
+            time.sleep(args.stage_seconds)
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=150)  # Let in-flight requests finish (counted in this stage)
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=30)
+        for fake in fakes.values():
+            fake.stop()
+
+    summary = summarize(recorder.samples, args.stage_seconds)
+    # Long-running routes get a budget of their own - they return partial results before gunicorn's timeout
+    slo_ms = {'default': args.slo_ms, '/api/minicrm/daily_todos': 110000, '/api/send_bulk_emails': 110000}
+    onset = error_onset(summary, args.max_error_rate, slo_ms)
+
+    for stage in stages:
+        print(f"\n{stage} user(s)")
+        print(f"{'route':<30}{'reqs':>6}{'req/s':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        print('-' * 82)
+        for route, stats in summary.get(stage, {}).items():
+            print(f"{route:<30}{stats['requests']:>6}{stats['throughput_rps']:>8.2f}{stats['error_rate']:>8.1%}"
+                  f"{stats['p50_ms']:>10.0f}{stats['p95_ms']:>10.0f}{stats['p99_ms']:>10.0f}")
+
+    print("\nOnset (first stage over budget)")
+    routes = sorted({route for stage in summary.values() for route in stage})
+    for route in routes:
+        if route in onset:
+            print(f"  ❌ {route:<30} {onset[route]['users']} users - {onset[route]['reason']}")
+        else:
+            print(f"  ✅ {route:<30} within budget up to {stages[-1]} users")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump({
+            'meta': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'command': None if args.url else ' '.join(procfile_command(0)),
+                'stages': stages,
+                'stage_seconds': args.stage_seconds,
+                'think_seconds': args.think_seconds,
+                'upstream_latency_ms': {'minicrm': args.minicrm_latency_ms, 'gmail': args.gmail_latency_ms,
+                                        'openai': args.openai_latency_ms},
+                'error_rate': args.error_rate,
+            },
+            'stages': {str(stage): routes for stage, routes in summary.items()},
+            'onset': onset
+        }, f, indent=2, ensure_ascii=False)
+    print(f"\nResults written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+PRV AI Marketing Assistant - Static asset build step
+Minifies JS/CSS, writes content-hashed copies to static/dist/ with precompressed
+.gz/.br variants, and records the mapping in static/dist/manifest.json.
+
+Run before starting the server in production:
+    python build_assets.py
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+# Minifiers and Brotli are optional - without them assets are only hashed/gzipped
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST_FOLDER = os.path.join(STATIC_FOLDER, 'dist')
+MANIFEST_PATH = os.path.join(DIST_FOLDER, 'manifest.json')
+
+# Source files (relative to static/) referenced from templates/index.html
+ASSETS = ['js/app.js', 'css/style.css']
+
+
+def minify(path, source):
+    """Minify JS/CSS source if the minifier is installed"""
+    if path.endswith('.js') and rjsmin is not None:
+        return rjsmin.jsmin(source)
+    if path.endswith('.css') and rcssmin is not None:
+        return rcssmin.cssmin(source)
+    return source
+
+
+def hashed_name(path, content):
+    """js/app.js -> js/app.<12 hex chars of sha256>.js"""
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    base, ext = os.path.splitext(path)
+    return f'{base}.{digest}{ext}'
+
+
+def build():
+    """Build all assets and write the manifest"""
+    # Start from a clean dist folder so stale hashed files don't pile up
+    if os.path.exists(DIST_FOLDER):
+        shutil.rmtree(DIST_FOLDER)
+    os.makedirs(DIST_FOLDER)
+
+    manifest = {}
+    for path in ASSETS:
+        with open(os.path.join(STATIC_FOLDER, path), 'r', encoding='utf-8') as f:
+            source = f.read()
+
+        content = minify(path, source).encode('utf-8')
+        output_name = hashed_name(path, content)
+        output_path = os.path.join(DIST_FOLDER, output_name)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        with open(output_path, 'wb') as f:
+            f.write(content)
+
+        # mtime=0 keeps the .gz output byte-for-byte reproducible between builds
+        with open(output_path + '.gz', 'wb') as f:
+            f.write(gzip.compress(content, compresslevel=9, mtime=0))
+
+        sizes = f"{len(source.encode('utf-8'))} -> {len(content)} bytes, gz {os.path.getsize(output_path + '.gz')}"
+
+        if brotli is not None:
+            with open(output_path + '.br', 'wb') as f:
+                f.write(brotli.compress(content, quality=11))
+            sizes += f", br {os.path.getsize(output_path + '.br')}"
+
+        manifest[path] = f'dist/{output_name}'
+        print(f"✅ {path} -> dist/{output_name} ({sizes})")
+
+    with open(MANIFEST_PATH, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    if rjsmin is None or rcssmin is None:
+        print("⚠️  rjsmin/rcssmin not installed - some assets were not minified")
+    if brotli is None:
+        print("⚠️  Brotli not installed - .br variants were not generated")
+
+    return manifest
+
+
+if __name__ == '__main__':
+    build()
@@ -0,0 +1,16 @@
+"""
+Gunicorn server hooks (loaded automatically from the working directory)
+Bind address, worker count and timeout stay on the command line in Procfile / nixpacks.toml.
+"""
+
+
+def post_worker_init(worker):
+    """Start the scheduled-delivery thread (only one worker at a time actually sends, see DeliveryScheduler)"""
+    from app import delivery_scheduler
+    delivery_scheduler.start()
+
+
+def child_exit(server, worker):
+    """Drop the exited worker's live gauges from the shared Prometheus metrics"""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,9 +1,20 @@
 // Modern Chat Application
-let sessionId = 'session_' + Date.now();
+// The chat session survives page reloads - its history is restored from the server (see loadConversationHistory)
+function newSessionId() {
+    // Random, so a session id can't be guessed (the server also checks who owns it)
+    const bytes = crypto.getRandomValues(new Uint8Array(16));
+    return 'session_' + Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+}
+let sessionId = localStorage.getItem('chatSessionId');
+if (!sessionId || /^session_\d+$/.test(sessionId)) {
+    sessionId = newSessionId();  // Also replaces the old timestamp ids
+}
+localStorage.setItem('chatSessionId', sessionId);
 let currentAssistant = 'Marketing Expert';
 let isProcessing = false;
 let currentEmails = [];
 let currentEmailAddress = '';
+let currentEmailSummary = null;  // Server-side summary of currentEmails (used instead of the full bodies)
 
 // Email prompts - stored in localStorage (starts empty so users can customize)
 let emailPrompts = JSON.parse(localStorage.getItem('emailPrompts')) || [];
@@ -321,6 +332,9 @@ function initializeApp() {
     // Update assistant description
     updateAssistantDescription();
     
+    // Restore the conversation after a page reload
+    loadConversationHistory();
+    
     // Event listeners
     sendBtn.addEventListener('click', sendMessage);
     messageInput.addEventListener('keydown', function(e) {
@@ -536,6 +550,8 @@ async function loadEmails() {
         if (response.ok) {
             currentEmails = data.emails;
             currentEmailAddress = data.email;
+            currentEmailSummary = null;
+            loadEmailSummary();
             
             // Add system message
             addSystemMessage(`✅ Loaded ${data.count} emails from ${email}. Now when you send a message, it will open ChatGPT with the full email context.`);
@@ -558,7 +574,9 @@ async function loadEmails() {
             messageInput.focus();
             
             // Show toast notification instead of alert
-            showToast(`✅ Successfully loaded ${data.count} emails!`, 'success');
+            if (!warnIfDegraded(data)) {
+                showToast(`✅ Successfully loaded ${data.count} emails!`, 'success');
+            }
         } else {
             // Check if needs Gmail authorization
             if (data.needs_auth) {
@@ -707,7 +725,7 @@ async function sendMessage() {
     
     try {
         // Send to backend
-        const response = await fetch('/api/send_message', {
+        let response = await fetch('/api/send_message', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json'
@@ -719,7 +737,23 @@ async function sendMessage() {
             })
         });
         
-        const data = await response.json();
+        let data = await response.json();
+        
+        // Long assistant runs outlive one request - resume polling the same run
+        while (response.ok && data.complete === false) {
+            response = await fetch('/api/send_message', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    run_id: data.run_id,
+                    assistant: currentAssistant,
+                    session_id: sessionId
+                })
+            });
+            data = await response.json();
+        }
         
         // Remove typing indicator
         hideTypingIndicator();
@@ -811,8 +845,12 @@ ${'='.repeat(60)}
 
 `;
 
-    // Add email history (full bodies)
-    currentEmails.slice(0, 10).forEach((conv, i) => {
+    // Summarized history + the latest email in full, or the full bodies until the summary is ready
+    const contextEmails = currentEmailSummary ? currentEmails.slice(0, 1) : currentEmails.slice(0, 10);
+    if (currentEmailSummary) {
+        prompt += `SUMMARY OF ${currentEmails.length} EMAILS:\n${currentEmailSummary.summary}\n${'-'.repeat(60)}\n\nLATEST EMAIL:\n`;
+    }
+    contextEmails.forEach((conv, i) => {
         let body = conv.body || '';
         // Keep full body but limit to 1000 chars
         if (body.length > 1000) {
@@ -861,6 +899,30 @@ Now, provide a concrete, practical email response IN ${lastEmailLanguage.toUpper
     });
 }
 
+async function loadEmailSummary() {
+    // Summarize the loaded history in the background - the prompt uses it once it's ready
+    const email = currentEmailAddress;
+    const messageIds = currentEmails.map(conv => conv.id);
+    if (messageIds.length < 2) return;  // Nothing to compress
+    
+    try {
+        const response = await fetch('/api/email_summary', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ email: email, message_ids: messageIds })
+        });
+        const data = await response.json();
+        if (!response.ok || email !== currentEmailAddress) return;  // Keep the full bodies
+        
+        currentEmailSummary = data;
+        addSystemMessage(`📝 Email history summarized: ~${data.context_tokens.toLocaleString()} → ~${data.summary_tokens.toLocaleString()} tokens per prompt`);
+    } catch (error) {
+        console.error('Error summarizing emails:', error);
+    }
+}
+
 function sendSuggestion(text) {
     const messageInput = document.getElementById('message-input');
     messageInput.value = text;
@@ -938,6 +1000,24 @@ function updateSendButton(disabled) {
     sendBtn.disabled = disabled;
 }
 
+async function loadConversationHistory() {
+    try {
+        const response = await fetch(`/api/conversation/${encodeURIComponent(sessionId)}?order=desc&limit=50`);
+        if (!response.ok) return;  // 404: nothing said in this session yet
+        
+        const data = await response.json();
+        if (data.messages.length === 0) return;
+        
+        hideWelcome();
+        if (data.has_more) {
+            addSystemMessage('Earlier messages are not shown');
+        }
+        data.messages.reverse().forEach(message => addMessage(message.role, message.content));
+    } catch (error) {
+        console.error('Error loading conversation history:', error);
+    }
+}
+
 function hideWelcome() {
     const welcome = document.querySelector('.welcome-message');
     if (welcome) {
@@ -990,7 +1070,8 @@ async function clearConversation() {
             `;
         
         // Generate new session ID
-        sessionId = 'session_' + Date.now();
+        sessionId = newSessionId();
+        localStorage.setItem('chatSessionId', sessionId);
         
     } catch (error) {
         alert('Failed to clear conversation');
@@ -3334,6 +3415,26 @@ function showToast(message, type = 'info') {
     }, 3000);
 }
 
+// Upstreams the server is failing fast for (circuit breaker open) - see /api/upstream_status
+const UPSTREAM_NAMES = { minicrm: 'MiniCRM', gmail: 'Gmail', openai: 'OpenAI' };
+
+function warnIfDegraded(data) {
+    // Returns true (and warns) when the response says results are limited by a failing upstream
+    if (!data || !data.degraded || data.degraded.length === 0) {
+        return false;
+    }
+    const names = data.degraded.map(name => UPSTREAM_NAMES[name] || name).join(', ');
+    showToast(`⚠️ ${names} is having problems - results may be incomplete. Try again in a minute.`, 'warning');
+    return true;
+}
+
+function escapeHtml(text) {
+    // For untrusted text (e.g. AI output) interpolated into innerHTML templates
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
 // Add CSS animations if not already present
 if (!document.getElementById('toast-animations')) {
     const style = document.createElement('style');
@@ -3367,6 +3468,13 @@ if (!document.getElementById('toast-animations')) {
 // ============================================================================
 
 let bulkEmailContacts = [];
+let bulkEmailEnrichment = {};     // row index -> MiniCRM enrichment row
+let bulkEmailSelection = null;    // emails to send to (null = all contacts)
+let personalizeJobId = null;      // AI-personalized openers for {{opener}}
+let personalizeDraftsShown = 0;
+let campaignSpool = null;         // { id, fields } - pre-rendered messages, used while the fields are unchanged
+let campaignPreviewOffset = 0;
+let uploadSniff = null;           // Sheets and proposed columns of the uploaded file, until the user confirms
 
 function openBulkEmailModal() {
     // Check Gmail connection first
@@ -3449,7 +3557,34 @@ function openBulkEmailModal() {
                 📁 Choose Excel/CSV File
             </button>
             <div id="file-status" style="margin-top: 12px; font-size: 14px; color: #666;"></div>
+            <div id="column-mapping" style="margin-top: 16px; display: none;"></div>
             <div id="contacts-preview" style="margin-top: 16px; display: none;"></div>
+            <div id="enrich-section" style="margin-top: 16px; display: none;">
+                <button onclick="enrichBulkContacts()" id="enrich-btn" style="
+                    padding: 10px 20px;
+                    background: white;
+                    color: #667eea;
+                    border: 2px solid #667eea;
+                    border-radius: 8px;
+                    font-size: 14px;
+                    font-weight: 600;
+                    cursor: pointer;
+                ">
+                    🔎 Check contacts in MiniCRM
+                </button>
+                <div id="enrich-status" style="margin-top: 12px; font-size: 14px; color: #666;"></div>
+                <div id="enrich-filter" style="margin-top: 12px; display: none; font-size: 14px; color: #2c3e50;">
+                    <select id="enrich-filter-mode" onchange="applyEnrichmentFilter()" style="padding: 8px; border: 2px solid #dee2e6; border-radius: 8px; font-size: 14px;">
+                        <option value="all">All contacts</option>
+                        <option value="in">Only contacts in MiniCRM</option>
+                        <option value="not_in">Only contacts NOT in MiniCRM</option>
+                    </select>
+                    <label style="margin-left: 12px; cursor: pointer;">
+                        <input type="checkbox" id="enrich-skip-open-todos" onchange="applyEnrichmentFilter()">
+                        Skip contacts with open todos
+                    </label>
+                </div>
+            </div>
         </div>
         
         <!-- Step 2: Compose Email -->
@@ -3538,12 +3673,96 @@ www.prv.hu</textarea>
             <div style="background: #fff3cd; border: 1px solid #ffc107; padding: 12px; border-radius: 8px; font-size: 13px; color: #856404;">
                 <strong>💡 Tip:</strong> Use placeholders like <code>{{company}}</code>, <code>{{person}}</code>, and <code>{{email}}</code> to personalize each email automatically.
             </div>
+            
+            <!-- Optional: AI-personalized openers -->
+            <div style="margin-top: 16px; padding: 16px; background: white; border: 2px dashed #9b59b6; border-radius: 8px;">
+                <label style="display: block; font-weight: 600; margin-bottom: 8px; color: #2c3e50;">
+                    ✨ AI-Personalized Opener (optional):
+                </label>
+                <textarea id="personalize-prompt" placeholder="e.g., Write a friendly opener that mentions the company and how PRV could help them" style="
+                    width: 100%;
+                    padding: 12px;
+                    border: 2px solid #dee2e6;
+                    border-radius: 8px;
+                    font-size: 14px;
+                    font-family: inherit;
+                    min-height: 60px;
+                    box-sizing: border-box;
+                    resize: vertical;
+                "></textarea>
+                <div style="font-size: 12px; color: #6c757d; margin: 4px 0 12px 0;">
+                    The selected assistant writes one opener per contact. Review the drafts, then put <code>{{opener}}</code> in the email body where it should go.
+                </div>
+                <button onclick="startPersonalizeJob()" id="personalize-btn" style="
+                    padding: 10px 20px;
+                    background: #9b59b6;
+                    color: white;
+                    border: none;
+                    border-radius: 8px;
+                    font-size: 14px;
+                    font-weight: 600;
+                    cursor: pointer;
+                ">
+                    ✨ Generate Personalized Openers
+                </button>
+                <div id="personalize-status" style="margin-top: 12px; font-size: 14px; color: #666;"></div>
+                <div id="personalize-drafts" style="margin-top: 12px; max-height: 300px; overflow-y: auto;"></div>
+            </div>
         </div>
         
         <!-- Step 3: Send -->
         <div class="bulk-step" style="padding: 20px; background: #f8f9fa; border-radius: 12px; border: 2px solid #e9ecef; opacity: 0.6; pointer-events: none;" id="send-section">
             <h3 style="margin: 0 0 16px 0; color: #2c3e50; font-size: 18px;">Step 3: Send Emails</h3>
             <div id="send-status" style="margin-bottom: 16px; font-size: 14px;"></div>
+            
+            <!-- Send history rules (unsubscribes are always skipped) -->
+            <div style="margin-bottom: 16px; padding: 12px; background: white; border: 1px solid #dee2e6; border-radius: 8px; font-size: 14px; color: #2c3e50;">
+                <div style="margin-bottom: 8px;">
+                    <label style="font-weight: 600;">Campaign:</label>
+                    <input type="text" id="bulk-campaign" placeholder="defaults to the subject line" style="padding: 6px; border: 1px solid #dee2e6; border-radius: 6px; width: 60%;">
+                </div>
+                <label style="display: block; margin-bottom: 6px; cursor: pointer;">
+                    <input type="checkbox" id="skip-sent-in-campaign" checked>
+                    Skip contacts who already received this campaign
+                </label>
+                <label style="display: block; margin-bottom: 8px; cursor: pointer;">
+                    <input type="checkbox" id="skip-recent-enabled">
+                    Skip contacts emailed in the last
+                    <input type="number" id="skip-recent-days" value="14" min="1" style="width: 60px; padding: 4px;"> days
+                </label>
+                <button onclick="checkSendHistory()" style="padding: 6px 12px; cursor: pointer;">🔍 Check send history</button>
+                <button onclick="addSuppressions()" style="padding: 6px 12px; cursor: pointer; margin-left: 8px;">🚫 Add unsubscribes</button>
+                <div id="send-history-status" style="margin-top: 8px; color: #666;"></div>
+            </div>
+            
+            <!-- Sender pool: spread the send over several authorized Gmail accounts -->
+            <div style="margin-bottom: 16px; padding: 12px; background: white; border: 1px solid #dee2e6; border-radius: 8px; font-size: 14px; color: #2c3e50;">
+                <label style="display: block; margin-bottom: 8px; cursor: pointer; font-weight: 600;">
+                    <input type="checkbox" id="use-sender-pool">
+                    Send through the sender pool
+                    <select id="pool-strategy" style="margin-left: 8px; padding: 4px; font-weight: normal;">
+                        <option value="quota">weighted by remaining quota</option>
+                        <option value="round_robin">round-robin</option>
+                    </select>
+                </label>
+                <div id="sender-pool-list" style="margin-bottom: 8px; color: #666;"></div>
+                <button onclick="addSenderAccount()" style="padding: 6px 12px; cursor: pointer;">➕ Add connected Gmail account</button>
+            </div>
+            
+            <button onclick="renderCampaign()" id="render-campaign-btn" style="
+                padding: 14px 24px;
+                margin-right: 8px;
+                background: white;
+                color: #27ae60;
+                border: 2px solid #27ae60;
+                border-radius: 8px;
+                font-size: 16px;
+                font-weight: 600;
+                cursor: pointer;
+            ">
+                👁️ Render &amp; Preview
+            </button>
+            
             <button onclick="sendBulkEmails()" id="send-bulk-btn" style="
                 padding: 14px 32px;
                 background: #27ae60;
@@ -3559,12 +3778,23 @@ www.prv.hu</textarea>
             </button>
         </div>
         
+        <!-- Rendered campaign preview -->
+        <div id="campaign-preview" style="margin-top: 24px; display: none;"></div>
+        
+        <!-- Scheduled delivery: form (after rendering) and scheduled campaigns -->
+        <div id="schedule-section" style="margin-top: 24px; display: none;">
+            <div id="schedule-form"></div>
+            <div id="schedules-list"></div>
+        </div>
+        
         <!-- Results -->
         <div id="results-section" style="margin-top: 24px; display: none;"></div>
     `;
     
     modal.appendChild(modalContent);
     document.body.appendChild(modal);
+    loadSchedules();
+    loadSenderPool();
     
     // Close on overlay click
     modal.addEventListener('click', (e) => {
@@ -3580,31 +3810,141 @@ function closeBulkEmailModal() {
         modal.remove();
     }
     bulkEmailContacts = [];
+    bulkEmailEnrichment = {};
+    bulkEmailSelection = null;
+    personalizeJobId = null;
+    campaignSpool = null;
+    uploadSniff = null;
 }
 
 async function handleFileUpload(event) {
     const file = event.target.files[0];
     if (!file) return;
+    event.target.value = '';  // Choosing the same file again re-uploads it
     
     const fileStatus = document.getElementById('file-status');
-    fileStatus.innerHTML = '⏳ Uploading and parsing file...';
+    fileStatus.innerHTML = '⏳ Uploading and reading sheets...';
     fileStatus.style.color = '#ff9800';
     
     try {
+        // Only the first rows of each sheet are read here - the user confirms the sheet and columns
         const formData = new FormData();
         formData.append('file', file);
         
-        const response = await fetch('/api/upload_excel', {
+        const response = await fetch('/api/upload_excel/sniff', {
             method: 'POST',
             body: formData
         });
         
         const data = await response.json();
         
+        if (!response.ok) {
+            throw new Error(data.error);
+        }
+        uploadSniff = data;
+        fileStatus.innerHTML = `📄 ${escapeHtml(data.filename)}: check the sheet and columns, then load the contacts`;
+        fileStatus.style.color = '#666';
+        renderColumnMapping(data.suggested_sheet !== null ? data.suggested_sheet : 0);
+    } catch (error) {
+        fileStatus.innerHTML = `❌ Error: ${escapeHtml(error.message)}`;
+        fileStatus.style.color = '#e74c3c';
+        showToast(`❌ Failed to upload file: ${error.message}`, 'error');
+    }
+}
+
+function renderColumnMapping(sheetIndex) {
+    const sheet = uploadSniff.sheets[sheetIndex];
+    const columnLabel = (name, i) => name || `Column ${i + 1}`;
+    const width = Math.max(sheet.columns.length, ...sheet.preview.map(row => row.length));
+    const columns = Array.from({ length: width }, (_, i) => columnLabel(sheet.columns[i], i));
+    const labels = { company: '🏢 Company', person: '👤 Person', email: '📧 Email' };
+    
+    const container = document.getElementById('column-mapping');
+    container.style.display = 'block';
+    container.innerHTML = `
+        <div style="background: white; border: 2px solid #667eea; border-radius: 8px; padding: 16px; font-size: 14px;">
+            <div style="margin-bottom: 12px;">
+                <label style="font-weight: 600;">Sheet:</label>
+                <select id="mapping-sheet" onchange="renderColumnMapping(parseInt(this.value))" style="padding: 6px; border-radius: 6px;">
+                    ${uploadSniff.sheets.map((s, i) => `<option value="${i}" ${i === sheetIndex ? 'selected' : ''}>${escapeHtml(s.name)}</option>`).join('')}
+                </select>
+                <label style="font-weight: 600; margin-left: 12px;">Header row:</label>
+                <select id="mapping-header-row" style="padding: 6px; border-radius: 6px;">
+                    <option value="-1" ${sheet.header_row === -1 ? 'selected' : ''}>none</option>
+                    ${Array.from({ length: Math.max(sheet.header_row + 1, 10) }, (_, i) => `<option value="${i}" ${i === sheet.header_row ? 'selected' : ''}>${i + 1}</option>`).join('')}
+                </select>
+            </div>
+            <div style="display: flex; gap: 12px; flex-wrap: wrap; margin-bottom: 12px;">
+                ${uploadSniff.fields.map(field => `
+                    <label>${labels[field] || field}:
+                        <select id="mapping-${field}" style="padding: 6px; border-radius: 6px;">
+                            <option value="">-</option>
+                            ${columns.map((name, i) => `<option value="${i}" ${sheet.mapping[field] === i ? 'selected' : ''}>${escapeHtml(name)}</option>`).join('')}
+                        </select>
+                    </label>
+                `).join('')}
+            </div>
+            ${sheet.preview.length > 0 ? `
+                <div style="overflow-x: auto; margin-bottom: 12px;">
+                    <table style="border-collapse: collapse; font-size: 12px;">
+                        <tr>${columns.map(name => `<th style="border: 1px solid #dee2e6; padding: 4px 8px; background: #f8f9fa;">${escapeHtml(name)}</th>`).join('')}</tr>
+                        ${sheet.preview.map(row => `<tr>${columns.map((_, i) => `<td style="border: 1px solid #dee2e6; padding: 4px 8px;">${escapeHtml(row[i] || '')}</td>`).join('')}</tr>`).join('')}
+                    </table>
+                </div>
+            ` : '<div style="color: #666; margin-bottom: 12px;">This sheet looks empty.</div>'}
+            <button onclick="confirmColumnMapping()" id="confirm-mapping-btn" style="padding: 10px 20px; background: #27ae60; color: white; border: none; border-radius: 8px; font-weight: 600; cursor: pointer;">
+                ✅ Load Contacts
+            </button>
+        </div>
+    `;
+}
+
+async function confirmColumnMapping() {
+    const fileStatus = document.getElementById('file-status');
+    const button = document.getElementById('confirm-mapping-btn');
+    const sheet = uploadSniff.sheets[parseInt(document.getElementById('mapping-sheet').value)];
+    const mapping = {};
+    uploadSniff.fields.forEach(field => {
+        const value = document.getElementById(`mapping-${field}`).value;
+        if (value !== '') {
+            mapping[field] = parseInt(value);
+        }
+    });
+    
+    button.disabled = true;
+    fileStatus.innerHTML = '⏳ Loading contacts...';
+    fileStatus.style.color = '#ff9800';
+    
+    try {
+        const response = await fetch('/api/upload_excel', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                upload_id: uploadSniff.upload_id,
+                sheet: sheet.name,
+                header_row: parseInt(document.getElementById('mapping-header-row').value),
+                mapping: mapping
+            })
+        });
+        
+        const data = await response.json();
+        
         if (response.ok) {
+            uploadSniff = null;
+            document.getElementById('column-mapping').style.display = 'none';
             bulkEmailContacts = data.contacts;
+            bulkEmailEnrichment = {};
+            bulkEmailSelection = null;
+            personalizeJobId = null;
+            campaignSpool = null;
+            document.getElementById('campaign-preview').style.display = 'none';
+            document.getElementById('personalize-status').innerHTML = '';
+            document.getElementById('personalize-drafts').innerHTML = '';
+            document.getElementById('enrich-section').style.display = 'block';
+            document.getElementById('enrich-status').innerHTML = '';
+            document.getElementById('enrich-filter').style.display = 'none';
             
-            fileStatus.innerHTML = `✅ Successfully loaded ${data.total_contacts} contacts!`;
+            fileStatus.innerHTML = `✅ Successfully loaded ${data.total_contacts} contacts from sheet ${escapeHtml(data.sheet)}!`;
             fileStatus.style.color = '#27ae60';
             
             // Show preview
@@ -3644,17 +3984,651 @@ async function handleFileUpload(event) {
             
             showToast(`✅ Successfully loaded ${data.total_contacts} contacts!`, 'success');
         } else {
-            fileStatus.innerHTML = `❌ Error: ${data.error}`;
+            fileStatus.innerHTML = `❌ Error: ${escapeHtml(data.error)}`;
             fileStatus.style.color = '#e74c3c';
             showToast(`❌ ${data.error}`, 'error');
         }
     } catch (error) {
-        fileStatus.innerHTML = `❌ Error: ${error.message}`;
+        fileStatus.innerHTML = `❌ Error: ${escapeHtml(error.message)}`;
         fileStatus.style.color = '#e74c3c';
-        showToast(`❌ Failed to upload file: ${error.message}`, 'error');
+        showToast(`❌ Failed to load contacts: ${error.message}`, 'error');
+    } finally {
+        button.disabled = false;
+    }
+}
+
+async function enrichBulkContacts() {
+    const enrichBtn = document.getElementById('enrich-btn');
+    const enrichStatus = document.getElementById('enrich-status');
+    enrichBtn.disabled = true;
+    
+    try {
+        // Rows arrive as NDJSON while the server works through the list. A run that hits the
+        // time budget ends with complete: false - re-post with the emails still missing
+        while (true) {
+            const done = new Set(Object.values(bulkEmailEnrichment).map(row => row.email.trim().toLowerCase()));
+            const pending = [...new Set(bulkEmailContacts.map(c => c.email.trim().toLowerCase()))]
+                .filter(email => !done.has(email));
+            if (pending.length === 0) {
+                break;
+            }
+            
+            const response = await fetch('/api/enrich_contacts', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({ emails: pending })
+            });
+            
+            if (!response.ok) {
+                const data = await response.json();
+                enrichStatus.innerHTML = `❌ Error: ${data.error}`;
+                showToast(`❌ ${data.error}`, 'error');
+                return;
+            }
+            
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let finished = null;
+            
+            while (true) {
+                const { value, done: streamDone } = await reader.read();
+                if (streamDone) break;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                
+                for (const line of lines) {
+                    if (!line.trim()) continue;
+                    const message = JSON.parse(line);
+                    if (message.type === 'row') {
+                        bulkEmailEnrichment[message.index] = message;
+                    } else if (message.type === 'done') {
+                        finished = message;
+                    }
+                }
+                enrichStatus.innerHTML = `⏳ Checking contacts in MiniCRM... ${Object.keys(bulkEmailEnrichment).length}/${bulkEmailContacts.length}`;
+            }
+            
+            // Connection dropped, or MiniCRM is failing - keep what we have
+            if (!finished || finished.complete !== false || warnIfDegraded(finished)) {
+                break;
+            }
+        }
+        
+        const checked = Object.values(bulkEmailEnrichment);
+        const inMiniCRM = checked.filter(row => row.in_minicrm).length;
+        const withTodos = checked.filter(row => row.open_todos > 0).length;
+        enrichStatus.innerHTML = `✅ ${checked.length}/${bulkEmailContacts.length} checked: ${inMiniCRM} in MiniCRM, ${withTodos} with open todos`;
+        document.getElementById('enrich-filter').style.display = 'block';
+        applyEnrichmentFilter();
+    } catch (error) {
+        enrichStatus.innerHTML = `❌ Error: ${error.message}`;
+        showToast(`❌ Failed to check contacts: ${error.message}`, 'error');
+    } finally {
+        enrichBtn.disabled = false;
+    }
+}
+
+function applyEnrichmentFilter() {
+    const mode = document.getElementById('enrich-filter-mode').value;
+    const skipOpenTodos = document.getElementById('enrich-skip-open-todos').checked;
+    
+    const selected = bulkEmailContacts.filter((contact, index) => {
+        const row = bulkEmailEnrichment[index];
+        if (!row || row.error) {
+            return mode === 'all';  // Unknown status - only kept when not filtering on it
+        }
+        if (mode === 'in' && !row.in_minicrm) return false;
+        if (mode === 'not_in' && row.in_minicrm) return false;
+        if (skipOpenTodos && row.open_todos > 0) return false;
+        return true;
+    });
+    
+    bulkEmailSelection = selected.length === bulkEmailContacts.length ? null : selected.map(c => c.email);
+    
+    const sendStatus = document.getElementById('send-status');
+    sendStatus.innerHTML = `<span style="color: #27ae60;">✅ Ready to send to ${selected.length} of ${bulkEmailContacts.length} contacts</span>`;
+}
+
+async function startPersonalizeJob() {
+    const prompt = document.getElementById('personalize-prompt').value.trim();
+    if (!prompt) {
+        showToast('❌ Please describe what the opener should say!', 'error');
+        return;
+    }
+    
+    const personalizeBtn = document.getElementById('personalize-btn');
+    const personalizeStatus = document.getElementById('personalize-status');
+    personalizeBtn.disabled = true;
+    personalizeStatus.innerHTML = '⏳ Starting...';
+    document.getElementById('personalize-drafts').innerHTML = '';
+    
+    try {
+        const response = await fetch('/api/personalize/jobs', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                prompt: prompt,
+                assistant: currentAssistant,
+                ...(bulkEmailSelection ? { emails: bulkEmailSelection } : {})
+            })
+        });
+        const data = await response.json();
+        
+        if (!response.ok) {
+            personalizeStatus.innerHTML = `❌ Error: ${data.error}`;
+            showToast(`❌ ${data.error}`, 'error');
+            return;
+        }
+        
+        personalizeJobId = data.job_id;
+        await pollPersonalizeJob();
+    } catch (error) {
+        personalizeStatus.innerHTML = `❌ Error: ${error.message}`;
+        showToast(`❌ Failed to generate openers: ${error.message}`, 'error');
+    } finally {
+        personalizeBtn.disabled = false;
+    }
+}
+
+async function pollPersonalizeJob() {
+    // Drafts are generated in the background - poll until the job stops
+    const jobId = personalizeJobId;
+    const personalizeStatus = document.getElementById('personalize-status');
+    let job;
+    
+    while (jobId === personalizeJobId) {
+        const response = await fetch(`/api/personalize/jobs/${jobId}?limit=50`);
+        job = await response.json();
+        if (!response.ok) {
+            personalizeStatus.innerHTML = `❌ Error: ${job.error}`;
+            return;
+        }
+        
+        // The worker running the job was restarted - pick it up again
+        if (job.stalled) {
+            await fetch(`/api/personalize/jobs/${jobId}/resume`, { method: 'POST' });
+        }
+        
+        const rate = job.drafts_per_minute ? `, ${job.drafts_per_minute}/min` : '';
+        personalizeStatus.innerHTML = `⏳ Generating openers... ${job.done + job.failed}/${job.total}${rate}`;
+        
+        if (job.status !== 'running' && job.status !== 'pending' && job.status !== 'cancelling') {
+            break;
+        }
+        await new Promise(resolve => setTimeout(resolve, 2000));
+    }
+    if (jobId !== personalizeJobId) {
+        return;  // A newer job replaced this one
+    }
+    
+    personalizeStatus.innerHTML = `
+        ${job.failed > 0 ? '⚠️' : '✅'} ${job.done}/${job.total} openers ready
+        (${job.cached} reused, ${job.failed} failed) in ${job.elapsed_seconds}s -
+        ${job.prompt_tokens + job.completion_tokens} tokens, ~$${job.estimated_cost_usd.toFixed(4)}
+        ${job.failed > 0 ? `<button onclick="resumePersonalizeJob()" style="margin-left: 8px; cursor: pointer;">🔄 Retry failed</button>` : ''}
+    `;
+    personalizeDraftsShown = 0;
+    document.getElementById('personalize-drafts').innerHTML = '';
+    renderPersonalizeDrafts(job);
+}
+
+async function resumePersonalizeJob() {
+    const response = await fetch(`/api/personalize/jobs/${personalizeJobId}/resume`, { method: 'POST' });
+    const data = await response.json();
+    if (!response.ok) {
+        showToast(`❌ ${data.error}`, 'error');
+        return;
+    }
+    await pollPersonalizeJob();
+}
+
+function renderPersonalizeDrafts(page) {
+    const container = document.getElementById('personalize-drafts');
+    container.querySelector('.load-more')?.remove();
+    
+    container.insertAdjacentHTML('beforeend', page.drafts.map(draft => `
+        <div style="padding: 8px; margin-bottom: 8px; background: #f8f9fa; border-radius: 6px; font-size: 13px;">
+            <strong>${escapeHtml(draft.person)}</strong> (${escapeHtml(draft.company)}) - ${escapeHtml(draft.email)}
+            ${draft.status === 'failed' ? `
+                <div style="color: #e74c3c; margin-top: 4px;">❌ ${escapeHtml(draft.error || 'Failed')}</div>
+            ` : `
+                <textarea onchange="savePersonalizeDraft(${draft.index}, this)" style="
+                    width: 100%;
+                    margin-top: 6px;
+                    padding: 8px;
+                    border: 1px solid #dee2e6;
+                    border-radius: 6px;
+                    font-size: 13px;
+                    font-family: inherit;
+                    box-sizing: border-box;
+                    resize: vertical;
+                ">${escapeHtml(draft.text || '')}</textarea>
+            `}
+        </div>
+    `).join(''));
+    
+    personalizeDraftsShown += page.drafts.length;
+    if (personalizeDraftsShown < page.total) {
+        container.insertAdjacentHTML('beforeend', `
+            <button class="load-more" onclick="loadMorePersonalizeDrafts()" style="width: 100%; padding: 8px; cursor: pointer;">
+                Show more (${page.total - personalizeDraftsShown} left)
+            </button>
+        `);
     }
 }
 
+async function loadMorePersonalizeDrafts() {
+    const response = await fetch(`/api/personalize/jobs/${personalizeJobId}?offset=${personalizeDraftsShown}&limit=50`);
+    const page = await response.json();
+    if (response.ok) {
+        renderPersonalizeDrafts(page);
+    } else {
+        showToast(`❌ ${page.error}`, 'error');
+    }
+}
+
+async function savePersonalizeDraft(index, textarea) {
+    const response = await fetch(`/api/personalize/jobs/${personalizeJobId}/drafts/${index}`, {
+        method: 'PUT',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ text: textarea.value })
+    });
+    if (response.ok) {
+        textarea.style.borderColor = '#27ae60';
+        campaignSpool = null;  // Rendered messages contain the old opener
+    } else {
+        const data = await response.json();
+        showToast(`❌ ${data.error}`, 'error');
+    }
+}
+
+function sendHistoryRules() {
+    // Ledger options shared by the pre-send check and the send itself
+    const skipRecent = document.getElementById('skip-recent-enabled').checked;
+    return {
+        campaign: document.getElementById('bulk-campaign').value.trim() || document.getElementById('email-subject').value.trim(),
+        skip_sent_in_campaign: document.getElementById('skip-sent-in-campaign').checked,
+        skip_recent_days: skipRecent ? parseFloat(document.getElementById('skip-recent-days').value) || null : null
+    };
+}
+
+async function checkSendHistory() {
+    const historyStatus = document.getElementById('send-history-status');
+    const rules = sendHistoryRules();
+    historyStatus.innerHTML = '⏳ Checking send history...';
+    
+    try {
+        const response = await fetch('/api/send_history/check', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({
+                campaign: rules.skip_sent_in_campaign ? rules.campaign : '',
+                skip_recent_days: rules.skip_recent_days,
+                ...(bulkEmailSelection ? { emails: bulkEmailSelection } : {})
+            })
+        });
+        const data = await response.json();
+        
+        if (!response.ok) {
+            historyStatus.innerHTML = `❌ Error: ${data.error}`;
+            return;
+        }
+        
+        const counts = data.skipped_counts;
+        historyStatus.innerHTML = `
+            ✅ ${data.to_send} of ${data.checked} will be sent.
+            Skipped: ${counts.already_sent_campaign} already got this campaign,
+            ${counts.emailed_recently} emailed recently, ${counts.unsubscribed} unsubscribed.
+        `;
+    } catch (error) {
+        historyStatus.innerHTML = `❌ Error: ${error.message}`;
+    }
+}
+
+async function addSuppressions() {
+    const input = prompt('Email addresses to unsubscribe (separated by commas or new lines):');
+    if (!input) return;
+    
+    const emails = input.split(/[\s,;]+/).filter(email => email.includes('@'));
+    const response = await fetch('/api/suppressions', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ emails: emails, reason: 'unsubscribed' })
+    });
+    const data = await response.json();
+    
+    if (response.ok) {
+        showToast(`✅ ${data.count} address(es) will not be emailed anymore`, 'success');
+    } else {
+        showToast(`❌ ${data.error}`, 'error');
+    }
+}
+
+async function loadSenderPool() {
+    const list = document.getElementById('sender-pool-list');
+    if (!list) return;
+    
+    try {
+        const response = await fetch('/api/sender_pool');
+        const data = await response.json();
+        if (!response.ok) {
+            list.innerHTML = `❌ Error: ${escapeHtml(data.error)}`;
+            return;
+        }
+        if (data.accounts.length === 0) {
+            list.innerHTML = 'No accounts yet - connect a Gmail account and add it to the pool.';
+            return;
+        }
+        
+        list.innerHTML = `
+            <div style="margin-bottom: 6px;">${data.available} of ${data.accounts.length} account(s) ready, ${data.remaining} emails left today</div>
+            ${data.accounts.map(account => {
+                let state = '✅ ready';
+                if (!account.enabled) {
+                    state = `❌ ${escapeHtml(account.last_error || 'disabled')}`;
+                } else if (account.paused_until && account.paused_until * 1000 > Date.now()) {
+                    state = `⏸️ paused until ${formatScheduleTime(account.paused_until * 1000)}`;
+                } else if (account.remaining === 0) {
+                    state = '⛔ daily quota used';
+                }
+                return `
+                    <div style="display: flex; align-items: center; gap: 8px; padding: 4px 0; border-top: 1px solid #f1f3f5;">
+                        <strong style="color: #2c3e50;">${escapeHtml(account.account)}</strong>
+                        <span>${account.sent_24h}/${account.daily_quota} in 24h, ${account.per_minute}/min, ${account.failed} failed</span>
+                        <span>${state}</span>
+                        <button onclick="removeSenderAccount('${escapeHtml(account.account)}')" style="margin-left: auto; padding: 2px 8px; cursor: pointer;">Remove</button>
+                    </div>
+                `;
+            }).join('')}
+        `;
+    } catch (error) {
+        list.innerHTML = `❌ Error: ${escapeHtml(error.message)}`;
+    }
+}
+
+async function addSenderAccount() {
+    const quota = prompt('Daily sending quota of the connected Gmail account (Gmail: 500, Google Workspace: 2000):', '500');
+    if (!quota) return;
+    
+    const response = await fetch('/api/sender_pool', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ daily_quota: parseInt(quota, 10) })
+    });
+    const data = await response.json();
+    
+    if (response.ok) {
+        showToast('✅ Account added to the sender pool', 'success');
+        loadSenderPool();
+    } else if (data.needs_auth) {
+        showToast('❌ Connect the Gmail account first, then add it to the pool.', 'error');
+    } else {
+        showToast(`❌ ${data.error}`, 'error');
+    }
+}
+
+async function removeSenderAccount(account) {
+    if (!confirm(`Remove ${account} from the sender pool?`)) return;
+    
+    const response = await fetch(`/api/sender_pool/${encodeURIComponent(account)}`, { method: 'DELETE' });
+    if (response.ok) {
+        loadSenderPool();
+    } else {
+        const data = await response.json();
+        showToast(`❌ ${data.error}`, 'error');
+    }
+}
+
+function campaignFields() {
+    // Everything that changes the rendered messages - a spool is only reused while these are unchanged
+    return JSON.stringify({
+        sender_name: document.getElementById('sender-name').value.trim(),
+        subject: document.getElementById('email-subject').value.trim(),
+        body: document.getElementById('email-body').value.trim(),
+        signature: document.getElementById('email-signature').value.trim(),
+        personalize_job_id: personalizeJobId,
+        emails: bulkEmailSelection
+    });
+}
+
+async function renderCampaign() {
+    const fields = campaignFields();
+    const { subject, body } = JSON.parse(fields);
+    if (!subject || !body) {
+        showToast('❌ Please fill in both subject and body!', 'error');
+        return;
+    }
+    
+    const renderBtn = document.getElementById('render-campaign-btn');
+    const preview = document.getElementById('campaign-preview');
+    renderBtn.disabled = true;
+    preview.style.display = 'block';
+    preview.innerHTML = '⏳ Rendering emails...';
+    campaignSpool = null;
+    
+    try {
+        // Large lists are rendered over several requests - continue with the spool_id until complete
+        let request = JSON.parse(fields);
+        let data;
+        while (true) {
+            const response = await fetch('/api/campaigns/render', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify(request)
+            });
+            data = await response.json();
+            if (!response.ok) {
+                preview.innerHTML = `<div style="color: #e74c3c;">❌ Error: ${data.error}</div>`;
+                showToast(`❌ ${data.error}`, 'error');
+                return;
+            }
+            if (data.complete) break;
+            preview.innerHTML = `⏳ Rendering emails... ${data.rendered}/${data.total}`;
+            request = { spool_id: data.spool_id };
+        }
+        
+        campaignSpool = { id: data.spool_id, fields: fields };
+        await showCampaignPreview(0);
+        showScheduleForm();
+    } catch (error) {
+        preview.innerHTML = `<div style="color: #e74c3c;">❌ Error: ${error.message}</div>`;
+        showToast(`❌ Failed to render emails: ${error.message}`, 'error');
+    } finally {
+        renderBtn.disabled = false;
+    }
+}
+
+async function showCampaignPreview(offset) {
+    const preview = document.getElementById('campaign-preview');
+    const pageSize = 5;
+    const response = await fetch(`/api/campaigns/${campaignSpool.id}?offset=${offset}&limit=${pageSize}`);
+    const data = await response.json();
+    if (!response.ok) {
+        preview.innerHTML = `<div style="color: #e74c3c;">❌ Error: ${data.error}</div>`;
+        return;
+    }
+    campaignPreviewOffset = offset;
+    
+    preview.innerHTML = `
+        <div style="background: #f8f9fa; border-radius: 12px; padding: 20px; border: 2px solid #27ae60;">
+            <h3 style="margin: 0 0 8px 0; color: #27ae60;">👁️ Preview (${data.total} emails${data.failed ? `, ${data.failed} could not be rendered` : ''})</h3>
+            <div style="font-size: 13px; color: #666; margin-bottom: 12px;">
+                Rendered in ${data.render_seconds}s (${(data.bytes / 1048576).toFixed(1)} MB). Sending uses these exact messages.
+            </div>
+            ${data.messages.map(message => `
+                <div style="background: white; border-radius: 8px; padding: 12px; margin-bottom: 12px; font-size: 13px;">
+                    <div><strong>#${message.index + 1} To:</strong> ${escapeHtml(message.person)} &lt;${escapeHtml(message.email)}&gt;</div>
+                    ${message.error ? `
+                        <div style="color: #e74c3c; margin-top: 6px;">❌ ${escapeHtml(message.error)}</div>
+                    ` : `
+                        <div><strong>Subject:</strong> ${escapeHtml(message.subject)}</div>
+                        <iframe sandbox srcdoc="${escapeHtml(message.html)}" style="width: 100%; height: 180px; border: 1px solid #dee2e6; border-radius: 6px; margin-top: 6px;"></iframe>
+                    `}
+                </div>
+            `).join('')}
+            <div style="display: flex; justify-content: space-between; align-items: center;">
+                <button onclick="showCampaignPreview(${Math.max(0, offset - pageSize)})" ${offset === 0 ? 'disabled' : ''} style="padding: 6px 12px; cursor: pointer;">◀ Previous</button>
+                <span style="font-size: 13px; color: #666;">${offset + 1}-${Math.min(offset + pageSize, data.total)} of ${data.total}</span>
+                <button onclick="showCampaignPreview(${offset + pageSize})" ${offset + pageSize >= data.total ? 'disabled' : ''} style="padding: 6px 12px; cursor: pointer;">Next ▶</button>
+            </div>
+        </div>
+    `;
+}
+
+const WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun'];
+
+function showScheduleForm() {
+    document.getElementById('schedule-section').style.display = 'block';
+    document.getElementById('schedule-form').innerHTML = `
+        <div style="background: #f8f9fa; border-radius: 12px; padding: 20px; border: 2px solid #667eea; margin-bottom: 16px; font-size: 14px;">
+            <h3 style="margin: 0 0 12px 0; color: #667eea;">🗓️ Schedule Delivery (Hungarian time)</h3>
+            <div style="margin-bottom: 8px;">
+                Start: <input type="datetime-local" id="schedule-start" style="padding: 4px;">
+                <span style="color: #666;">(empty = now)</span>
+            </div>
+            <div style="margin-bottom: 8px;">
+                Send on:
+                ${WEEKDAYS.map((day, i) => `
+                    <label style="margin-right: 6px; cursor: pointer;"><input type="checkbox" class="schedule-day" value="${i}" ${i < 5 ? 'checked' : ''}> ${day}</label>
+                `).join('')}
+            </div>
+            <div style="margin-bottom: 8px;">
+                Between <input type="time" id="schedule-window-start" value="09:00" style="padding: 4px;">
+                and <input type="time" id="schedule-window-end" value="17:00" style="padding: 4px;">
+            </div>
+            <div style="margin-bottom: 12px;">
+                At most <input type="number" id="schedule-per-hour" value="60" min="1" max="3600" style="width: 70px; padding: 4px;"> emails per hour from this Gmail account
+            </div>
+            <button onclick="scheduleCampaign()" style="padding: 10px 20px; background: #667eea; color: white; border: none; border-radius: 8px; font-weight: 600; cursor: pointer;">
+                🗓️ Schedule Campaign
+            </button>
+        </div>
+    `;
+}
+
+async function scheduleCampaign() {
+    if (!campaignSpool || campaignSpool.fields !== campaignFields()) {
+        showToast('❌ The email changed since it was rendered - please Render & Preview again.', 'error');
+        return;
+    }
+    
+    const rules = sendHistoryRules();
+    const response = await fetch(`/api/campaigns/${campaignSpool.id}/schedule`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({
+            start_at: document.getElementById('schedule-start').value || null,
+            send_window: {
+                days: [...document.querySelectorAll('.schedule-day:checked')].map(box => parseInt(box.value)),
+                start: document.getElementById('schedule-window-start').value,
+                end: document.getElementById('schedule-window-end').value
+            },
+            per_hour: parseInt(document.getElementById('schedule-per-hour').value),
+            ...rules
+        })
+    });
+    const data = await response.json();
+    
+    if (!response.ok) {
+        showToast(`❌ ${data.error}`, 'error');
+        if (data.needs_auth && confirm('Gmail not connected. Would you like to connect now?')) {
+            closeBulkEmailModal();
+            await connectGmail();
+        }
+        return;
+    }
+    
+    showToast(`✅ Scheduled ${data.total} emails - estimated to finish ${formatScheduleTime(data.eta)}`, 'success');
+    document.getElementById('schedule-form').innerHTML = '';
+    await loadSchedules();
+}
+
+function formatScheduleTime(isoTime) {
+    return isoTime ? new Date(isoTime).toLocaleString('hu-HU', { timeZone: 'Europe/Budapest', dateStyle: 'short', timeStyle: 'short' }) : '-';
+}
+
+async function loadSchedules() {
+    const list = document.getElementById('schedules-list');
+    if (!list) return;  // Modal closed
+    
+    const response = await fetch('/api/schedules');
+    if (!response.ok) return;
+    const data = await response.json();
+    const schedules = data.schedules.filter(s => s.status !== 'cancelled');
+    if (schedules.length === 0) {
+        list.innerHTML = '';
+        return;
+    }
+    
+    document.getElementById('schedule-section').style.display = 'block';
+    list.innerHTML = `
+        <div style="background: #f8f9fa; border-radius: 12px; padding: 20px; border: 2px solid #e9ecef; font-size: 13px;">
+            <h3 style="margin: 0 0 12px 0; color: #2c3e50;">📬 Scheduled Campaigns</h3>
+            ${schedules.map(s => `
+                <div style="background: white; border-radius: 8px; padding: 12px; margin-bottom: 8px;">
+                    <div style="display: flex; justify-content: space-between; align-items: center;">
+                        <strong>${escapeHtml(s.campaign)}</strong>
+                        <span>${{ scheduled: '🟢 Sending', paused: '⏸️ Paused', done: '✅ Done' }[s.status] || s.status}</span>
+                    </div>
+                    <div style="width: 100%; height: 6px; background: #e9ecef; border-radius: 3px; margin: 8px 0; overflow: hidden;">
+                        <div style="width: ${Math.round(s.processed / s.total * 100)}%; height: 100%; background: #667eea;"></div>
+                    </div>
+                    <div style="color: #666;">
+                        ${s.sent} sent, ${s.skipped} skipped, ${s.failed} failed of ${s.total} · ${s.per_hour}/hour from ${escapeHtml(s.account)}
+                        ${s.status === 'scheduled' ? `<br>Next: ${formatScheduleTime(s.next_send_at)} · ETA: ${formatScheduleTime(s.eta)}` : ''}
+                        ${s.last_error ? `<br><span style="color: #e74c3c;">⚠️ ${escapeHtml(s.last_error)}</span>` : ''}
+                        ${s.processed > 0 ? `<br>Deliveries: ${sendResultsExportLinks({ schedule_id: s.schedule_id })}` : ''}
+                    </div>
+                    ${s.status === 'scheduled' || s.status === 'paused' ? `
+                        <div style="margin-top: 8px;">
+                            ${s.status === 'scheduled'
+                                ? `<button onclick="updateSchedule('${s.schedule_id}', 'pause')" style="cursor: pointer;">⏸️ Pause</button>`
+                                : `<button onclick="updateSchedule('${s.schedule_id}', 'resume')" style="cursor: pointer;">▶️ Resume</button>`}
+                            <button onclick="updateSchedule('${s.schedule_id}', 'cancel')" style="cursor: pointer;">✖ Cancel</button>
+                        </div>
+                    ` : ''}
+                </div>
+            `).join('')}
+        </div>
+    `;
+    
+    // Keep progress fresh while the modal is open
+    if (schedules.some(s => s.status === 'scheduled')) {
+        clearTimeout(loadSchedules.timer);
+        loadSchedules.timer = setTimeout(loadSchedules, 30000);
+    }
+}
+
+async function updateSchedule(scheduleId, action) {
+    if (action === 'cancel' && !confirm('Cancel this campaign? Emails not sent yet will not be sent.')) {
+        return;
+    }
+    const response = await fetch(`/api/schedules/${scheduleId}/${action}`, { method: 'POST' });
+    const data = await response.json();
+    if (!response.ok) {
+        showToast(`❌ ${data.error}`, 'error');
+    }
+    await loadSchedules();
+}
+
 async function sendBulkEmails() {
     const senderName = document.getElementById('sender-name').value.trim();
     const subject = document.getElementById('email-subject').value.trim();
@@ -3671,8 +4645,14 @@ async function sendBulkEmails() {
         return;
     }
     
+    const recipientCount = bulkEmailSelection ? bulkEmailSelection.length : bulkEmailContacts.length;
+    if (recipientCount === 0) {
+        showToast('❌ No contacts match the current filter.', 'error');
+        return;
+    }
+    
     // Confirm before sending
-    if (!confirm(`Are you sure you want to send ${bulkEmailContacts.length} emails?\n\nThis action cannot be undone.`)) {
+    if (!confirm(`Are you sure you want to send ${recipientCount} emails?\n\nThis action cannot be undone.`)) {
         return;
     }
     
@@ -3698,26 +4678,93 @@ async function sendBulkEmails() {
     `;
     
     try {
-        const response = await fetch('/api/send_bulk_emails', {
-            method: 'POST',
-            headers: {
-                'Content-Type': 'application/json'
-            },
-            body: JSON.stringify({
-                sender_name: senderName,
-                subject: subject,
-                body: body,
-                signature: signature
-            })
-        });
+        // The server stops before its time budget runs out and returns
+        // complete: false + next_index - keep calling until every contact is processed
+        const allResults = { success: [], failed: [], skipped: [] };
+        const rules = sendHistoryRules();
+        // Send the previewed messages as they are, unless the template changed since rendering
+        const spoolId = campaignSpool && campaignSpool.fields === campaignFields() ? campaignSpool.id : null;
+        const usePool = document.getElementById('use-sender-pool').checked;
+        let startIndex = 0;
+        let notAttempted = 0;
+        let stopReason = '';
+        let response;
+        let data;
         
-        const data = await response.json();
+        while (true) {
+            response = await fetch('/api/send_bulk_emails', {
+                method: 'POST',
+                headers: {
+                    'Content-Type': 'application/json'
+                },
+                body: JSON.stringify({
+                    sender_name: senderName,
+                    subject: subject,
+                    body: body,
+                    signature: signature,
+                    start_index: startIndex,
+                    ...rules,
+                    ...(bulkEmailSelection ? { emails: bulkEmailSelection } : {}),
+                    ...(personalizeJobId ? { personalize_job_id: personalizeJobId } : {}),
+                    ...(spoolId ? { spool_id: spoolId } : {}),
+                    ...(usePool ? { use_sender_pool: true, pool_strategy: document.getElementById('pool-strategy').value } : {})
+                })
+            });
+            
+            data = await response.json();
+            
+            if (!response.ok) {
+                break;
+            }
+            
+            allResults.success.push(...data.results.success);
+            allResults.failed.push(...data.results.failed);
+            allResults.skipped.push(...data.results.skipped);
+            
+            if (data.complete !== false) {
+                break;
+            }
+            
+            // Stop if Gmail is failing - the remaining contacts were not attempted
+            if (warnIfDegraded(data)) {
+                notAttempted = data.total_contacts - data.next_index;
+                stopReason = 'Gmail is having problems';
+                break;
+            }
+            
+            // No pool account can send more today (quota used, paused or disabled)
+            if (data.pool_exhausted) {
+                notAttempted = data.total_contacts - data.next_index;
+                stopReason = 'The sender pool is out of quota';
+                break;
+            }
+            
+            startIndex = data.next_index;
+            const progressBar = document.getElementById('progress-bar');
+            if (progressBar) {
+                progressBar.style.width = `${Math.round(startIndex / data.total_contacts * 100)}%`;
+            }
+        }
         
         if (response.ok) {
+            data.results = allResults;
+            data.total_sent = allResults.success.length;
+            data.total_failed = allResults.failed.length;
+            data.total_skipped = allResults.skipped.length;
+            
             // Show results
             resultsSection.innerHTML = `
                 <div style="background: #f8f9fa; border-radius: 12px; padding: 20px; border: 2px solid #27ae60;">
-                    <h3 style="margin: 0 0 16px 0; color: #27ae60;">✅ Sending Complete!</h3>
+                    <h3 style="margin: 0 0 16px 0; color: #27ae60;">${notAttempted > 0 ? '⚠️ Sending Stopped' : '✅ Sending Complete!'}</h3>
+                    ${notAttempted > 0 ? `
+                        <p style="margin: 0 0 16px 0; color: #856404;">⚠️ ${stopReason} - ${notAttempted} contact(s) were not attempted. Send again later for the rest.</p>
+                    ` : ''}
+                    ${data.total_skipped > 0 ? `
+                        <p style="margin: 0 0 16px 0; color: #666;">⏭️ ${data.total_skipped} contact(s) skipped (unsubscribed, already got this campaign or emailed recently).</p>
+                    ` : ''}
+                    ${data.total_sent > 0 && rules.campaign ? `
+                        <p style="margin: 0 0 16px 0; font-size: 13px;">Everyone who got "${escapeHtml(rules.campaign)}": ${sendResultsExportLinks({ campaign: rules.campaign })}</p>
+                    ` : ''}
                     
                     <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 16px; margin-bottom: 20px;">
                         <div style="background: #d4edda; padding: 16px; border-radius: 8px; text-align: center;">
@@ -3744,7 +4791,9 @@ async function sendBulkEmails() {
                 </div>
             `;
             
-            showToast(`✅ Successfully sent ${data.total_sent} emails!`, 'success');
+            if (notAttempted === 0) {
+                showToast(`✅ Successfully sent ${data.total_sent} emails!`, 'success');
+            }
         } else {
             resultsSection.innerHTML = `
                 <div style="background: #f8d7da; border: 2px solid #e74c3c; border-radius: 12px; padding: 20px;">
@@ -3774,6 +4823,7 @@ async function sendBulkEmails() {
     } finally{
         sendBtn.innerHTML = originalText;
         sendBtn.disabled = false;
+        loadSenderPool();  // Updated quota use
     }
 }
 
@@ -3782,6 +4832,7 @@ async function sendBulkEmails() {
 // ============================================
 
 let currentMiniCRMContact = null;
+let dailyTodosShown = [];  // The list in the daily todos modal (exported as is)
 let showClosedTodos = false;  // Toggle for showing closed/completed todos
 
 async function loadMiniCRMTodos(email, includeClosedTodos = false) {
@@ -3824,22 +4875,39 @@ async function loadMiniCRMTodos(email, includeClosedTodos = false) {
         
         console.log(`Fetching todos - Business IDs: [${businessIds.join(', ')}], Category: ${promptSettings.miniCrmCategoryId || 'All'}, User ID: ${promptSettings.miniCrmUserName || 'All'}`);
         
-        const todosResponse = await fetch('/api/minicrm/get_todos', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({ 
-                business_ids: businessIds,  // ← Send ALL BusinessIds!
-                contact_name: contactData.contact.name,
-                category_id: promptSettings.miniCrmCategoryId || null,  // Filter by Termék (Product/Category)
-                filter_user: promptSettings.miniCrmUserName || null,  // Filter by assigned user
-                include_closed: includeClosedTodos  // Include completed/closed todos
-            })
-        });
-        
-        const todosData = await todosResponse.json();
+        // Partial results (complete: false + cursor) are resumed until everything is loaded
+        let todosData;
+        let todos = [];
+        let cursor = null;
+        do {
+            const todosResponse = await fetch('/api/minicrm/get_todos', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({ 
+                    business_ids: businessIds,  // ← Send ALL BusinessIds!
+                    contact_name: contactData.contact.name,
+                    category_id: promptSettings.miniCrmCategoryId || null,  // Filter by Termék (Product/Category)
+                    filter_user: promptSettings.miniCrmUserName || null,  // Filter by assigned user
+                    include_closed: includeClosedTodos,  // Include completed/closed todos
+                    cursor: cursor
+                })
+            });
+            
+            todosData = await todosResponse.json();
+            if (!todosData.success) {
+                break;
+            }
+            todos = todos.concat(todosData.todos);
+            // Don't keep resuming against a failing MiniCRM - show what we have
+            const degraded = warnIfDegraded(todosData);
+            cursor = todosData.complete === false && !degraded ? todosData.cursor : null;
+            if (todosData.error) {
+                showToast('⚠️ ' + todosData.error, 'warning');
+            }
+        } while (cursor);
         
-        if (todosData.success && todosData.todos.length > 0) {
-            displayMiniCRMTodosPanel(todosData.todos, contactData.contact);
+        if (todos.length > 0) {
+            displayMiniCRMTodosPanel(todos, contactData.contact);
         } else {
             console.log('No todos found for this company');
         }
@@ -4152,25 +5220,56 @@ async function openDailyTodosView() {
             return;
         }
         
-        // Fetch todos
-        const response = await fetch('/api/minicrm/daily_todos', {
-            method: 'POST',
-            headers: {'Content-Type': 'application/json'},
-            body: JSON.stringify({
-                category_id: promptSettings.miniCrmCategoryId || null,
-                filter_user: promptSettings.miniCrmUserName || null,  // Fixed: was miniCrmUserId
-                lookback_days: promptSettings.miniCrmLookbackDays || 30
-            })
-        });
+        // Fetch todos - the server returns partial results (complete: false + cursor)
+        // when it runs out of time, so keep resuming until everything is loaded
+        let todos = [];
+        let overdue = 0;
+        let todayCount = 0;
+        let cursor = null;
+        let degraded = null;
         
-        const data = await response.json();
+        do {
+            const response = await fetch('/api/minicrm/daily_todos', {
+                method: 'POST',
+                headers: {'Content-Type': 'application/json'},
+                body: JSON.stringify({
+                    category_id: promptSettings.miniCrmCategoryId || null,
+                    filter_user: promptSettings.miniCrmUserName || null,  // Fixed: was miniCrmUserId
+                    lookback_days: promptSettings.miniCrmLookbackDays || 30,
+                    cursor: cursor
+                })
+            });
+            
+            const data = await response.json();
+            
+            if (!data.success) {
+                showToast('❌ ' + (data.error || 'Failed to load todos'), 'error');
+                return;
+            }
+            
+            todos = todos.concat(data.todos);
+            overdue += data.overdue;
+            todayCount += data.today;
+            // Don't keep resuming against a failing MiniCRM - show what we have
+            degraded = data.degraded && data.degraded.length > 0 ? data : degraded;
+            cursor = data.complete === false && !degraded ? data.cursor : null;
+            if (data.error) {
+                // The server gave up on a partial result (no cursor) - show what we have
+                showToast('⚠️ ' + data.error, 'warning');
+            }
+            
+            if (cursor) {
+                showToast(`⏳ Loaded ${todos.length} todos so far, continuing...`, 'info');
+            }
+        } while (cursor);
         
-        if (data.success) {
-            showToast(`✅ Loaded ${data.total} todos (${data.overdue} overdue, ${data.today} today)`, 'success');
-            displayDailyTodosModal(data.todos, data.overdue, data.today);
-        } else {
-            showToast('❌ ' + (data.error || 'Failed to load todos'), 'error');
+        // Batches are sorted individually - sort the merged list by deadline (oldest first)
+        todos.sort((a, b) => (a.Deadline || '').localeCompare(b.Deadline || ''));
+        
+        if (!warnIfDegraded(degraded)) {
+            showToast(`✅ Loaded ${todos.length} todos (${overdue} overdue, ${todayCount} today)`, 'success');
         }
+        displayDailyTodosModal(todos, overdue, todayCount);
     } catch (error) {
         console.error('Error loading daily todos:', error);
         showToast('❌ Error: ' + error.message, 'error');
@@ -4185,6 +5284,7 @@ function displayDailyTodosModal(todos, overdueCount, todayCount) {
     }
     
     const today = new Date().toISOString().split('T')[0];
+    dailyTodosShown = todos;
     
     // Create modal
     const modal = document.createElement('div');
@@ -4252,6 +5352,10 @@ function displayDailyTodosModal(todos, overdueCount, todayCount) {
                         <div style="background: rgba(255, 255, 255, 0.2); padding: 8px 16px; border-radius: 12px;">
                             <span style="font-size: 14px; opacity: 0.9;">📦 ${categoryName}</span>
                         </div>
+                        ${todos.length > 0 ? `
+                        <button onclick="exportDailyTodos('xlsx')" style="background: rgba(255, 255, 255, 0.2); border: none; color: white; padding: 8px 16px; border-radius: 12px; cursor: pointer; font-size: 14px;">⬇️ Excel</button>
+                        <button onclick="exportDailyTodos('csv')" style="background: rgba(255, 255, 255, 0.2); border: none; color: white; padding: 8px 16px; border-radius: 12px; cursor: pointer; font-size: 14px;">⬇️ CSV</button>
+                        ` : ''}
                     </div>
                 </div>
                 <button onclick="closeDailyTodosModal()" style="
@@ -4388,6 +5492,38 @@ function displayDailyTodosModal(todos, overdueCount, todayCount) {
     document.body.appendChild(modal);
 }
 
+async function exportDailyTodos(format) {
+    // POST the loaded list - the server streams it back as a spreadsheet
+    try {
+        const response = await fetch('/api/export/daily_todos', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({ todos: dailyTodosShown, format: format })
+        });
+        if (!response.ok) {
+            const data = await response.json();
+            throw new Error(data.error || 'Export failed');
+        }
+        const match = /filename="([^"]+)"/.exec(response.headers.get('Content-Disposition') || '');
+        const link = document.createElement('a');
+        link.href = URL.createObjectURL(await response.blob());
+        link.download = match ? match[1] : `daily-todos.${format}`;
+        link.click();
+        URL.revokeObjectURL(link.href);
+    } catch (error) {
+        showToast('❌ Export failed: ' + error.message, 'error');
+    }
+}
+
+function sendResultsExportLinks(params) {
+    // Plain download links: the browser streams the file straight to disk
+    const query = new URLSearchParams(params);
+    return ['xlsx', 'csv'].map(format => {
+        query.set('format', format);
+        return `<a href="/api/export/send_results?${query}" download style="margin-right: 12px;">⬇️ ${format === 'xlsx' ? 'Excel' : 'CSV'}</a>`;
+    }).join('');
+}
+
 function closeDailyTodosModal() {
     const modal = document.getElementById('daily-todos-modal');
     if (modal) {